@@ -0,0 +1,278 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from psycopg2 import Error, sql
+
+# Indexes of the audit table.
+#
+# The "data contains" filter searches a text in the values of row_data. The
+# exact filter rebuilds a string for each audit row and cannot use an index,
+# so when the audit table has a trigram (pg_trgm) or a full text (tsvector)
+# index on the text of row_data, the filter is prefixed with an expression
+# using that index. The exact filter is kept to check the candidate rows.
+
+# Kinds of index usable by the data filter.
+DATA_INDEX_TRGM = "trgm"
+DATA_INDEX_TSVECTOR = "tsvector"
+
+# Indexed expressions, as written in pg_indexes.indexdef.
+TRGM_INDEX_PATTERN = "((row_data)::text) gin_trgm_ops"
+TSVECTOR_INDEX_PATTERN = "to_tsvector('simple'::regconfig, (row_data)::text)"
+
+
+def split_table_name(table_name):
+    """Split a schema qualified table name, the schema defaults to public."""
+    if "." in table_name:
+        schema, table = table_name.split(".", 1)
+        return schema, table
+    return "public", table_name
+
+
+def table_identifier(table_name):
+    """Quoted identifier of a table name, optionally schema qualified."""
+    return sql.Identifier(*table_name.split(".", 1))
+
+
+def table_indexes(cursor, audit_table):
+    """List the indexes of a table.
+    @returns list of (index name, index definition)
+    """
+    schema, table = split_table_name(audit_table)
+    cursor.execute("SELECT indexname, indexdef FROM pg_indexes "
+                   "WHERE schemaname = %s AND tablename = %s ORDER BY indexname",
+                   (schema, table))
+    return cursor.fetchall()
+
+
+def data_index_kind(cursor, audit_table):
+    """Detect an index usable by the data filter.
+    @returns DATA_INDEX_TRGM, DATA_INDEX_TSVECTOR or None
+    """
+    try:
+        indexes = table_indexes(cursor, audit_table)
+    except Error as e:
+        print("Cannot list the indexes of the audit table:", e)
+        return None
+    defs = [indexdef for name, indexdef in indexes]
+    if any(TRGM_INDEX_PATTERN in d for d in defs):
+        return DATA_INDEX_TRGM
+    if any(TSVECTOR_INDEX_PATTERN in d for d in defs):
+        return DATA_INDEX_TSVECTOR
+    return None
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def data_filter(value, index_kind=None):
+    """Build the "data contains" filter expression.
+    @param value text searched in the values of row_data
+    @param index_kind kind of the index of the audit table, None for no index
+    @returns (SQL template with a {} field per value, values), see SearchQuery
+    """
+    exact = "(SELECT string_agg(v,' ') FROM svals(row_data) as v) ILIKE {}"
+    pattern = "%" + escape_like(value) + "%"
+
+    if index_kind == DATA_INDEX_TRGM:
+        # The text representation of a hstore escapes " and \
+        hstore_value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return "(row_data::text ILIKE {} AND " + exact + ")", \
+            ["%" + escape_like(hstore_value) + "%", pattern]
+
+    if index_kind == DATA_INDEX_TSVECTOR and len(value.split()) > 0:
+        # Only whole words are indexed.
+        return "(to_tsvector('simple', row_data::text) @@ plainto_tsquery('simple', {}) AND " + exact + ")", \
+            [value, pattern]
+
+    return exact, [pattern]
+
+
+def create_data_index_statements(audit_table):
+    """SQL statements creating the trigram index used by the data filter."""
+    schema, table = split_table_name(audit_table)
+    return [sql.SQL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+            sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} "
+                    "USING gin ((row_data::text) gin_trgm_ops)").format(
+                        sql.Identifier(table + "_row_data_trgm_idx"), table_identifier(audit_table))]
+
+
+def spatial_index_statement(audit_table, table_name, column):
+    """SQL statement creating the GiST index used by the spatial filter on a table.
+    The index is on the geometry of the rows of this table only.
+    @param table_name schema qualified name of the table
+    @param column geometry column of the table
+    """
+    audit_schema, audit = split_table_name(audit_table)
+    schema, table = split_table_name(table_name)
+    return sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} "
+                   "USING gist (((row_data -> {})::geometry)) "
+                   "WHERE schema_name = {} AND table_name = {}").format(
+                       sql.Identifier("{}_{}_{}_gist_idx".format(audit, table, column)),
+                       table_identifier(audit_table),
+                       sql.Literal(column), sql.Literal(schema), sql.Literal(table))
+
+
+def has_spatial_index(indexes, table_name, column):
+    """Whether the spatial filter on a table can use an index.
+    @param indexes list of (index name, index definition), as returned by table_indexes()
+    """
+    schema, table = split_table_name(table_name)
+    expression = "(row_data -> '{}'::text))::geometry".format(column)
+    return any("USING gist" in d and expression in d and "'{}'::text".format(table) in d
+               for name, d in indexes)
+
+
+def run_outside_transaction(connection, statements):
+    """Run statements in autocommit mode, as needed by CREATE INDEX CONCURRENTLY.
+    @param connection psycopg2 connection
+    @param statements list of SQL statements, strings or sql.Composable
+    """
+    connection.rollback()
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        cursor = connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    finally:
+        connection.autocommit = autocommit
+
+
+def statements_text(connection, statements):
+    """Text of SQL statements, to be displayed before running them.
+    @param connection psycopg2 connection, used to quote the identifiers
+    @param statements list of SQL statements, strings or sql.Composable
+    """
+    return ";\n".join(s.as_string(connection) if isinstance(s, sql.Composable) else s
+                       for s in statements)
+
+
+# Indexes recommended for the searches of the event dialog:
+# (name suffix, indexed columns, pattern of pg_indexes.indexdef, usage)
+RECOMMENDED_INDEXES = [
+    ("tstamp_idx",
+     "(action_tstamp_clk DESC, event_id DESC)",
+     "btree (action_tstamp_clk",
+     "event list ordered by date, date range, jump to date"),
+    ("table_tstamp_idx",
+     "(schema_name, table_name, action_tstamp_clk DESC)",
+     "(schema_name, table_name, action_tstamp_clk",
+     "layer filter"),
+    ("row_id_idx",
+     "((row_data->'id'))",
+     "(row_data -> 'id'::text)",
+     "feature id filter"),
+    ("transaction_idx",
+     "(transaction_id)",
+     "btree (transaction_id)",
+     "replay of a whole transaction"),
+    ("transaction_tstamp_idx",
+     "(action_tstamp_tx DESC, transaction_id DESC)",
+     "btree (action_tstamp_tx DESC, transaction_id DESC)",
+     "events grouped by transaction"),
+    ("application_idx",
+     "(coalesce(application_name, ''), event_id)",
+     "(COALESCE(application_name, ''::text), event_id)",
+     "application filter, sort by application"),
+    ("user_idx",
+     "(coalesce(session_user_name, ''), event_id)",
+     "(COALESCE(session_user_name, ''::text), event_id)",
+     "user filter, sort by user"),
+]
+
+
+def missing_indexes(indexes):
+    """Recommended indexes that are not defined yet.
+    @param indexes list of (index name, index definition), as returned by table_indexes()
+    @returns list of items of RECOMMENDED_INDEXES
+    """
+    defs = [indexdef for name, indexdef in indexes]
+    return [r for r in RECOMMENDED_INDEXES
+            if not any(r[2] in d for d in defs)]
+
+
+def create_index_statement(audit_table, recommended_index):
+    """CREATE INDEX CONCURRENTLY statement of a recommended index."""
+    suffix, columns, pattern, usage = recommended_index
+    schema, table = split_table_name(audit_table)
+    return sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} " + columns).format(
+        sql.Identifier("{}_{}".format(table, suffix)), table_identifier(audit_table))
+
+
+def representative_searches(cursor, audit_table):
+    """Queries of the event dialog for representative filter combinations.
+    The queries are built by SearchQuery and KeysetPager, as the event dialog
+    does, filter values are taken from the most recent event.
+    @returns list of (label, query with numbered placeholders, parameters)
+    """
+    # search_query depends on this module
+    from .search_query import SearchQuery, EVENT_COLUMNS
+    from .keyset_pager import KeysetPager
+
+    cursor.execute(sql.SQL("SELECT schema_name, table_name, row_data->'id', action_tstamp_clk, event_id, "
+                           "coalesce(session_user_name, '') "
+                           "FROM {} ORDER BY event_id DESC LIMIT 1").format(table_identifier(audit_table)))
+    sample = cursor.fetchone()
+    if sample is None:
+        return []
+    schema, table, feature_id, tstamp, event_id, user = sample
+
+    def search():
+        return SearchQuery(audit_table)
+
+    searches = [("All events", search(), None),
+                ("Next page", search(), (tstamp, event_id)),
+                ("Layer", search().filterTable(schema, table), None),
+                ("Deletes", search().filterActions(['D']), None),
+                ("Before a date", search().filterBefore(tstamp), None),
+                ("User", search().filterUser(user), None),
+                ("Sorted by user, next page", search().sortBy("user", False), (user, event_id))]
+    if feature_id is not None:
+        searches.append(("Layer and feature id",
+                         search().filterTable(schema, table).filterFeatureId(feature_id), None))
+
+    queries = []
+    for label, s, key in searches:
+        # first page, or the page after an event
+        pager = KeysetPager(None, EVENT_COLUMNS, s, 100)
+        conditions = []
+        if key is not None:
+            conditions.append(pager.keyCondition(pager.keyOperators()[0], key))
+        q, params = s.build(", ".join(EVENT_COLUMNS), conditions, order=True, limit=pager.page_size, numbered=True)
+        queries.append((label, q, params))
+    return queries
+
+
+def explain_analyze(cursor, query, params):
+    """Run EXPLAIN (ANALYZE, BUFFERS) on a query, prepared as the event dialog does.
+    @returns the plan, as a list of lines
+    """
+    from .search_query import prepare, execute_statement
+
+    name = prepare(cursor, query)
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + execute_statement(name, params), params)
+    return [r[0] for r in cursor.fetchall()]
+
+
+def plan_uses_seq_scan(plan, audit_table):
+    """Whether a plan reads the whole audit table."""
+    schema, table = split_table_name(audit_table)
+    return any("Seq Scan on " + table in line or "Seq Scan on " + audit_table in line
+               for line in plan)
@@ -0,0 +1,97 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from psycopg2 import sql
+
+from .audit_indexes import split_table_name, table_identifier
+
+# Suggested values of the quick filters of the event list.
+#
+# The distinct values of a column are read from the statistics of the audit
+# table (pg_stats) when all of them are listed there as most common values,
+# so that no audit row is read. Otherwise they are listed by a "loose index
+# scan": a recursive query jumping from a value to the next greater one,
+# which reads one index entry per distinct value when the expressions are
+# the first ones of an index (see audit_indexes.RECOMMENDED_INDEXES).
+#
+# This module does not depend on QGIS.
+
+# Quick filters: key => expressions of the audit table, values are joined with "."
+QUICK_FILTERS = {"table": ["schema_name", "table_name"],
+                 "application": ["coalesce(application_name, '')"],
+                 "user": ["coalesce(session_user_name, '')"]}
+
+# Columns whose statistics list the values of a quick filter.
+STATISTICS_COLUMNS = {"application": "application_name",
+                      "user": "session_user_name"}
+
+# Maximum number of suggested values of a filter.
+MAX_SUGGESTIONS = 200
+
+
+def statistics_values(cursor, audit_table, column):
+    """Distinct values of a column, from the statistics of the table.
+    @returns list of values, None when the statistics do not list all the values
+    """
+    schema, table = split_table_name(audit_table)
+    cursor.execute("SELECT most_common_vals::text::text[], n_distinct FROM pg_stats "
+                   "WHERE schemaname = %s AND tablename = %s AND attname = %s",
+                   (schema, table, column))
+    r = cursor.fetchone()
+    if r is None or r[0] is None:
+        return None
+    values, n_distinct = r
+    # a negative n_distinct is a fraction of the number of rows
+    if n_distinct <= 0 or len(values) < n_distinct:
+        return None
+    return sorted(values)
+
+
+def loose_scan_values(cursor, audit_table, expressions, limit=MAX_SUGGESTIONS):
+    """Distinct values of expressions, by a loose index scan.
+    @returns list of value tuples, in ascending order
+    """
+    keys = ["k{}".format(i) for i in range(len(expressions))]
+    select = ", ".join("{} AS {}".format(e, k) for e, k in zip(expressions, keys))
+    order = ", ".join(str(i + 1) for i in range(len(expressions)))
+    cursor.execute(
+        sql.SQL("WITH RECURSIVE v AS ("
+                "(SELECT {s} FROM {t} ORDER BY {o} LIMIT 1) "
+                "UNION ALL "
+                "SELECT n.* FROM v, LATERAL (SELECT {s} FROM {t} WHERE ({e}) > ({p}) ORDER BY {o} LIMIT 1) AS n"
+                ") SELECT {k} FROM v LIMIT %s").format(
+            s=sql.SQL(select), t=table_identifier(audit_table), o=sql.SQL(order),
+            e=sql.SQL(", ".join(expressions)),
+            p=sql.SQL(", ".join("v." + k for k in keys)), k=sql.SQL(", ".join(keys))),
+        (limit,))
+    return cursor.fetchall()
+
+
+def distinct_values(cursor, audit_table, filter_key, limit=MAX_SUGGESTIONS):
+    """Suggested values of a quick filter.
+    Can be run in a QueryWorker thread.
+    @param filter_key key of QUICK_FILTERS
+    @returns list of values, at most limit
+    """
+    column = STATISTICS_COLUMNS.get(filter_key)
+    if column is not None:
+        values = statistics_values(cursor, audit_table, column)
+        if values is not None:
+            return [v for v in values if v != ""][:limit]
+    return [".".join(r) for r in loose_scan_values(cursor, audit_table, QUICK_FILTERS[filter_key], limit)
+            if all(v is not None and v != "" for v in r)]
@@ -26,16 +26,34 @@ from PyQt5.QtWidgets import QDialog, QMessageBox, QMenu
 from qgis.core import QgsProject, QgsLayerTreeModel, QgsDataSourceUri
 from qgis.gui import QgsLayerTreeView
 
+from psycopg2 import Error
+
 from .connection_wrapper import ConnectionWrapper
+from .table_metadata import MetadataCache
+from .index_advisor_dialog import IndexAdvisorDialog
+from .audit_indexes import (data_index_kind,
+                            create_data_index_statements,
+                            run_outside_transaction,
+                            statements_text,
+                            table_indexes,
+                            spatial_index_statement,
+                            has_spatial_index,
+                            DATA_INDEX_TRGM,
+                            DATA_INDEX_TSVECTOR)
+from .live_tail import create_notify_trigger_statements, has_notify_trigger
 
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'config.ui'))
 
+# Loading modes, in the order of the combo box items.
+PAGINATION_MODES = ["keyset", "cursor"]
+
 
 class ConfigDialog(QDialog, FORM_CLASS):
-    def __init__(self, parent, db_connection="", audit_table="", table_map={}, replay_function=None):
+    def __init__(self, parent, db_connection="", audit_table="", table_map={}, replay_function=None, fetch_size=1000, pagination="keyset", estimate_count=False, level_of_detail=False, metadata=None, max_events=100000):
         """Constructor.
         @param parent parent widget
+        @param metadata MetadataCache shared by the dialogs
         """
         super(ConfigDialog, self).__init__(parent)
         self.setupUi(self)
@@ -44,6 +62,7 @@ class ConfigDialog(QDialog, FORM_CLASS):
             QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'repeat.svg')))
 
         self._table_map = table_map
+        self.metadata = metadata if metadata is not None else MetadataCache()
 
         self.tree_group = QgsProject.instance().layerTreeRoot().clone()
         self.tree_model = QgsLayerTreeModel(self.tree_group)
@@ -59,6 +78,13 @@ class ConfigDialog(QDialog, FORM_CLASS):
         self.reloadBtn.clicked.connect(self.onDatabaseChanged)
         self.dbConnectionBtn.clicked.connect(self.onBrowseConnection)
         self.tableCombo.currentIndexChanged.connect(self.onTableEdit)
+        self.auditTableCombo.currentIndexChanged.connect(self.onAuditTableChanged)
+        self.dataIndexBtn.clicked.connect(self.onCreateDataIndex)
+        self.diagnosticsBtn.clicked.connect(self.onDiagnostics)
+        self.dataIndexBtn.setEnabled(False)
+        self.notifyTriggerBtn.clicked.connect(self.onCreateNotifyTrigger)
+        self.notifyTriggerBtn.setEnabled(False)
+        self.spatialIndexBtn.clicked.connect(self.onCreateSpatialIndex)
 
         if db_connection:
             self.dbConnectionText.setText(db_connection)
@@ -71,6 +97,13 @@ class ConfigDialog(QDialog, FORM_CLASS):
                     self.replayFunctionCombo.findText(replay_function))
                 self.replayFunctionChk.setChecked(True)
 
+        self.fetchSizeSpin.setValue(fetch_size)
+        self.paginationCombo.setCurrentIndex(
+            PAGINATION_MODES.index(pagination) if pagination in PAGINATION_MODES else 0)
+        self.estimateCountChk.setChecked(estimate_count)
+        self.levelOfDetailChk.setChecked(level_of_detail)
+        self.maxEventsSpin.setValue(max_events)
+
         self.tables = None
 
     def sslModeToString(self, mode):
@@ -143,17 +176,13 @@ class ConfigDialog(QDialog, FORM_CLASS):
         if cur == None:
             return
 
-        # populate tables
-        q = "SELECT table_schema ,table_name FROM information_schema.tables" \
-            " where table_schema not in ('pg_catalog', 'information_schema') order by table_schema, table_name"
-
-        cur.execute(q)
+        # populate tables, from the metadata cache
+        self.metadata.refreshIfChanged(self.connection_wrapper)
 
         self.tableCombo.clear()
         self.tableCombo.addItem("")
 
-        for r in cur.fetchall():
-            t = r[0] + "." + r[1]
+        for t in self.metadata.tableNames():
             self.auditTableCombo.addItem(t)
             self.tableCombo.addItem(t)
 
@@ -169,6 +198,90 @@ class ConfigDialog(QDialog, FORM_CLASS):
             t = r[0] + "." + r[1]
             self.replayFunctionCombo.addItem(t)
 
+    def onAuditTableChanged(self, idx):
+        self.dataIndexLabel.setText("")
+        self.dataIndexBtn.setEnabled(False)
+        self.notifyTriggerBtn.setEnabled(False)
+        audit_table = self.auditTableCombo.itemText(idx)
+        if not audit_table or not self.connection_wrapper.isValid():
+            return
+
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            return
+        kind = data_index_kind(cur, audit_table)
+        try:
+            notify = has_notify_trigger(cur, audit_table)
+        except Error:
+            notify = False
+        cur.close()
+        self.connection_wrapper.rollback()
+
+        self.notifyTriggerBtn.setEnabled(not notify)
+        self.notifyTriggerBtn.setToolTip(
+            "The new events are notified, they can be followed live" if notify else
+            "Install a trigger notifying the new events, needed to follow them live (PostgreSQL 10 or later)")
+
+        if kind == DATA_INDEX_TRGM:
+            self.dataIndexLabel.setText("trigram index")
+        elif kind == DATA_INDEX_TSVECTOR:
+            self.dataIndexLabel.setText("full text index (whole words)")
+        else:
+            self.dataIndexLabel.setText("no data index")
+            self.dataIndexBtn.setEnabled(True)
+
+        self.updateSpatialIndexBtn()
+
+    def onCreateDataIndex(self):
+        audit_table = self.auditTableCombo.currentText()
+        if not audit_table:
+            return
+        statements = create_data_index_statements(audit_table)
+        r = QMessageBox.question(self, "Data index",
+                                 "The following statements will be run, it may take a while on a big audit table:\n\n" +
+                                 statements_text(self.connection_wrapper.psycopg2Connection, statements))
+        if r != QMessageBox.Yes:
+            return
+
+        try:
+            run_outside_transaction(
+                self.connection_wrapper.psycopg2Connection, statements)
+        except Error as e:
+            QMessageBox.critical(self, "Data index", str(e))
+
+        self.onAuditTableChanged(self.auditTableCombo.currentIndex())
+
+    def onCreateNotifyTrigger(self):
+        audit_table = self.auditTableCombo.currentText()
+        if not audit_table:
+            return
+        statements = create_notify_trigger_statements(audit_table)
+        r = QMessageBox.question(self, "Live follow",
+                                 "The following statements will be run:\n\n" +
+                                 statements_text(self.connection_wrapper.psycopg2Connection, statements))
+        if r != QMessageBox.Yes:
+            return
+
+        try:
+            run_outside_transaction(
+                self.connection_wrapper.psycopg2Connection, statements)
+        except Error as e:
+            QMessageBox.critical(self, "Live follow", str(e))
+
+        self.onAuditTableChanged(self.auditTableCombo.currentIndex())
+
+    def onDiagnostics(self):
+        audit_table = self.auditTableCombo.currentText()
+        if not audit_table or not self.connection_wrapper.isValid():
+            QMessageBox.warning(self, "Diagnostics",
+                                "Please select a database connection and an audit table first")
+            return
+        self.advisor_dlg = IndexAdvisorDialog(
+            self, self.connection_wrapper, audit_table)
+        self.advisor_dlg.exec_()
+        # indexes may have been created
+        self.onAuditTableChanged(self.auditTableCombo.currentIndex())
+
     def onLayerChanged(self, layer):
         if layer is None:
             return
@@ -184,6 +297,47 @@ class ConfigDialog(QDialog, FORM_CLASS):
         current = self.treeView.currentLayer()
         if current is not None:
             self._table_map[current.id()] = table_name
+        self.updateSpatialIndexBtn()
+
+    def updateSpatialIndexBtn(self):
+        """Offer the spatial index of the current table if it has a geometry and no index yet."""
+        self.spatialIndexBtn.setEnabled(False)
+        audit_table = self.auditTableCombo.currentText()
+        table_name = self.tableCombo.currentText()
+        columns = self.metadata.geometryColumns(table_name) if table_name else []
+        if not audit_table or len(columns) == 0 or not self.connection_wrapper.isValid():
+            return
+
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            return
+        try:
+            indexes = table_indexes(cur, audit_table)
+        finally:
+            cur.close()
+            self.connection_wrapper.rollback()
+        self.spatialIndexBtn.setEnabled(not has_spatial_index(indexes, table_name, columns[0]))
+
+    def onCreateSpatialIndex(self):
+        audit_table = self.auditTableCombo.currentText()
+        table_name = self.tableCombo.currentText()
+        columns = self.metadata.geometryColumns(table_name)
+        if not audit_table or len(columns) == 0:
+            return
+        statement = spatial_index_statement(audit_table, table_name, columns[0])
+        r = QMessageBox.question(self, "Spatial index",
+                                 "The following statement will be run, it may take a while on a big audit table:\n\n" +
+                                 statements_text(self.connection_wrapper.psycopg2Connection, [statement]))
+        if r != QMessageBox.Yes:
+            return
+
+        try:
+            run_outside_transaction(
+                self.connection_wrapper.psycopg2Connection, [statement])
+        except Error as e:
+            QMessageBox.critical(self, "Spatial index", str(e))
+
+        self.updateSpatialIndexBtn()
 
     def table_map(self):
         return self._table_map
@@ -198,3 +352,18 @@ class ConfigDialog(QDialog, FORM_CLASS):
 
     def db_connection(self):
         return self.dbConnectionText.text()
+
+    def fetch_size(self):
+        return self.fetchSizeSpin.value()
+
+    def pagination(self):
+        return PAGINATION_MODES[self.paginationCombo.currentIndex()]
+
+    def estimate_count(self):
+        return self.estimateCountChk.isChecked()
+
+    def level_of_detail(self):
+        return self.levelOfDetailChk.isChecked()
+
+    def max_events(self):
+        return self.maxEventsSpin.value()
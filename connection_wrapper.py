@@ -17,10 +17,13 @@
 """
 # -*- coding: utf-8 -*-
 from qgis.core import QgsTransactionGroup, QgsProject, QgsDataSourceUri
-from psycopg2 import Error
+from psycopg2 import Error, OperationalError, InterfaceError
+from psycopg2.extras import register_hstore
+from psycopg2.extensions import STATUS_READY
 
 from .credentials_dialog import CredentialsDialog
 import psycopg2
+import threading
 import os
 
 # This object contains database connection wrapped for both
@@ -33,7 +36,49 @@ import os
 #
 # In some case transaction group cannot be used. To disable transaction
 # group use disableTransactionGroup().
-# Direct connection allow the use of cursor() for cursor creation.
+# Direct connection allow the use of cursor() for cursor creation and
+# namedCursor() for server-side cursor creation.
+#
+# Direct connections can be taken from a ConnectionPool, see
+# setConnectionPool(): each role (streaming reader, detail and metadata
+# reader, reader of the GUI thread, writer) has its own session, so that a
+# long event list cursor, a detail lookup and a replay do not block each
+# other, and that a query of the GUI thread never rolls back a transaction
+# of a background worker.
+
+# Connection roles.
+ROLE_STREAM = "stream"
+ROLE_DETAIL = "detail"
+ROLE_READ = "read"
+ROLE_WRITE = "write"
+CONNECTION_ROLES = [ROLE_STREAM, ROLE_DETAIL, ROLE_READ, ROLE_WRITE]
+
+
+# Check that a direct connection is still usable.
+# A connection in a transaction is not checked, the running query will fail
+# if it is broken.
+# probe: whether a query may be sent to check the connection. The probe ends
+# its transaction, it must not be sent on a connection that another thread
+# may be using: psycopg2 marks a broken connection as closed when one of its
+# queries fails, only this flag is checked then.
+def connection_is_healthy(connection, probe=True):
+    if connection.closed != 0:
+        return False
+
+    if not probe or connection.status != STATUS_READY:
+        return True
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        connection.rollback()
+
+    except (OperationalError, InterfaceError) as ex:
+        print("Broken database connection:", ex)
+        return False
+
+    return True
 
 
 class ConnectionWrapper():
@@ -42,11 +87,18 @@ class ConnectionWrapper():
     def disableTransactionGroup(self, disabled):
         self.qgisTransactionGroupDisabled = disabled
 
+    # Take the direct connection from a pool, instead of opening a new one.
+    # pool: an open ConnectionPool.
+    # role: one of CONNECTION_ROLES.
+    def setConnectionPool(self, pool, role):
+        self.connectionPool = pool
+        self.connectionRole = role
+
     # Create database connection.
     # db_connection: database connection string.
     def openConnection(self, db_connection):
         # Check for connection is already open.
-        if self.isConnected() and self.db_source == db_connection:
+        if self.isConnected() and self.db_source == db_connection and self.checkConnection():
             print("Connection already open: reusing it.")
             return
 
@@ -63,12 +115,59 @@ class ConnectionWrapper():
                 return
 
         # Transaction group not available: try to create direct connection.
-        if self.psycopg2Connection == None:
+        if self.psycopg2Connection == None and self.connectionPool != None:
+            self.storePsycopg2Connection(
+                self.connectionPool.connection(self.connectionRole))
+            self.connected_db_source = self.connectionPool.connected_db_source
+
+        elif self.psycopg2Connection == None:
             dirConn = self.createSingleConnection(db_connection)
 
             if dirConn != None:
                 self.storePsycopg2Connection(dirConn)
 
+    # Check the direct connection and reconnect if it is broken, without
+    # asking the credentials again.
+    # Return False if there is no usable connection.
+    def checkConnection(self):
+        if self.qgisTransactionGroupConnection != None:
+            return True
+
+        if self.psycopg2Connection == None:
+            return False
+
+        if self.connectionPool != None:
+            healthy = self.connectionPool.isHealthy(
+                self.connectionRole, self.psycopg2Connection)
+        else:
+            healthy = connection_is_healthy(self.psycopg2Connection)
+
+        if healthy:
+            return True
+
+        print("Reconnecting to the database.")
+        if self.connectionPool != None:
+            broken = self.psycopg2Connection
+            self.psycopg2Connection = self.connectionPool.reconnect(
+                self.connectionRole, broken)
+            if self.psycopg2Connection == None:
+                self.connectionPool.release(self.connectionRole, broken)
+
+        else:
+            try:
+                self.psycopg2Connection = psycopg2.connect(self.connected_db_source)
+
+            except Error as ex:
+                print("Cannot reconnect to the database:", ex)
+                self.psycopg2Connection = None
+
+        return self.psycopg2Connection != None
+
+    # Connection string of the direct connection, including the credentials
+    # that may have been asked to the user.
+    def connectionString(self):
+        return self.connected_db_source
+
     # Check for a valid connection has been wrapped.
     def isValid(self):
         if self.psycopg2Connection == None and self.qgisTransactionGroupConnection == None:
@@ -123,6 +222,21 @@ class ConnectionWrapper():
         else:
             print("Connection wrapper doesn't store any database connection!")
 
+    # Rollback current transaction. For direct connection only.
+    def rollback(self):
+
+        # Use psycopg2 connection.
+        if self.psycopg2Connection != None:
+            self.psycopg2Connection.rollback()
+
+        # Use QGis.QgsTransactionGroup connection.
+        elif self.qgisTransactionGroupConnection != None:
+            # No rollback for transaction group.
+            pass
+
+        else:
+            print("Connection wrapper doesn't store any database connection!")
+
     # Create new cursor. For direct connection only.
     def cursor(self):
         if self.psycopg2Connection != None:
@@ -132,9 +246,43 @@ class ConnectionWrapper():
 
         return None
 
+    # Create new server-side (named) cursor. For direct connection only.
+    # name: cursor name, unique for the session.
+    # itersize: number of rows transferred at once from the server.
+    def namedCursor(self, name, itersize=1000):
+        if self.psycopg2Connection != None:
+            cursor = self.psycopg2Connection.cursor(name)
+            cursor.itersize = itersize
+            return cursor
+
+        print("Cannot create server-side cursor without direct connection!")
+
+        return None
+
+    # Register psycopg2's hstore adapter, so that hstore values are returned
+    # as dicts. For direct connection only.
+    # Return False if the hstore extension is not available.
+    def registerHstore(self):
+        if self.psycopg2Connection == None:
+            return False
+
+        try:
+            register_hstore(self.psycopg2Connection)
+
+        except Error as ex:
+            print("Cannot register the hstore adapter:", ex)
+            return False
+
+        return True
+
     # Close connection.
+    # A pooled connection is given back to its pool.
     def closeConnection(self):
 
+        if self.psycopg2Connection != None and self.connectionPool != None:
+            self.connectionPool.release(self.connectionRole, self.psycopg2Connection)
+            self.psycopg2Connection = None
+
         if self.psycopg2Connection != None:
             del self.psycopg2Connection
             self.psycopg2Connection = None
@@ -158,6 +306,9 @@ class ConnectionWrapper():
     #
     db_source = ""
 
+    # Connection string used for the direct connection.
+    connected_db_source = ""
+
     # psycopg2 database connection.
     psycopg2Connection = None
 
@@ -165,6 +316,10 @@ class ConnectionWrapper():
     qgisTransactionGroupConnection = None
     qgisTransactionGroupDisabled = False
 
+    # Pool and role of the direct connection.
+    connectionPool = None
+    connectionRole = None
+
     def __exit__(self, exc_type, exc_value, traceback):
         self.closeConnection()
 
@@ -242,4 +397,144 @@ class ConnectionWrapper():
                 return self.createSingleConnection(db_connection)
 
         # Create has been successfull done.
+        self.connected_db_source = db_connection
+        return conn
+
+
+# Pool of direct connections, one per role, with the semantics of
+# psycopg2.pool.ThreadedConnectionPool getconn(key)/putconn(key): the
+# connection of a role is shared by the wrappers of that role, it can be used
+# from a worker thread while the other roles are in use, and it is kept open
+# when released.
+#
+# Credentials are asked once when the pool is opened, and kept for the
+# connections opened later, e.g. to replace a broken one.
+class ConnectionPool():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # role => psycopg2 connection
+        self.connections = {}
+        # role => number of wrappers using the connection
+        self.users = {}
+
+    # Open the pool.
+    # db_connection: database connection string.
+    # Return False if no connection can be established.
+    def open(self, db_connection):
+        if self.isOpen() and self.db_source == db_connection:
+            return True
+
+        self.close()
+
+        # Ask for credentials if needed, the first connection is kept for
+        # the detail role.
+        probe = ConnectionWrapper()
+        probe.disableTransactionGroup(True)
+        conn = probe.createSingleConnection(db_connection)
+        if conn == None:
+            return False
+
+        self.db_source = db_connection
+        self.connected_db_source = probe.connectionString()
+        with self.lock:
+            self.connections[ROLE_DETAIL] = conn
+
+        return True
+
+    # Check for the pool is open.
+    def isOpen(self):
+        return self.connected_db_source != ""
+
+    # Get the connection of a role, checked for health.
+    # Each call must be balanced by a call to release().
+    # Return None if the database cannot be reached.
+    def connection(self, role):
+        if not self.isOpen():
+            return None
+
+        with self.lock:
+            conn = self.connections.get(role)
+            if conn == None or not connection_is_healthy(conn, self.users.get(role, 0) == 0):
+                conn = self.connect(role)
+
+            if conn != None:
+                self.users[role] = self.users.get(role, 0) + 1
+
+            return conn
+
+    # Check the connection of a role for a wrapper using it.
+    # The database is only queried if no other wrapper uses the connection,
+    # so that the check never ends a transaction of another thread.
+    def isHealthy(self, role, connection):
+        with self.lock:
+            return connection_is_healthy(connection, self.users.get(role, 0) <= 1)
+
+    # Replace the broken connection of a role.
+    def reconnect(self, role, connection):
+        with self.lock:
+            current = self.connections.get(role)
+
+            # Already replaced for another wrapper of the role.
+            if current != None and current is not connection and current.closed == 0:
+                return current
+
+            return self.connect(role)
+
+    # Give back the connection of a role.
+    # The last user rolls back the pending transaction, the connection is
+    # kept open for the next user.
+    def release(self, role, connection):
+        with self.lock:
+            n = self.users.get(role, 0) - 1
+            self.users[role] = max(n, 0)
+
+            if n > 0 or self.connections.get(role) is not connection:
+                return
+
+            try:
+                if connection.closed == 0:
+                    connection.rollback()
+
+            except Error as ex:
+                print("Cannot release the connection:", ex)
+                self.connections.pop(role).close()
+
+    # Close all the connections.
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                if conn.closed == 0:
+                    conn.close()
+
+            self.connections = {}
+            self.users = {}
+
+        self.db_source = ""
+        self.connected_db_source = ""
+
+    #
+    # Internal members.
+    #
+
+    # Connection string as given, and with the credentials asked to the user.
+    db_source = ""
+    connected_db_source = ""
+
+    # Open a new connection for a role, closing the previous one.
+    # Called with the lock held.
+    def connect(self, role):
+        old = self.connections.pop(role, None)
+        if old != None and old.closed == 0:
+            old.close()
+
+        try:
+            conn = psycopg2.connect(self.connected_db_source)
+
+        except Error as ex:
+            print("Cannot connect to the database:", ex)
+            return None
+
+        self.connections[role] = conn
         return conn
@@ -0,0 +1,202 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from psycopg2 import sql
+
+from .audit_indexes import table_identifier
+
+# Bounded LRU cache of the event details (row_data and changed_fields).
+#
+# The event list query only fetches the narrow columns displayed in the
+# table. The hstores, that may contain large geometries, are fetched on
+# demand by event_id when an event is selected.
+#
+# When the main geometry column of the table of an event is known, this
+# geometry is removed from the hstores and transferred as WKB (bytea), with
+# its SRID in a separate column, instead of hex EWKB text.
+#
+# With a level of detail, the main geometry is simplified server-side with
+# a tolerance of about one pixel of the canvas it is displayed on, it can be
+# fetched again at a higher level of detail with loadGeometries().
+
+
+class DetailCache():
+
+    def __init__(self, connection_wrapper, audit_table, parse_function, max_size=1000):
+        """Constructor.
+        @param connection_wrapper connection wrapper (dbapi2)
+        @param audit_table the name of the audit table in the database
+        @param parse_function function converting a hstore value to a dict
+        @param max_size maximum number of events kept in the cache
+        """
+        self.connection_wrapper = connection_wrapper
+        self.audit_table = audit_table
+        self.parse_function = parse_function
+        self.max_size = max_size
+
+        # event_id => (row_data, changed_fields, geometries), least recently used first
+        # geometries is (old WKB, new WKB, SRID, simplification tolerance) or None if the geometry is still in the hstores
+        self.__cache = OrderedDict()
+
+    def __contains__(self, event_id):
+        return event_id in self.__cache
+
+    def __len__(self):
+        return len(self.__cache)
+
+    def get(self, event_id):
+        """Get the details of an event, fetching them if needed.
+        @returns (row_data, changed_fields, geometries)
+        """
+        if event_id not in self.__cache:
+            self.fetch([event_id])
+        details = self.__cache.get(event_id)
+        if details is None:
+            # unknown event
+            return {}, {}, None
+        self.__cache.move_to_end(event_id)
+        return details
+
+    def missing(self, event_ids):
+        return [e for e in event_ids if e not in self.__cache]
+
+    def fetch(self, event_ids, geometry_columns={}):
+        """Fetch the details of the events not already cached, in one query.
+        @param event_ids list of event ids
+        @param geometry_columns dict table_name => list of geometry columns, the first one is the "main" geometry column
+        """
+        for event_id, details in self.load(self.missing(event_ids), geometry_columns).items():
+            self.insert(event_id, details)
+
+    def load(self, event_ids, geometry_columns={}, simplify_factor=None):
+        """Query the details of events, without caching them.
+        Can be run in a QueryWorker thread.
+        @param event_ids list of event ids
+        @param geometry_columns dict table_name => list of geometry columns, the first one is the "main" geometry column
+        @param simplify_factor simplification tolerance of the main geometry, as a fraction of its size, None for full resolution
+        @returns dict event_id => (row_data, changed_fields, geometries)
+        """
+        if len(event_ids) == 0:
+            return {}
+
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            print("Cannot get cursor for database.")
+            return {}
+
+        # the transaction is ended so that no lock is kept on the audit table
+        try:
+            main_columns = [(t, c[0]) for t, c in geometry_columns.items() if len(c) > 0]
+            if len(main_columns) == 0:
+                q = sql.SQL("SELECT event_id, row_data, changed_fields, NULL, NULL, NULL, NULL, NULL FROM {} WHERE event_id = ANY(%s)").format(
+                    table_identifier(self.audit_table))
+                cur.execute(q, (list(event_ids),))
+            else:
+                # The main geometry is removed from the hstores and sent as WKB.
+                if simplify_factor is None:
+                    tolerance = "NULL::float8"
+                    params = []
+                else:
+                    # about one pixel of the geometry displayed on the canvas
+                    tolerance = "(SELECT greatest(ST_XMax(b) - ST_XMin(b), ST_YMax(b) - ST_YMin(b)) * %s " \
+                                "FROM box2d(coalesce(r.o, r.n)) AS b)"
+                    params = [simplify_factor]
+                q = sql.SQL("SELECT l.event_id, "
+                            "CASE WHEN g.col IS NULL THEN l.row_data ELSE l.row_data - g.col END, "
+                            "CASE WHEN g.col IS NULL THEN l.changed_fields ELSE l.changed_fields - g.col END, "
+                            "g.col, {} "
+                            "FROM {} l LEFT JOIN unnest(%s::text[], %s::text[]) AS g(tbl, col) "
+                            "ON l.schema_name || '.' || l.table_name = g.tbl "
+                            "LEFT JOIN LATERAL (SELECT (l.row_data->g.col)::geometry AS o, "
+                            "(l.changed_fields->g.col)::geometry AS n) AS r ON true "
+                            "LEFT JOIN LATERAL (SELECT {} AS t) AS s ON true "
+                            "WHERE l.event_id = ANY(%s)").format(
+                    sql.SQL(self.geometriesSelect()), table_identifier(self.audit_table), sql.SQL(tolerance))
+                cur.execute(q, [[t for t, c in main_columns],
+                                [c for t, c in main_columns]] + params + [list(event_ids)])
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+            self.connection_wrapper.rollback()
+
+        details = {}
+        for event_id, row_data, changed_fields, column, old_wkb, new_wkb, srid, tolerance in rows:
+            geometries = None
+            if column is not None:
+                geometries = (None if old_wkb is None else bytes(old_wkb),
+                              None if new_wkb is None else bytes(new_wkb),
+                              srid,
+                              tolerance)
+            details[event_id] = (self.parse_function(row_data),
+                                 self.parse_function(changed_fields),
+                                 geometries)
+        return details
+
+    def geometriesSelect(self):
+        """Select list of the main geometries, from the r(o, n) and s(t) relations."""
+        return "ST_AsBinary(CASE WHEN s.t IS NULL THEN r.o ELSE ST_SimplifyPreserveTopology(r.o, s.t) END), " \
+               "ST_AsBinary(CASE WHEN s.t IS NULL THEN r.n ELSE ST_SimplifyPreserveTopology(r.n, s.t) END), " \
+               "ST_SRID(coalesce(r.o, r.n)), s.t"
+
+    def loadGeometries(self, event_id, column, tolerance=None):
+        """Query the main geometries of an event at a given level of detail.
+        Can be run in a QueryWorker thread.
+        @param event_id event id
+        @param column main geometry column
+        @param tolerance simplification tolerance, in map units, None for full resolution
+        @returns (old WKB, new WKB, SRID, tolerance)
+        """
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            print("Cannot get cursor for database.")
+            return None
+
+        q = sql.SQL("SELECT {} FROM {} l, "
+                    "LATERAL (SELECT (l.row_data->%s)::geometry AS o, (l.changed_fields->%s)::geometry AS n) AS r, "
+                    "LATERAL (SELECT %s::float8 AS t) AS s "
+                    "WHERE l.event_id = %s").format(sql.SQL(self.geometriesSelect()), table_identifier(self.audit_table))
+        try:
+            cur.execute(q, (column, column, tolerance, event_id))
+            r = cur.fetchone()
+        finally:
+            cur.close()
+            self.connection_wrapper.rollback()
+        if r is None:
+            return None
+        old_wkb, new_wkb, srid, tolerance = r
+        return (None if old_wkb is None else bytes(old_wkb),
+                None if new_wkb is None else bytes(new_wkb),
+                srid,
+                tolerance)
+
+    def updateGeometries(self, event_id, geometries):
+        """Replace the cached main geometries of an event."""
+        details = self.__cache.get(event_id)
+        if details is not None:
+            self.__cache[event_id] = (details[0], details[1], geometries)
+
+    def insert(self, event_id, details):
+        self.__cache[event_id] = details
+        self.__cache.move_to_end(event_id)
+        while len(self.__cache) > self.max_size:
+            self.__cache.popitem(last=False)
+
+    def clear(self):
+        self.__cache.clear()
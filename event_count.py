@@ -0,0 +1,57 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import json
+
+from psycopg2 import sql
+
+from .search_query import execute_prepared
+
+# Number of events of a search.
+#
+# The exact count needs to read every matching row. The estimate is read
+# from the statistics of the audit table (pg_class.reltuples) when there is
+# no filter, and from the row estimate of the planner otherwise.
+
+
+def estimate_count(cursor, search):
+    """Estimated number of events of a search, without reading the events.
+    @param cursor a cursor
+    @param search SearchQuery
+    """
+    if search.isEmpty():
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                       (search.audit_table,))
+        r = cursor.fetchone()
+        # reltuples is -1 or 0 for a table never analyzed
+        if r is not None and r[0] > 0:
+            return r[0]
+
+    q, params = search.build("1")
+    cursor.execute(sql.SQL("EXPLAIN (FORMAT JSON) ") + q, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def exact_count(cursor, search):
+    """Exact number of events of a search."""
+    q, params = search.build("count(*)", numbered=True)
+    execute_prepared(cursor, q, params)
+    return cursor.fetchone()[0]
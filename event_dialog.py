@@ -16,11 +16,27 @@
  */
 """
 # -*- coding: utf-8 -*-
-import re
 import os
 from psycopg2 import Error
 
 from .error_dialog import ErrorDialog
+from .hstore import parse_hstore
+from .event_page import EventPage, EventPages, DATE_FORMAT, DATA_ROLES, cell_data
+from .keyset_pager import KeysetPager
+from .detail_cache import DetailCache
+from .query_worker import QueryWorker
+from .connection_wrapper import ROLE_STREAM, ROLE_DETAIL, ROLE_WRITE
+from .audit_indexes import data_index_kind
+from .search_query import SearchQuery, EVENT_COLUMNS, execute_prepared
+from .column_values import QUICK_FILTERS, distinct_values
+from .event_count import estimate_count, exact_count
+from .table_metadata import MetadataCache, TableInfo, query_tables
+from .event_replay import (replay_statement, replay_batch_statement, check_replay_statement,
+                           transaction_event_ids, REPLAY_BATCH_SIZE)
+from .live_tail import LiveTail, has_notify_trigger
+from .event_tail import EventTail, TAIL_COLUMNS, current_snapshot
+from .transaction_groups import fetch_transactions, fetch_transaction_events
+from .spatial_filter import PolygonMapTool, to_table_crs
 
 from PyQt5 import QtGui, uic
 from PyQt5.QtCore import *
@@ -32,7 +48,9 @@ from PyQt5.QtWidgets import (QDialog,
                              QTableWidgetItem,
                              QSpacerItem,
                              QSizePolicy,
-                             QHeaderView)
+                             QHeaderView,
+                             QAbstractItemView,
+                             QFileDialog)
 
 from qgis.core import QgsGeometry, QgsDataSourceUri, QgsProject, QgsMapLayer
 from qgis.gui import QgsRubberBand, QgsMapCanvas
@@ -41,16 +59,6 @@ FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'event_dialog.ui'))
 
 
-# Convert a string representing a hstore from psycopg2 to a Python dict
-kv_re = re.compile('"(\w+)"=>(NULL|""|".*?[^\\\\]")(?:, |$)')
-
-
-def parse_hstore(hstore_str):
-    if hstore_str is None:
-        return {}
-    return dict([(m.group(1), None if m.group(2) == 'NULL' else m.group(2).replace('\\"', '"')[1:-1]) for m in re.finditer(kv_re, hstore_str)])
-
-
 def ewkb_to_geom(ewkb_str):
     if ewkb_str is None:
         return QgsGeometry()
@@ -68,66 +76,363 @@ def ewkb_to_geom(ewkb_str):
     return g
 
 
+# Formats the events of a search can be exported to, see event_export: (name, file extension)
+EXPORT_FORMATS = [("GeoPackage", "gpkg"),
+                  ("CSV", "csv"),
+                  ("GeoJSON lines", "geojsonl")]
+
+# Number of events before and after the selected one whose details are prefetched.
+DETAIL_PREFETCH_RADIUS = 5
+
+# Level of detail: minimum canvas size, in pixels, used to compute the
+# simplification tolerance, and delay before fetching more details after a
+# zoom on the inner canvas, in milliseconds.
+LOD_MIN_PIXELS = 256
+LOD_REFINE_DELAY = 300
+
+
+def wkb_to_geom(wkb):
+    """Geometry from WKB bytes, as transferred by the DetailCache."""
+    g = QgsGeometry()
+    if wkb is not None:
+        g.fromWkb(wkb)
+    return g
+
+
 def reset_table_widget(table_widget):
     table_widget.clearContents()
     for r in range(table_widget.rowCount() - 1, -1, -1):
         table_widget.removeRow(r)
 
+
+# Sort key of each column of the event list, see SearchQuery.sortBy().
+SORT_COLUMNS = ["date", "table", "action", "application", "user"]
+
 # Incremental loader
+# Rows are read by batches of page_size rows from a server-side (named) cursor
+# or from a KeysetPager, the model grows through canFetchMore() / fetchMore()
+# when the view needs it.
+# Batches are fetched in the background by a QueryWorker and inserted in the
+# model as they arrive.
+# When an estimated number of rows is given, the model is sized from it until
+# all the rows are fetched, rows that are not loaded yet are fetched when they
+# are displayed.
+# At most max_rows rows are kept in memory: with a KeysetPager, the least
+# recently displayed pages are dropped, and fetched again from their keys
+# when they are displayed again. Pages of events inserted on top by
+# prependRows() count against the same ceiling, they are fetched again by id
+# (see EventPages).
 
 
 class EventModel(QAbstractTableModel):
-    def __init__(self, cursor):
+    # Emitted with the error message when a batch cannot be fetched.
+    fetchFailed = pyqtSignal(str)
+
+    def __init__(self, cursor, worker, detail_cache, page_size=1000, max_rows=100000):
         QAbstractItemModel.__init__(self)
         self.cursor = cursor
-        self.__data = []
-        self.page_size = 100
+        self.worker = worker
+        self.detail_cache = detail_cache
+        self.page_size = page_size
+        # pages can only be dropped if they can be fetched again
+        self.max_rows = max(3 * page_size, max_rows) if hasattr(cursor, "page") else None
+        # pages in memory, and pages inserted on top
+        self.__pages = EventPages(page_size, self.max_rows)
+        # number of rows fetched from the cursor, kept in memory or not
+        self.__fetched = 0
+        # pages being fetched again
+        self.__refetching = set()
+        # highest event id
+        self.__newest = None
+        self.__exhausted = False
+        # a batch is being fetched
+        self.__fetching = False
+        # incremented on each reset, to drop the batches of a previous position
+        self.__generation = 0
+        # estimated number of rows, 0 if unknown
+        self.__estimate = 0
+        # last row displayed while not loaded
+        self.__requested_row = -1
+        # ids of the events replayed from the dialog
+        self.__replayed = set()
+        self.replayed_font = QFont()
+        self.replayed_font.setItalic(True)
+        # date the list has been moved to by seek(), None for the most recent events
+        self.__seek_date = None
 
     def flags(self, idx):
         return Qt.NoItemFlags | Qt.ItemIsSelectable | Qt.ItemIsEnabled
 
-    def data(self, idx, role=Qt.DisplayRole):
-        # print idx.column(), role
-        if idx.row() >= len(self.__data):
-            rc = len(self.__data)
-            # fetch more
-            remaining = idx.row() - rc + 1
-            for row in self.cursor.fetchmany(remaining):
-                self.__data.append(row)
-
-        row = self.__data[idx.row()]
-        event_id, tstamp, table_name, action, application, user, row_data, changed_fields = row
-        if idx.column() == 0:
-            if role == Qt.DisplayRole:
-                return tstamp.strftime("%x - %X")
-            elif role == Qt.UserRole:
-                return event_id
-        elif idx.column() == 1:
-            if role == Qt.DisplayRole:
-                return table_name
-        elif idx.column() == 2:
-            if role == Qt.DisplayRole:
-                if action == 'I':
-                    return "Insertion"
-                elif action == 'D':
-                    return "Delete"
-                elif action == 'U':
-                    return "Update"
-            elif role == Qt.UserRole:
-                return action
-        elif idx.column() == 3:
-            if role == Qt.DisplayRole:
-                return application
-        elif idx.column() == 4:
-            if role == Qt.DisplayRole:
-                return user
-        return None
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return not self.__exhausted
 
-    def row_data(self, row):
-        return parse_hstore(self.__data[row][6])
+    def fetchMore(self, parent):
+        if parent.isValid() or self.__exhausted or self.__fetching:
+            return
+        self.__fetching = True
+        cursor = self.cursor
+        page_size = self.page_size
+        generation = self.__generation
+        self.worker.submit(lambda: cursor.fetchmany(page_size),
+                           lambda rows: self.onRowsFetched(generation, rows),
+                           lambda error: self.onFetchFailed(generation, error))
+
+    def isFetching(self):
+        return self.__fetching
+
+    def onRowsFetched(self, generation, rows):
+        if generation != self.__generation:
+            return
+        self.__fetching = False
+        exhausted = len(rows) < self.page_size
+        self.appendRows(rows, exhausted)
+        if exhausted:
+            # end of the result set, release the server-side cursor
+            self.close()
+        elif self.__requested_row >= self.loadedRowCount():
+            # keep on loading up to the displayed rows
+            self.fetchMore(QModelIndex())
+
+    def onFetchFailed(self, generation, error):
+        if generation != self.__generation:
+            return
+        # canceled or failed: stop loading
+        self.__fetching = False
+        self.appendRows([], True)
+        if error is not None:
+            self.fetchFailed.emit(error)
+
+    def appendRows(self, rows, exhausted):
+        """Append fetched rows, and resize the model accordingly.
+        @param rows fetched rows, a page of page_size rows unless exhausted
+        @param exhausted whether all the rows have been fetched
+        """
+        parent = QModelIndex()
+        rc = self.loadedRowCount()
+        old_count = self.rowCount(parent)
+        new_len = rc + len(rows)
+        new_count = new_len if exhausted else max(new_len, self.__estimate)
+
+        if new_count > old_count:
+            self.beginInsertRows(parent, old_count, new_count - 1)
+        elif new_count < old_count:
+            self.beginRemoveRows(parent, new_count, old_count - 1)
+        if len(rows) > 0:
+            self.__pages.store(self.__fetched // self.page_size, EventPage(rows))
+            self.__fetched += len(rows)
+            newest = max([r[0] for r in rows])
+            self.__newest = newest if self.__newest is None else max(self.__newest, newest)
+        self.__exhausted = exhausted
+        if new_count > old_count:
+            self.endInsertRows()
+        elif new_count < old_count:
+            self.endRemoveRows()
+
+        # rows that were displayed before being loaded
+        last = min(new_len, old_count) - 1
+        if last >= rc:
+            self.dataChanged.emit(self.index(rc, 0),
+                                  self.index(last, self.columnCount(parent) - 1))
+
+    def setEstimatedRowCount(self, estimate):
+        """Size the model from an estimated number of rows, until all rows are fetched.
+        @param estimate estimated number of rows, 0 to size the model from the fetched rows only
+        """
+        parent = QModelIndex()
+        old_count = self.rowCount(parent)
+        new_count = old_count if self.__exhausted else max(
+            self.loadedRowCount(), estimate)
+        if new_count > old_count:
+            self.beginInsertRows(parent, old_count, new_count - 1)
+        elif new_count < old_count:
+            self.beginRemoveRows(parent, new_count, old_count - 1)
+        self.__estimate = estimate
+        if new_count > old_count:
+            self.endInsertRows()
+        elif new_count < old_count:
+            self.endRemoveRows()
+
+    def loadedRowCount(self):
+        """Number of rows fetched so far, whether they are still in memory or not."""
+        return self.__pages.headCount() + self.__fetched
+
+    def locate(self, row):
+        """Page and index in the page of a row.
+        @returns (EventPage, index) or None if the row is not in memory
+        """
+        return self.__pages.locate(row)
 
-    def changed_fields(self, row):
-        return parse_hstore(self.__data[row][7])
+    def isRowLoaded(self, row):
+        return row >= 0 and self.locate(row) is not None
+
+    def requestRow(self, row):
+        """Fetch a row displayed while not in memory."""
+        if row < self.loadedRowCount():
+            # dropped page
+            self.refetchPage(self.__pages.pageKey(row))
+            return
+        self.__requested_row = max(self.__requested_row, row)
+        self.fetchMore(QModelIndex())
+
+    def refetchPage(self, page_number):
+        if page_number in self.__refetching or self.max_rows is None:
+            return
+        self.__refetching.add(page_number)
+        cursor = self.cursor
+        generation = self.__generation
+        if page_number < 0:
+            event_ids = list(self.__pages.headIds(page_number))
+            self.worker.submit(lambda: cursor.events(event_ids),
+                               lambda rows: self.onPageRefetched(generation, page_number, rows),
+                               lambda error: self.onRefetchFailed(generation, page_number, error))
+            return
+        self.worker.submit(lambda: cursor.page(page_number),
+                           lambda rows: self.onPageRefetched(generation, page_number, rows),
+                           lambda error: self.onRefetchFailed(generation, page_number, error))
+
+    def onPageRefetched(self, generation, page_number, rows):
+        if generation != self.__generation:
+            return
+        self.__refetching.discard(page_number)
+        if len(rows) == 0:
+            return
+        self.__pages.store(page_number, EventPage(rows))
+        first = self.__pages.firstRow(page_number)
+        self.dataChanged.emit(self.index(first, 0),
+                              self.index(first + len(rows) - 1, self.columnCount(QModelIndex()) - 1))
+
+    def onRefetchFailed(self, generation, page_number, error):
+        if generation != self.__generation:
+            return
+        self.__refetching.discard(page_number)
+        if error is not None:
+            self.fetchFailed.emit(error)
+
+    def newestEventId(self):
+        """Highest event id of the fetched rows, None if no row is fetched."""
+        return self.__newest
+
+    def seekDate(self):
+        """Date the list has been moved to, None if it starts from the most recent events."""
+        return self.__seek_date
+
+    def hasEvent(self, event_id):
+        """Whether an event is in the rows kept in memory."""
+        if self.__newest is None or event_id > self.__newest:
+            return False
+        return self.__pages.hasEvent(event_id)
+
+    def prependRows(self, rows):
+        """Insert events newer than the loaded ones at the top.
+        The loaded rows are kept, and the view keeps its selection.
+        @param rows fetched rows, most recent first
+        """
+        if len(rows) == 0:
+            return
+        n = len(rows)
+        self.beginInsertRows(QModelIndex(), 0, n - 1)
+        self.__pages.prepend(EventPage(rows))
+        newest = max([r[0] for r in rows])
+        self.__newest = newest if self.__newest is None else max(self.__newest, newest)
+        if self.__estimate > 0:
+            self.__estimate += n
+        if self.__requested_row >= 0:
+            self.__requested_row += n
+        self.endInsertRows()
+
+    def isExhausted(self):
+        return self.__exhausted
+
+    def seek(self, tstamp):
+        """Restart the list from the most recent event at or before a date.
+        Only available for a KeysetPager source.
+        """
+        self.beginResetModel()
+        self.__pages = EventPages(self.page_size, self.max_rows)
+        self.__fetched = 0
+        self.__refetching = set()
+        self.__newest = None
+        self.__exhausted = False
+        self.__fetching = False
+        self.__generation += 1
+        self.__estimate = 0
+        self.__requested_row = -1
+        self.__seek_date = tstamp
+        cursor = self.cursor
+        self.worker.submit(lambda: cursor.seek(tstamp))
+        self.endResetModel()
+
+    def close(self):
+        cursor = self.cursor
+
+        def close_cursor():
+            if not cursor.closed:
+                try:
+                    cursor.close()
+                except Error:
+                    # the cursor may already have been closed by a commit
+                    pass
+        self.worker.submit(close_cursor)
+
+    def data(self, idx, role=Qt.DisplayRole):
+        # called for each cell and role on every repaint: only lookups here,
+        # the display strings are computed once per page by EventPage, see
+        # tests/bench_event_page.py
+        if role not in DATA_ROLES:
+            return None
+        located = self.__pages.locate(idx.row())
+        if located is None:
+            # displayed before being loaded, or dropped
+            self.requestRow(idx.row())
+            return None
+        page, i = located
+        return cell_data(page, i, idx.column(), role, self.__replayed, self.replayed_font)
+
+    def loadedRows(self):
+        """Iterate over the rows in memory.
+        @returns iterator of (row, EventPage, index in the page)
+        """
+        for page_number, page in self.__pages.items():
+            first = self.__pages.firstRow(page_number)
+            for i in range(len(page)):
+                yield first + i, page, i
+
+    def setReplayed(self, event_ids):
+        """Mark events as replayed, and refresh their rows."""
+        event_ids = set(event_ids)
+        self.__replayed |= event_ids
+        for row, page, i in self.loadedRows():
+            if page.ids[i] in event_ids:
+                self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount(QModelIndex()) - 1))
+
+    def eventId(self, row):
+        """Event id of a row, None if the row is not in memory."""
+        located = self.locate(row)
+        if located is None:
+            return None
+        page, i = located
+        return page.ids[i]
+
+    def neighbourRows(self, row, radius):
+        first = max(0, row - radius)
+        last = min(self.loadedRowCount(), row + radius + 1)
+        for r in range(first, last):
+            located = self.locate(r)
+            if located is not None:
+                yield located
+
+    def neighbourIds(self, row, radius):
+        """Event ids of a row and of its neighbours that are in memory.
+        @param row current row
+        @param radius number of rows before and after the current row
+        """
+        return [page.ids[i] for page, i in self.neighbourRows(row, radius)]
+
+    def neighbourTables(self, row, radius):
+        """Table names of a row and of its neighbours."""
+        return set([page.tables[i] for page, i in self.neighbourRows(row, radius)])
 
     def headerData(self, section, orientation, role):
         if role == Qt.DisplayRole and orientation == Qt.Horizontal:
@@ -135,12 +440,255 @@ class EventModel(QAbstractTableModel):
         return QAbstractTableModel.headerData(self, section, orientation, role)
 
     def rowCount(self, parent):
-        return self.cursor.rowcount
+        if parent.isValid():
+            return 0
+        if self.__exhausted:
+            return self.loadedRowCount()
+        return max(self.loadedRowCount(), self.__estimate)
 
     def columnCount(self, parent):
         return 5
 
 
+# Events grouped by transaction
+# The transactions of a search are aggregated by the database and fetched by
+# pages as the view needs them, like the rows of an EventModel. The events
+# of a transaction are only fetched when it is expanded, by pages too.
+# Top level indexes have no internal pointer, the indexes of the events have
+# their TransactionNode.
+
+
+class TransactionNode():
+    __slots__ = ("row", "key", "count", "last_event_id", "display",
+                 "pages", "loaded", "exhausted", "fetching")
+
+    def __init__(self, row, r):
+        """@param row row of the transaction in the model
+        @param r fetched row, see transaction_groups.TRANSACTION_COLUMNS
+        """
+        tstamp_tx, transaction_id, count, first, last, tables, applications, users, last_event_id = r
+        self.row = row
+        self.key = (tstamp_tx, transaction_id)
+        self.count = count
+        self.last_event_id = last_event_id
+        date = first.strftime(DATE_FORMAT)
+        if last != first:
+            date += " to " + last.strftime(DATE_FORMAT)
+        self.display = [date, tables, "{} event{}".format(count, "s" if count > 1 else ""),
+                        applications, users]
+        # EventPages of the events fetched so far
+        self.pages = []
+        self.loaded = 0
+        self.exhausted = False
+        self.fetching = False
+
+
+class TransactionModel(QAbstractItemModel):
+    # Emitted with the error message when a page cannot be fetched.
+    fetchFailed = pyqtSignal(str)
+
+    def __init__(self, worker, search, page_size=1000):
+        """Constructor.
+        @param worker QueryWorker the pages are fetched by
+        @param search SearchQuery with the filters of the events
+        @param page_size number of transactions or events fetched at once
+        """
+        QAbstractItemModel.__init__(self)
+        self.worker = worker
+        self.search = search
+        self.page_size = page_size
+        self.__transactions = []
+        self.__exhausted = False
+        self.__fetching = False
+
+    def query(self, fetch):
+        """Job running fetch(cursor) in the worker thread, without keeping a transaction open."""
+        connection_wrapper = self.worker.connection_wrapper
+
+        def run():
+            cur = connection_wrapper.cursor()
+            try:
+                return fetch(cur)
+            finally:
+                cur.close()
+                connection_wrapper.rollback()
+        return run
+
+    def node(self, idx):
+        """TransactionNode of a transaction index, None for an event index."""
+        if not idx.isValid() or idx.internalPointer() is not None:
+            return None
+        return self.__transactions[idx.row()]
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, None)
+        return self.createIndex(row, column, self.__transactions[parent.row()])
+
+    def parent(self, idx=None):
+        if idx is None:
+            return QObject.parent(self)
+        node = idx.internalPointer() if idx.isValid() else None
+        if node is None:
+            return QModelIndex()
+        return self.createIndex(node.row, 0, None)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return True
+        node = self.node(parent)
+        return node is not None and node.count > 0
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.__transactions)
+        node = self.node(parent)
+        return 0 if node is None else node.loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        return 5
+
+    def flags(self, idx):
+        return Qt.NoItemFlags | Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+    def headerData(self, section, orientation, role):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return ("Date", "Table", "Action", "Application", "User")[section]
+        return QAbstractItemModel.headerData(self, section, orientation, role)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return not self.__exhausted
+        node = self.node(parent)
+        return node is not None and not node.exhausted
+
+    def fetchMore(self, parent):
+        if not parent.isValid():
+            self.fetchTransactions()
+            return
+        node = self.node(parent)
+        if node is not None:
+            self.fetchEvents(node)
+
+    def fetchTransactions(self):
+        if self.__exhausted or self.__fetching:
+            return
+        self.__fetching = True
+        search = self.search
+        page_size = self.page_size
+        last_key = self.__transactions[-1].key if len(self.__transactions) > 0 else None
+        self.worker.submit(self.query(lambda cur: fetch_transactions(cur, search, last_key, page_size)),
+                           self.onTransactionsFetched, self.onFetchFailed)
+
+    def onTransactionsFetched(self, rows):
+        self.__fetching = False
+        self.__exhausted = len(rows) < self.page_size
+        if len(rows) == 0:
+            return
+        first = len(self.__transactions)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.__transactions += [TransactionNode(first + i, r) for i, r in enumerate(rows)]
+        self.endInsertRows()
+
+    def onFetchFailed(self, error):
+        # canceled or failed: stop loading
+        self.__fetching = False
+        self.__exhausted = True
+        if error is not None:
+            self.fetchFailed.emit(error)
+
+    def fetchEvents(self, node):
+        if node.exhausted or node.fetching:
+            return
+        node.fetching = True
+        search = self.search
+        page_size = self.page_size
+        key = node.key
+        last_event_id = node.pages[-1].ids[-1] if node.loaded > 0 else None
+        self.worker.submit(self.query(lambda cur: fetch_transaction_events(
+            cur, search, EVENT_COLUMNS, key, last_event_id, page_size)),
+            lambda rows: self.onEventsFetched(node, rows),
+            lambda error: self.onEventsFailed(node, error))
+
+    def onEventsFetched(self, node, rows):
+        node.fetching = False
+        node.exhausted = len(rows) < self.page_size
+        if len(rows) == 0:
+            return
+        self.beginInsertRows(self.createIndex(node.row, 0, None), node.loaded, node.loaded + len(rows) - 1)
+        node.pages.append(EventPage(rows))
+        node.loaded += len(rows)
+        self.endInsertRows()
+
+    def onEventsFailed(self, node, error):
+        node.fetching = False
+        node.exhausted = True
+        if error is not None:
+            self.fetchFailed.emit(error)
+
+    def isExhausted(self):
+        return self.__exhausted
+
+    def transactionCount(self):
+        """Number of transactions fetched so far."""
+        return len(self.__transactions)
+
+    def locate(self, idx):
+        """Page and index in the page of an event index.
+        @returns (EventPage, index) or None for a transaction index
+        """
+        node = idx.internalPointer() if idx.isValid() else None
+        if node is None or idx.row() >= node.loaded:
+            return None
+        page_number, i = divmod(idx.row(), self.page_size)
+        return node.pages[page_number], i
+
+    def data(self, idx, role=Qt.DisplayRole):
+        if role not in DATA_ROLES or not idx.isValid():
+            return None
+        located = self.locate(idx)
+        if located is None:
+            node = self.node(idx)
+            if role == Qt.DisplayRole:
+                return node.display[idx.column()]
+            elif role == Qt.ToolTipRole:
+                return "Transaction {}".format(node.key[1])
+            return None
+
+        page, i = located
+        return cell_data(page, i, idx.column(), role)
+
+    def event(self, idx):
+        """(event_id, table_name, action) of an event index, None for a transaction index."""
+        located = self.locate(idx)
+        if located is None:
+            return None
+        page, i = located
+        return page.ids[i], page.tables[i], page.action(i)
+
+    def eventId(self, idx):
+        """Id of the event of an index, or of the last event of a transaction."""
+        located = self.locate(idx)
+        if located is None:
+            node = self.node(idx)
+            return None if node is None else node.last_event_id
+        page, i = located
+        return page.ids[i]
+
+    def neighbourEvents(self, idx, radius):
+        """(event_id, table_name) of an event and of the events around it in its transaction."""
+        node = idx.internalPointer() if idx.isValid() else None
+        if node is None:
+            return []
+        events = []
+        for r in range(max(0, idx.row() - radius), min(node.loaded, idx.row() + radius + 1)):
+            page, i = divmod(r, self.page_size)
+            events.append((node.pages[page].ids[i], node.pages[page].tables[i]))
+        return events
+
+
 class GeometryDisplayer:
 
     def __init__(self, canvas):
@@ -168,10 +716,11 @@ class GeometryDisplayer:
     def newGeometryColor(self):
         return QColor("#00f")
 
-    def display(self, geom1, geom2=None):
+    def display(self, geom1, geom2=None, zoom=True):
         """
         @param geom1 base geometry (old geometry for an update)
         @param geom2 new geometry for an update
+        @param zoom whether the canvas is zoomed on the geometries
         """
         if geom2 is None:
             bbox = geom1.boundingBox()
@@ -181,12 +730,29 @@ class GeometryDisplayer:
             bbox.combineExtentWith(geom2.boundingBox())
             self.rubber1.setToGeometry(geom2, None)
             self.rubber2.setToGeometry(geom1, None)
+        if not zoom:
+            return
         bbox.scale(1.5)
         self.canvas.setExtent(bbox)
 
 
 class EventDialog(QDialog, FORM_CLASS):
 
+    # Emitted with the layer id and the feature id to show the timeline of a feature.
+    timelineRequested = pyqtSignal(str, str)
+
+    # Emitted with the layer id and a datetime to load the state of a layer at this date.
+    timeTravelRequested = pyqtSignal(str, object)
+
+    # Emitted with the SearchQuery of the list to show the geometries of all its events.
+    showOnMapRequested = pyqtSignal(object)
+
+    # Emitted with the SearchQuery of the current search and the file name to export its events to.
+    exportRequested = pyqtSignal(object, str)
+
+    # Internal: emitted from the replay thread with the number of replayed events and the total.
+    replayProgress = pyqtSignal(int, int)
+
     # Editable layer to alter edition mode (transaction group).
     editableLayerObject = None
 
@@ -198,7 +764,7 @@ class EventDialog(QDialog, FORM_CLASS):
     #
     catchLayerModifications = True
 
-    def __init__(self, parent, connection_wrapper_read, connection_wrapper_write, map_canvas, audit_table, replay_function=None, table_map={}, selected_layer_id=None, selected_feature_id=None):
+    def __init__(self, parent, connection_wrapper_read, connection_wrapper_write, map_canvas, audit_table, replay_function=None, table_map={}, selected_layer_id=None, selected_feature_id=None, fetch_size=1000, pagination="keyset", detail_cache_size=1000, estimate_count=False, level_of_detail=False, metadata=None, connection_pool=None, max_events=100000):
         """Constructor.
         @param parent parent widget
         @param connection_wrapper_read connection wrapper (dbapi2)
@@ -209,6 +775,14 @@ class EventDialog(QDialog, FORM_CLASS):
         @param table_map a dict that associates database table name to a QGIS layer id layer_id : table_name
         @param selected_layer_id selected layer
         @param selected_feature_id selected feature_id
+        @param fetch_size number of events transferred at once from the database
+        @param pagination "keyset" to fetch events by keyset pages, "cursor" to stream them from a server-side cursor
+        @param detail_cache_size maximum number of event details kept in memory
+        @param estimate_count whether the event list is sized from the estimated number of events
+        @param level_of_detail whether geometries are simplified for display, and refined when zooming in
+        @param metadata MetadataCache shared by the dialogs, None to use a cache of this dialog
+        @param connection_pool ConnectionPool the background connections are taken from, None to open new connections
+        @param max_events maximum number of listed events kept in memory, with keyset pagination
         """
         super(EventDialog, self).__init__(parent)
         # Set up the user interface from Designer.
@@ -223,6 +797,24 @@ class EventDialog(QDialog, FORM_CLASS):
             QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'mActionFilter2.svg')))
         self.replayButton.setIcon(
             QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'mIconWarn.png')))
+        self.replayTransactionButton.setIcon(
+            QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'mIconWarn.png')))
+
+        # LiveTail of the audit table when following the new events
+        self.live_tail = None
+        # whether new events are being fetched, and whether other ones have been recorded since
+        self.refreshing_new_events = False
+        self.refresh_pending = False
+        # EventTail of the event list
+        self.tail = None
+
+        # whether events are being replayed, and message about the last replay
+        self.replaying = False
+        self.replay_message = None
+        # QueryWorker of the replays on a direct connection, created by the first one
+        self.replay_worker = None
+        # state shared with the running replay job
+        self.replay_state = None
 
         # Store connections.
         self.connection_wrapper_read = connection_wrapper_read
@@ -231,6 +823,54 @@ class EventDialog(QDialog, FORM_CLASS):
         self.map_canvas = map_canvas
         self.audit_table = audit_table
         self.replay_function = replay_function
+        self.fetch_size = fetch_size
+        self.max_events = max_events
+        self.pagination = pagination
+        self.estimate_count = estimate_count
+        self.level_of_detail = level_of_detail
+
+        # Simplified geometries on display: (event_id, main geometry column, tolerance)
+        self.displayed_lod = None
+
+        # Filters, estimated and exact number of events of the current search.
+        self.search = SearchQuery(self.audit_table)
+        self.estimated_count = None
+        self.exact_count = None
+
+        # Current model and its server-side cursor number.
+        self.eventModel = None
+        self.cursor_serial = 0
+        # TransactionModel when the events are grouped by transaction
+        self.transactionModel = None
+
+        # Queries are run in the background, on dedicated connections: the
+        # event list on one, the event details, metadata and replays on the
+        # other, so that a slow list fetch does not delay the selection.
+        db_connection = self.connection_wrapper_read.connectionString()
+        self.worker = QueryWorker(db_connection, connection_pool, ROLE_STREAM)
+        self.worker.busyChanged.connect(self.onWorkerBusyChanged)
+        self.detail_worker = QueryWorker(db_connection, connection_pool, ROLE_DETAIL)
+        self.detail_worker.busyChanged.connect(self.onWorkerBusyChanged)
+        self.connection_pool = connection_pool
+
+        # row_data and changed_fields of the recently selected events.
+        self.detail_cache = DetailCache(
+            self.detail_worker.connection_wrapper, self.audit_table, parse_hstore, detail_cache_size)
+
+        # Index usable by the data filter, looked up once before any
+        # background query is run.
+        self.data_index_kind = None
+        cur = self.detail_worker.connection_wrapper.cursor()
+        if cur != None:
+            self.data_index_kind = data_index_kind(cur, self.audit_table)
+            cur.close()
+            self.detail_worker.connection_wrapper.rollback()
+
+        # Geometry columns and other metadata of the audited tables.
+        self.metadata = metadata
+        if self.metadata is None:
+            self.metadata = MetadataCache()
+            self.metadata.load(self.detail_worker.connection_wrapper)
 
         # Watch for layer added or removed for replay button state update.
         QgsProject.instance().layersRemoved.connect(self.updateReplayButtonState)
@@ -239,9 +879,6 @@ class EventDialog(QDialog, FORM_CLASS):
         # Register all current layers.
         self.updateReplayButtonState()
 
-        # geometry columns : table_name => list of geometry columns, the first one is the "main" geometry column
-        self.geometry_columns = {}
-
         self.table_map = table_map
 
         # populate layer combo
@@ -256,12 +893,17 @@ class EventDialog(QDialog, FORM_CLASS):
             self.layerCombo.addItem(l.name(), layer_id)
         if layer_idx is not None:
             self.layerCombo.setCurrentIndex(layer_idx)
+            self.travelDt.setEnabled(True)
+            self.timeTravelButton.setEnabled(True)
+            self.spatialChck.setEnabled(True)
 
         if selected_feature_id is not None:
             self.idEdit.setEnabled(True)
             self.idEdit.setText(str(selected_feature_id))
 
         self.dataTable.hide()
+        self.transactionTree.hide()
+        self.groupChck.toggled.connect(self.onGroupToggled)
 
         #
         # inner canvas
@@ -284,6 +926,14 @@ class EventDialog(QDialog, FORM_CLASS):
         self.displayer = GeometryDisplayer(self.map_canvas)
         self.inner_displayer = GeometryDisplayer(self.inner_canvas)
 
+        # fetch more details of simplified geometries when zooming in
+        self.lod_timer = QTimer(self)
+        self.lod_timer.setSingleShot(True)
+        self.lod_timer.setInterval(LOD_REFINE_DELAY)
+        self.lod_timer.timeout.connect(self.onInnerCanvasZoomed)
+        if self.level_of_detail:
+            self.inner_canvas.extentsChanged.connect(self.lod_timer.start)
+
         self.afterDt.setDateTime(QDateTime.currentDateTime())
         self.beforeDt.setDateTime(QDateTime.currentDateTime())
 
@@ -314,47 +964,298 @@ class EventDialog(QDialog, FORM_CLASS):
         # refresh results when the search button is clicked
         self.searchButton.clicked.connect(self.populate)
 
+        # background query progress
+        self.progressBar.setRange(0, 0)
+        self.progressBar.hide()
+        self.cancelButton.hide()
+        self.cancelButton.clicked.connect(self.onCancel)
+        self.countButton.clicked.connect(self.onCount)
+        self.showOnMapButton.clicked.connect(self.onShowOnMap)
+        self.exportButton.clicked.connect(self.onExport)
+        self.followChk.toggled.connect(self.onFollowToggled)
+
+        # spatial filter, on the map extent or on a polygon drawn on the map
+        self.spatial_polygon = None
+        self.previous_map_tool = None
+        self.polygon_tool = PolygonMapTool(self.map_canvas)
+        self.polygon_tool.polygonDrawn.connect(self.onPolygonDrawn)
+        self.spatialChck.toggled.connect(self.updateSpatialFilterWidgets)
+        self.spatialCombo.currentIndexChanged.connect(self.updateSpatialFilterWidgets)
+        self.drawButton.clicked.connect(self.onDrawPolygon)
+
+        # jump to a date, only for keyset pagination
+        self.gotoDt.setDateTime(QDateTime.currentDateTime())
+        self.gotoButton.clicked.connect(self.onGotoDate)
+
+        # sort by a column, in the database: the list is searched again
+        self.sort_key = "date"
+        self.sort_descending = True
+        header = self.eventTable.horizontalHeader()
+        header.setSectionsClickable(True)
+        header.setSortIndicatorShown(True)
+        header.setSortIndicator(0, Qt.DescendingOrder)
+        header.sortIndicatorChanged.connect(self.onSortChanged)
+        self.updateGotoWidgets()
+
+        # quick filters, with the values suggested by the statistics of the audit table
+        self.filter_combos = {"table": self.tableFilterCombo,
+                              "application": self.applicationFilterCombo,
+                              "user": self.userFilterCombo}
+        self.loadFilterValues()
+
         # update the feature id line edit visiblity based on the current layer selection
         self.layerCombo.currentIndexChanged.connect(self.onCurrentLayerChanged)
 
+        # timeline of the feature
+        self.idEdit.textChanged.connect(self.updateTimelineButton)
+        self.timelineButton.clicked.connect(self.onTimeline)
+        self.updateTimelineButton()
+
+        # state of the layer at a date
+        self.travelDt.setDateTime(QDateTime.currentDateTime())
+        self.timeTravelButton.clicked.connect(self.onTimeTravel)
+
         # replay button
         if self.replay_function:
             self.replayButton.clicked.connect(self.onReplayEvent)
+            self.replayTransactionButton.clicked.connect(self.onReplayTransaction)
 
     def onCurrentLayerChanged(self, index):
         self.idEdit.setEnabled(index > 0)
+        self.travelDt.setEnabled(index > 0)
+        self.timeTravelButton.setEnabled(index > 0)
+        self.spatialChck.setEnabled(index > 0)
+        if index <= 0:
+            self.spatialChck.setChecked(False)
+        self.updateTimelineButton()
+
+    def updateSpatialFilterWidgets(self, unused=None):
+        checked = self.spatialChck.isChecked()
+        self.spatialCombo.setEnabled(checked)
+        self.drawButton.setEnabled(checked and self.spatialCombo.currentIndex() == 1)
+        # the polygon is shown while it filters the events
+        if not checked or self.spatialCombo.currentIndex() != 1:
+            self.polygon_tool.clear()
+            self.spatial_polygon = None
+
+    def onDrawPolygon(self):
+        if self.map_canvas.mapTool() is not self.polygon_tool:
+            self.previous_map_tool = self.map_canvas.mapTool()
+        self.map_canvas.setMapTool(self.polygon_tool)
+
+    def onPolygonDrawn(self, polygon):
+        self.spatial_polygon = polygon
+        if self.previous_map_tool is not None:
+            self.map_canvas.setMapTool(self.previous_map_tool)
+        else:
+            self.map_canvas.unsetMapTool(self.polygon_tool)
+
+    def spatialFilterArea(self):
+        """Area of the spatial filter, in the map canvas CRS, None if no polygon has been drawn."""
+        if self.spatialCombo.currentIndex() == 0:
+            return QgsGeometry.fromRect(self.map_canvas.extent())
+        return self.spatial_polygon
+
+    def updateTimelineButton(self):
+        self.timelineButton.setEnabled(
+            self.layerCombo.currentIndex() > 0 and len(self.idEdit.text()) > 0)
+
+    def onTimeline(self):
+        index = self.layerCombo.currentIndex()
+        if index <= 0 or len(self.idEdit.text()) == 0:
+            return
+        self.timelineRequested.emit(self.layerCombo.itemData(index), self.idEdit.text())
+
+    def onTimeTravel(self):
+        index = self.layerCombo.currentIndex()
+        if index <= 0:
+            return
+        self.timeTravelRequested.emit(self.layerCombo.itemData(index),
+                                      self.travelDt.dateTime().toPyDateTime())
 
     def done(self, status):
         self.undisplayGeometry()
+        self.polygon_tool.clear()
+        self.map_canvas.unsetMapTool(self.polygon_tool)
+        if self.live_tail is not None:
+            self.live_tail.close()
+            self.live_tail = None
+        if self.eventModel is not None:
+            self.eventModel.close()
+        self.worker.stop()
+        self.detail_worker.stop()
+        if self.replay_worker is not None:
+            self.replay_worker.stop()
         return QDialog.done(self, status)
 
-    def populate(self):
-        from qgis.core import QgsMessageLog
-        wheres = []
+    def onCancel(self):
+        self.worker.cancel()
+        self.detail_worker.cancel()
+        # The replay job is not dropped: it may have committed already, its
+        # handlers report whether the events have been replayed.
+        if self.replaying and self.replay_state is not None:
+            self.replay_state["canceled"] = True
+            connection = self.replay_worker.connection_wrapper.psycopg2Connection
+            if connection != None:
+                connection.cancel()
+
+    def onWorkerBusyChanged(self, unused):
+        busy = self.worker.isBusy() or self.detail_worker.isBusy() or \
+            (self.replay_worker is not None and self.replay_worker.isBusy())
+        self.progressBar.setVisible(busy)
+        self.cancelButton.setVisible(busy)
+        self.updateStatus()
+
+    def updateStatus(self):
+        if self.transactionModel is not None:
+            n = self.transactionModel.transactionCount()
+            status = "{} transactions".format(n)
+            if not self.transactionModel.isExhausted():
+                status += " loaded"
+            self.statusLabel.setText(self.replayStatus(status))
+            return
+        if self.eventModel is None:
+            self.statusLabel.setText("")
+            return
+        n = self.eventModel.loadedRowCount()
+        if self.eventModel.isExhausted():
+            status = "{} events".format(n)
+            self.countButton.setEnabled(False)
+        elif self.exact_count is not None:
+            status = "{} of {} events loaded".format(n, self.exact_count)
+        elif self.estimated_count is not None:
+            status = "{} of ~{} events loaded".format(n, self.estimated_count)
+        else:
+            status = "{} events loaded".format(n)
+        self.statusLabel.setText(self.replayStatus(status))
+
+    def replayStatus(self, status):
+        if self.replaying:
+            if self.progressBar.maximum() > 0:
+                return status + " - replaying events ({}/{})".format(
+                    self.progressBar.value(), self.progressBar.maximum())
+            return status + " - replaying events"
+        elif self.replay_message is not None:
+            return status + " - " + self.replay_message
+        return status
+
+    def onCountEstimated(self, model, estimate):
+        if model is not self.eventModel:
+            return
+        self.estimated_count = estimate
+        if self.estimate_count:
+            self.eventModel.setEstimatedRowCount(estimate)
+        self.updateStatus()
+
+    def onCount(self):
+        """Count the events of the current search, in the background."""
+        search = self.search
+        model = self.eventModel
+
+        self.countButton.setEnabled(False)
+        self.worker.submit(self.streamQuery(lambda cur: exact_count(cur, search)),
+                           lambda n: self.onCounted(model, n),
+                           self.onCountFailed)
+
+    def streamQuery(self, query):
+        """Job running query(cursor) on the stream connection.
+        With keyset pagination the transaction is rolled back at the end of
+        the job, as after each page, so that the session is not left idle in
+        transaction. With cursor pagination the transaction holds the
+        server-side cursor of the list, it is kept.
+        """
+        connection_wrapper = self.worker.connection_wrapper
+        keyset = self.pagination == "keyset"
+
+        def run():
+            cur = connection_wrapper.cursor()
+            try:
+                return query(cur)
+            finally:
+                cur.close()
+                if keyset:
+                    connection_wrapper.rollback()
+        return run
+
+    def onShowOnMap(self):
+        if self.eventModel is None and self.transactionModel is None:
+            return
+        self.showOnMapRequested.emit(self.search)
+
+    def onExport(self):
+        if self.eventModel is None and self.transactionModel is None:
+            return
+        filters = ["{} (*.{})".format(name, extension) for name, extension in EXPORT_FORMATS]
+        path, selected_filter = QFileDialog.getSaveFileName(self, "Export the events", "", ";;".join(filters))
+        if path == "":
+            return
+        extension = EXPORT_FORMATS[filters.index(selected_filter)][1] if selected_filter in filters else "gpkg"
+        if os.path.splitext(path)[1] == "":
+            path += "." + extension
+        self.exportRequested.emit(self.search, path)
+
+    def onCounted(self, model, n):
+        if model is not self.eventModel:
+            return
+        self.exact_count = n
+        if self.estimate_count:
+            self.eventModel.setEstimatedRowCount(n)
+        self.updateStatus()
+
+    def onCountFailed(self, error):
+        self.countButton.setEnabled(True)
+        self.showError(error)
+
+    def showError(self, error, details=""):
+        """Display an error message.
+        @param error error message, None for a canceled query
+        """
+        if error is None:
+            return
+        self.error_dlg = ErrorDialog(self)
+        self.error_dlg.setErrorText(
+            "An error has occurred during database access.")
+        self.error_dlg.setContextText(error)
+        self.error_dlg.setDetailsText(details)
+        self.error_dlg.exec_()
+
+    def searchQuery(self):
+        """Build the parameterized query of the current search."""
+        search = SearchQuery(self.audit_table)
 
         # filter by selected layer/table
         index = self.layerCombo.currentIndex()
         if index > 0:
             lid = self.layerCombo.itemData(index)
             schema, table = self.table_map[lid].split(".")
-            wheres.append("schema_name = '{}'".format(schema))
-            wheres.append("table_name = '{}'".format(table))
+            search.filterTable(schema, table)
+
+            # filter by area, on the main geometry column
+            if self.spatialChck.isChecked():
+                self.filterGeometry(search, lid, self.table_map[lid])
 
             # filter by feature id, if any
             if len(self.idEdit.text()) > 0:
                 try:
-                    id = int(self.idEdit.text())
-                    wheres.append("row_data->'id'='{}'".format(id))
+                    search.filterFeatureId(int(self.idEdit.text()))
                 except ValueError:
                     pass
 
-        # filter by data
+        # quick filters, on the values of the columns of the list
+        table_name = self.quickFilterValue("table")
+        if "." in table_name:
+            schema, table = table_name.split(".", 1)
+            search.filterTable(schema, table)
+        application = self.quickFilterValue("application")
+        if len(application) > 0:
+            search.filterApplication(application)
+        user = self.quickFilterValue("user")
+        if len(user) > 0:
+            search.filterUser(user)
+
+        # filter by data, using the trigram or full text index if any
         if self.dataChck.isChecked():
-            v = self.dataEdit.text()
-            v = v.replace('\\', '\\\\').replace(
-                "'", "''").replace('%', '\\%').replace('_', '\\_')
-            wheres.append(
-                "(SELECT string_agg(v,' ') FROM svals(row_data) as v) ILIKE '%{}%'".format(v))
+            search.filterData(self.dataEdit.text(), self.data_index_kind)
 
         # filter by event type
         types = []
@@ -364,84 +1265,491 @@ class EventDialog(QDialog, FORM_CLASS):
             types.append('U')
         if self.deletesChck.isChecked():
             types.append('D')
-        wheres.append("action IN ('{}')".format("','".join(types)))
+        search.filterActions(types)
 
         # filter by dates
         if self.afterChck.isChecked():
-            dt = self.afterDt.dateTime()
-            wheres.append("action_tstamp_clk > '{}'".format(
-                dt.toString(Qt.ISODate)))
+            search.filterAfter(self.afterDt.dateTime().toPyDateTime())
         if self.beforeChck.isChecked():
-            dt = self.beforeDt.dateTime()
-            wheres.append("action_tstamp_clk < '{}'".format(
-                dt.toString(Qt.ISODate)))
+            search.filterBefore(self.beforeDt.dateTime().toPyDateTime())
 
-        # base query
-        q = "SELECT event_id, action_tstamp_clk, schema_name || '.' || table_name, action, application_name, session_user_name, row_data, changed_fields FROM {} l".format(
-            self.audit_table)
-        # where clause
-        if len(wheres) > 0:
-            q += " WHERE " + " AND ".join(wheres)
+        search.sortBy(self.sort_key, self.sort_descending)
+        return search
 
-        # Descending order.
-        q += " ORDER BY action_tstamp_clk DESC"
+    def filterGeometry(self, search, layer_id, table_name):
+        columns = self.metadata.geometryColumns(table_name)
+        area = self.spatialFilterArea()
+        if len(columns) == 0 or area is None or area.isEmpty():
+            return
+        column = columns[0]
+        srid = self.metadata.srid(table_name, column)
+        if not srid:
+            # generic geometry column
+            layer = QgsProject.instance().mapLayer(layer_id)
+            if layer is None:
+                return
+            srid = layer.crs().postgisSrid()
+
+        # bounding box prefilter, then exact test for a drawn polygon
+        area = to_table_crs(area, self.map_canvas.mapSettings().destinationCrs(), srid)
+        bbox = area.boundingBox()
+        schema, table = table_name.split(".")
+        search.filterGeometry(schema, table, column, srid,
+                              (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()),
+                              area.asWkt() if self.spatialCombo.currentIndex() == 1 else None)
+
+    def loadFilterValues(self):
+        """Fill the quick filter combos in the background."""
+        connection_wrapper = self.detail_worker.connection_wrapper
+        audit_table = self.audit_table
+
+        def load():
+            cur = connection_wrapper.cursor()
+            if cur == None:
+                return {}
+            try:
+                return dict([(key, distinct_values(cur, audit_table, key)) for key in QUICK_FILTERS])
+            finally:
+                cur.close()
+                connection_wrapper.rollback()
+
+        self.detail_worker.submit(load, self.onFilterValuesLoaded, self.onFilterValuesFailed)
+
+    def onFilterValuesLoaded(self, values):
+        for key, combo in self.filter_combos.items():
+            text = combo.currentText()
+            combo.clear()
+            combo.addItems([""] + values.get(key, []))
+            combo.setEditText(text)
+
+    def onFilterValuesFailed(self, error):
+        # the filters can still be typed
+        if error is not None:
+            print("Cannot list the values of the filters:", error)
+
+    def quickFilterValue(self, filter_key):
+        return self.filter_combos[filter_key].currentText().strip()
+
+    def onSortChanged(self, section, order):
+        self.sort_key = SORT_COLUMNS[section]
+        self.sort_descending = order == Qt.DescendingOrder
+        self.updateGotoWidgets()
+        if self.eventModel is not None:
+            self.populate()
+
+    def updateGotoWidgets(self):
+        # a date can only be jumped to in a list of events sorted by date
+        enabled = self.pagination == "keyset" and self.sort_key == "date" and not self.groupChck.isChecked()
+        self.gotoDt.setEnabled(enabled)
+        self.gotoButton.setEnabled(enabled)
 
-        # Create cursor.
-        cur = self.connection_wrapper_read.cursor()
-        if cur == None:
-            print("Cannot get cursor for database.")
+    def populate(self):
+        search = self.searchQuery()
+        self.search = search
+
+        # Release the previous cursor and drop the pending queries.
+        if self.eventModel is not None:
+            self.worker.cancel()
+            self.eventModel.close()
+        elif self.transactionModel is not None:
+            self.worker.cancel()
+
+        if self.groupChck.isChecked():
+            self.populateTransactions(search)
             return
+        self.transactionModel = None
+        self.transactionTree.hide()
+        self.eventTable.show()
+
+        # Events recorded from now on are fetched by refreshNewEvents(), the
+        # snapshot is taken before the list query.
+        tail = EventTail()
+        self.tail = tail
+        self.worker.submit(self.streamQuery(current_snapshot), tail.setSnapshot)
+
+        if self.pagination == "keyset":
+            # Fetch events by pages, seeking on (action_tstamp_clk, event_id).
+            cur = KeysetPager(self.worker.connection_wrapper,
+                              EVENT_COLUMNS, search, self.fetch_size)
+        else:
+            # Descending order.
+            q, params = search.build(", ".join(EVENT_COLUMNS), order=True)
+
+            # Create a server-side cursor, so that only the rows actually
+            # displayed are transferred.
+            self.cursor_serial += 1
+            cur = self.worker.connection_wrapper.namedCursor(
+                "history_events_{}".format(self.cursor_serial), self.fetch_size)
+            if cur == None:
+                print("Cannot get cursor for database.")
+                return
+
+            # The query is declared in the background, before the first batch is fetched.
+            self.worker.submit(lambda: cur.execute(q, params), None, self.onSearchFailed)
+
+        self.eventModel = EventModel(cur, self.worker, self.detail_cache, self.fetch_size, self.max_events)
+        self.eventModel.fetchFailed.connect(self.showError)
+        self.eventModel.rowsInserted.connect(self.updateStatus)
+        self.eventModel.rowsRemoved.connect(self.updateStatus)
+        self.eventModel.dataChanged.connect(self.updateStatus)
+        self.eventModel.modelReset.connect(self.updateStatus)
 
-        cur.execute(q)
+        # The estimated number of events is known before the first batch.
+        self.estimated_count = None
+        self.exact_count = None
+        self.replay_message = None
+        self.countButton.setEnabled(True)
+        model = self.eventModel
 
-        self.eventModel = EventModel(cur)
+        self.worker.submit(self.streamQuery(lambda cur: estimate_count(cur, search)), lambda n: self.onCountEstimated(model, n))
+
+        self.eventModel.fetchMore(QModelIndex())
         self.eventTable.setModel(self.eventModel)
 
         self.eventTable.selectionModel().currentRowChanged.connect(self.onEventSelection)
 
         self.eventTable.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
 
+    def populateTransactions(self, search):
+        """List the transactions of the events of a search, most recent first."""
+        self.eventModel = None
+        self.estimated_count = None
+        self.exact_count = None
+        self.replay_message = None
+        self.countButton.setEnabled(False)
+
+        self.transactionModel = TransactionModel(self.worker, search, self.fetch_size)
+        self.transactionModel.fetchFailed.connect(self.showError)
+        self.transactionModel.rowsInserted.connect(self.updateStatus)
+        self.transactionModel.fetchMore(QModelIndex())
+        self.transactionTree.setModel(self.transactionModel)
+        self.transactionTree.selectionModel().currentChanged.connect(self.onTransactionSelection)
+
+        self.eventTable.hide()
+        self.transactionTree.show()
+        self.updateStatus()
+
+    def onGroupToggled(self, checked):
+        self.updateGotoWidgets()
+        if self.eventModel is not None or self.transactionModel is not None:
+            self.populate()
+
+    def refreshNewEvents(self):
+        """Insert the events recorded since the list was loaded at the top of the list, in the background."""
+        model = self.eventModel
+        # new events are only inserted on top of a list of the most recent events
+        if model is None or model.seekDate() is not None or not self.search.isSortedByDate():
+            return
+        newest = model.newestEventId()
+        if newest is None and self.tail.snapshot is None:
+            return
+        if self.refreshing_new_events:
+            # fetched once the current refresh is done
+            self.refresh_pending = True
+            return
+        self.refreshing_new_events = True
+        self.fetchNewEvents(model, self.tail, newest)
+
+    def fetchNewEvents(self, model, tail, newest, after_id=None):
+        """Fetch a batch of new events, in the background.
+        @param after_id highest event id of the previous batch, None for the first batch
+        """
+        search = self.search
+        page_size = self.fetch_size
+        conditions = tail.conditions(newest, after_id)
+
+        def fetch(cur):
+            q, params = search.build(", ".join(EVENT_COLUMNS + TAIL_COLUMNS), conditions,
+                                     order="event_id", limit=page_size, numbered=True)
+            execute_prepared(cur, q, params)
+            return cur.fetchall()
+
+        self.worker.submit(self.streamQuery(fetch),
+                           lambda rows: self.onNewEventsFetched(model, tail, newest, rows),
+                           self.onNewEventsFailed)
+
+    def onNewEventsFailed(self, error):
+        self.refreshing_new_events = False
+        self.refresh_pending = False
+        self.showError(error)
+
+    def onNewEventsFetched(self, model, tail, newest, rows):
+        if model is not self.eventModel:
+            self.refreshing_new_events = False
+            return
+        new_rows = tail.addRows(rows, model.hasEvent)
+
+        # a scrolled list keeps showing the same events
+        scrollbar = self.eventTable.verticalScrollBar()
+        position = scrollbar.value()
+        model.prependRows(new_rows)
+        if position > 0:
+            step = 1
+            if self.eventTable.verticalScrollMode() == QAbstractItemView.ScrollPerPixel:
+                step = self.eventTable.rowHeight(0)
+            scrollbar.setValue(position + len(new_rows) * step)
+
+        if self.exact_count is not None:
+            self.exact_count += len(new_rows)
+        if self.estimated_count is not None:
+            self.estimated_count += len(new_rows)
+        self.updateStatus()
+
+        if len(rows) == self.fetch_size:
+            # next batch
+            self.fetchNewEvents(model, tail, newest, rows[-1][0])
+            return
+        tail.endRefresh()
+        self.refreshing_new_events = False
+
+        if self.refresh_pending:
+            self.refresh_pending = False
+            self.refreshNewEvents()
+
+    def onFollowToggled(self, checked):
+        if self.live_tail is not None:
+            self.live_tail.close()
+            self.live_tail = None
+        if not checked:
+            return
+
+        cur = self.connection_wrapper_read.cursor()
+        if cur == None:
+            return
+        try:
+            installed = has_notify_trigger(cur, self.audit_table)
+        except Error:
+            installed = False
+        finally:
+            cur.close()
+            self.connection_wrapper_read.rollback()
+        if not installed:
+            self.followChk.setChecked(False)
+            self.showError("The notification trigger is not installed on the audit table, "
+                           "it can be installed from the configuration dialog.")
+            return
+
+        self.live_tail = LiveTail(self.connection_wrapper_read.connectionString(), self.audit_table)
+        if not self.live_tail.isValid():
+            self.followChk.setChecked(False)
+            return
+        self.live_tail.eventsAvailable.connect(self.onEventsRecorded)
+
+    def onEventsRecorded(self, event_id):
+        # a transaction committed late may notify ids lower than the listed
+        # ones, the tail query drops the events already listed
+        if self.eventModel is None:
+            return
+        self.refreshNewEvents()
+
+    def onSearchFailed(self, error):
+        # drop the batch fetches queued after the failed query
+        self.worker.cancel()
+        self.showError(error)
+
+    def onGotoDate(self):
+        if self.eventModel is None or self.pagination != "keyset" or self.sort_key != "date":
+            return
+        self.eventModel.seek(self.gotoDt.dateTime().toPyDateTime())
+
     def updateReplayButton(self):
         self.replayButton.setEnabled(False)
         self.replayButton.setToolTip(
             "No replay function or layer is in edition mode: replay action is not available.")
 
-        if self.replay_function and self.replayEnabled == True:
+        self.replayTransactionButton.setEnabled(False)
+        self.replayTransactionButton.setToolTip(self.replayButton.toolTip())
+
+        if self.replay_function and self.replayEnabled == True and not self.replaying:
             self.replayButton.setEnabled(True)
-            self.replayButton.setToolTip("Replay the current selected item.")
+            self.replayButton.setToolTip("Replay the selected events, oldest first, in one transaction.")
+            self.replayTransactionButton.setEnabled(True)
+            self.replayTransactionButton.setToolTip(
+                "Replay all the events of the transaction of the current event.")
 
     def onEventSelection(self, current_idx, previous_idx):
         reset_table_widget(self.dataTable)
         self.undisplayGeometry()
 
-        # get current selection
-        if current_idx.row() == -1:
+        # get current selection, that may not be loaded yet
+        if not self.eventModel.isRowLoaded(current_idx.row()):
             self.dataTable.hide()
             return
         i = current_idx.row()
-        # action from current selection
-        action = self.eventModel.data(self.eventModel.index(i, 2), Qt.UserRole)
 
         self.updateReplayButton()
 
-        # get geometry columns
-        data = self.eventModel.row_data(i)
-        table_name = self.eventModel.data(self.eventModel.index(i, 1))
-        gcolumns = self.geometry_columns.get(table_name)
-        if gcolumns is None:
-            schema, table = table_name.split('.')
-
-            # Create cursor.
-            cur = self.connection_wrapper_read.cursor()
-            if cur == None:
-                print("Cursor creation has failed")
+        # fetch in the background the details of the event, and of its
+        # neighbours for a smooth browsing with the arrow keys
+        self.loadEvent(self.eventModel.neighbourIds(i, DETAIL_PREFETCH_RADIUS),
+                       self.eventModel.neighbourTables(i, DETAIL_PREFETCH_RADIUS))
+
+    def onTransactionSelection(self, current_idx, previous_idx):
+        reset_table_widget(self.dataTable)
+        self.undisplayGeometry()
+
+        # a transaction, or an event of a transaction
+        self.updateReplayButton()
+        neighbours = self.transactionModel.neighbourEvents(current_idx, DETAIL_PREFETCH_RADIUS)
+        if len(neighbours) == 0:
+            self.dataTable.hide()
+            return
+        self.loadEvent([event_id for event_id, table_name in neighbours],
+                       set([table_name for event_id, table_name in neighbours]))
+
+    def currentEvent(self):
+        """(event_id, table_name, action) of the current event, None if no loaded event is current."""
+        if self.transactionModel is not None:
+            return self.transactionModel.event(self.transactionTree.selectionModel().currentIndex())
+        if self.eventModel is None:
+            return None
+        i = self.eventTable.selectionModel().currentIndex().row()
+        if not self.eventModel.isRowLoaded(i):
+            return None
+        return (self.eventModel.eventId(i),
+                self.eventModel.data(self.eventModel.index(i, 1)),
+                self.eventModel.data(self.eventModel.index(i, 2), Qt.UserRole))
+
+    def loadEvent(self, neighbour_ids, neighbour_tables):
+        """Display the current event, once its details and the ones of its neighbours are loaded.
+        @param neighbour_ids ids of the current event and of its neighbours
+        @param neighbour_tables table names of these events
+        """
+        event = self.currentEvent()
+        event_ids = self.detail_cache.missing(neighbour_ids)
+        tables = self.metadata.missing(neighbour_tables)
+        if len(event_ids) == 0 and len(tables) == 0:
+            self.displayEvent(event)
+            return
+
+        geometry_columns = self.metadata.geometryColumnsMap(neighbour_tables)
+        simplify_factor = self.simplifyFactor()
+
+        def load():
+            # geometry columns are needed to transfer the main geometry as WKB
+            tables_info = self.loadTables(tables)
+            for t, info in tables_info.items():
+                geometry_columns[t] = info.geometry_columns
+            details = self.detail_cache.load(
+                event_ids, geometry_columns, simplify_factor)
+            return details, tables_info
+
+        self.detail_worker.submit(load,
+                                  lambda result: self.onEventDetailsLoaded(
+                                      event[0], result),
+                                  self.showError)
+
+    def loadTables(self, table_names):
+        """Query the metadata of tables missing from the metadata cache, in one query.
+        Run in the worker thread.
+        @param table_names list of schema qualified table names
+        @returns dict table_name => TableInfo, with an empty TableInfo for the tables that do not exist anymore
+        """
+        if len(table_names) == 0:
+            return {}
+
+        # Create cursor.
+        connection_wrapper = self.detail_worker.connection_wrapper
+        cur = connection_wrapper.cursor()
+        if cur == None:
+            print("Cursor creation has failed")
+            return {}
+
+        try:
+            tables = query_tables(cur, table_names)
+        finally:
+            cur.close()
+            connection_wrapper.rollback()
+        for t in table_names:
+            tables.setdefault(t, TableInfo())
+        return tables
+
+    def simplifyFactor(self):
+        """Simplification tolerance as a fraction of the geometry size, so that
+        the tolerance is about one pixel of the inner canvas zoomed on the geometry.
+        @returns the factor or None if geometries are not simplified
+        """
+        if not self.level_of_detail:
+            return None
+        pixels = max(self.inner_canvas.width(), self.inner_canvas.height(), LOD_MIN_PIXELS)
+        # the extent is 1.5 times the geometry size, see GeometryDisplayer
+        return 1.5 / pixels
+
+    def onInnerCanvasZoomed(self):
+        if self.displayed_lod is None:
+            return
+        event_id, column, tolerance = self.displayed_lod
+        map_units_per_pixel = self.inner_canvas.mapUnitsPerPixel()
+        if map_units_per_pixel >= tolerance / 2:
+            # the current level of detail is good enough
+            return
+
+        self.detail_worker.submit(lambda: self.detail_cache.loadGeometries(event_id, column, map_units_per_pixel),
+                                  lambda geometries: self.onGeometriesRefined(
+                                      event_id, geometries),
+                                  self.showError)
+
+    def onGeometriesRefined(self, event_id, geometries):
+        if geometries is None:
+            return
+        self.detail_cache.updateGeometries(event_id, geometries)
+
+        # the selection may have changed in the meantime
+        event = self.currentEvent()
+        if event is None or event[0] != event_id:
+            return
+        self.displayMainGeometries(event, zoom=False)
+
+    def displayMainGeometries(self, event, zoom=True):
+        """Display the main geometry of an event, when transferred as WKB.
+        @param event (event_id, table_name, action)
+        """
+        self.displayed_lod = None
+        event_id, table_name, action = event
+        # (old WKB, new WKB, SRID, simplification tolerance), None if the geometry is in the hstores
+        geometries = self.detail_cache.get(event_id)[2]
+        if geometries is None:
+            return
+        old_wkb, new_wkb, srid, tolerance = geometries
+        if action == 'U':
+            if new_wkb is None:
                 return
+            self.displayGeometry(wkb_to_geom(old_wkb), wkb_to_geom(new_wkb), zoom)
+        elif old_wkb is not None:
+            self.displayGeometry(wkb_to_geom(old_wkb), zoom=zoom)
+        else:
+            return
 
-            q = "SELECT f_geometry_column FROM geometry_columns WHERE f_table_schema='{}' AND f_table_name='{}'".format(
-                schema, table)
-            cur.execute(q)
-            self.geometry_columns[table_name] = [r[0] for r in cur.fetchall()]
-            gcolumns = self.geometry_columns[table_name]
+        if tolerance is not None and tolerance > 0:
+            self.displayed_lod = (event_id, self.metadata.geometryColumns(table_name)[0], tolerance)
+
+    def onEventDetailsLoaded(self, event_id, result):
+        details, tables = result
+        for k, v in details.items():
+            self.detail_cache.insert(k, v)
+        self.metadata.update(tables)
+
+        # the selection may have changed in the meantime
+        event = self.currentEvent()
+        if event is None or event[0] != event_id:
+            return
+        self.displayEvent(event)
+
+    def displayEvent(self, event):
+        """Display the data and the geometries of an event whose details are loaded.
+        @param event (event_id, table_name, action)
+        """
+        reset_table_widget(self.dataTable)
+        self.undisplayGeometry()
+
+        event_id, table_name, action = event
+        data, changed_fields = self.detail_cache.get(event_id)[:2]
+
+        # get geometry columns
+        gcolumns = self.metadata.geometryColumns(table_name)
+
+        # main geometry transferred as WKB, if any
+        self.displayMainGeometries(event)
 
         # insertion or deletion
         if action == 'I' or action == 'D':
@@ -450,6 +1758,7 @@ class EventDialog(QDialog, FORM_CLASS):
             j = 0
             for k, v in data.items():
                 if len(gcolumns) > 0 and k == gcolumns[0]:
+                    # fallback: hex EWKB in the hstore
                     self.displayGeometry(ewkb_to_geom(v))
                     continue
                 if k in gcolumns:
@@ -465,10 +1774,10 @@ class EventDialog(QDialog, FORM_CLASS):
             self.dataTable.setColumnCount(3)
             self.dataTable.setHorizontalHeaderLabels(
                 ["Column", "Old value", "New value"])
-            changed_fields = self.eventModel.changed_fields(i)
             j = 0
             for k, v in data.items():
                 if len(gcolumns) > 0 and k == gcolumns[0]:
+                    # fallback: hex EWKB in the hstore
                     w = changed_fields.get(k)
                     if w is not None:
                         self.displayGeometry(ewkb_to_geom(v), ewkb_to_geom(w))
@@ -496,53 +1805,173 @@ class EventDialog(QDialog, FORM_CLASS):
         self.dataTable.show()
 
     def undisplayGeometry(self):
+        self.displayed_lod = None
         self.geometryGroup.hide()
         self.displayer.reset()
         self.inner_displayer.reset()
 
-    def displayGeometry(self, geom, geom2=None):
-        self.inner_displayer.display(geom, geom2)
+    def displayGeometry(self, geom, geom2=None, zoom=True):
+        self.inner_displayer.display(geom, geom2, zoom)
         self.geometryGroup.show()
 
         if self.onMainCanvas.isChecked():
-            self.displayer.display(geom, geom2)
+            self.displayer.display(geom, geom2, zoom)
+
+    def selectedEventIds(self):
+        """Ids of the selected events that are loaded, oldest first."""
+        if self.transactionModel is not None:
+            events = [self.transactionModel.event(idx)
+                      for idx in self.transactionTree.selectionModel().selectedRows()]
+            return sorted([event[0] for event in events if event is not None])
+        if self.eventModel is None:
+            return []
+        rows = [idx.row() for idx in self.eventTable.selectionModel().selectedRows()]
+        return sorted([self.eventModel.data(self.eventModel.index(i, 0), Qt.UserRole)
+                       for i in rows if self.eventModel.isRowLoaded(i)])
 
     def onReplayEvent(self):
-        i = self.eventTable.selectionModel().currentIndex().row()
-        if i == -1:
+        event_ids = self.selectedEventIds()
+        if len(event_ids) == 0:
             return
-        # event_id from current selection
-        event_id = self.eventModel.data(
-            self.eventModel.index(i, 0), Qt.UserRole)
+        self.replayEvents(lambda cursor: event_ids)
 
-        error = ""
+    def onReplayTransaction(self):
+        if self.transactionModel is not None:
+            # the current transaction, or the transaction of the current event
+            event_id = self.transactionModel.eventId(self.transactionTree.selectionModel().currentIndex())
+        else:
+            event = self.currentEvent()
+            event_id = None if event is None else event[0]
+        if event_id is None:
+            return
+        audit_table = self.audit_table
+        self.replayEvents(lambda cursor: transaction_event_ids(cursor, audit_table, event_id))
 
-        q = "SELECT {}({})".format(self.replay_function, event_id)
+    def replayEvents(self, get_event_ids):
+        """Replay events in one statement and one transaction.
+        @param get_event_ids function returning the ordered event ids, given a cursor
+        """
+        replay_function = self.replay_function
+
+        # Direct connection: replay in the background, by batches in one
+        # transaction, on a worker of its own so that canceling the other
+        # queries does not drop the completion of the replay.
+        if self.connection_wrapper_write.qgisTransactionGroupConnection == None:
+            if self.replay_worker is None:
+                self.replay_worker = QueryWorker(self.connection_wrapper_read.connectionString(),
+                                                 self.connection_pool, ROLE_WRITE)
+                self.replay_worker.busyChanged.connect(self.onWorkerBusyChanged)
+                self.replayProgress.connect(self.onReplayProgress)
+            connection_wrapper = self.replay_worker.connection_wrapper
+            progress = self.replayProgress
+            state = {"canceled": False}
+
+            def replay():
+                cur = connection_wrapper.cursor()
+                try:
+                    event_ids = get_event_ids(cur)
+                    n = len(event_ids)
+                    for start in range(0, n, REPLAY_BATCH_SIZE):
+                        if state["canceled"]:
+                            break
+                        cur.execute(replay_batch_statement(replay_function,
+                                                           event_ids[start:start + REPLAY_BATCH_SIZE]))
+                        progress.emit(min(start + REPLAY_BATCH_SIZE, n), n)
+                    if state["canceled"]:
+                        connection_wrapper.rollback()
+                        return None
+                    if n > 0:
+                        cur.execute(check_replay_statement(n))
+                    connection_wrapper.commit()
+                except Error:
+                    # nothing is replayed
+                    connection_wrapper.rollback()
+                    if state["canceled"]:
+                        return None
+                    raise
+                finally:
+                    cur.close()
+                return event_ids
+
+            self.replaying = True
+            self.replay_state = state
+            self.updateReplayButton()
+            self.replay_worker.submit(replay, self.onReplayDone, self.onReplayFailed)
+            self.updateStatus()
+            return
+
+        # Transaction group: the events of a transaction are read with the read connection.
+        cur = self.connection_wrapper_read.cursor()
+        try:
+            event_ids = get_event_ids(cur)
+        except Error as e:
+            self.showError(str(e))
+            return
+        finally:
+            cur.close()
+            self.connection_wrapper_read.rollback()
+        if len(event_ids) == 0:
+            return
 
         # Make a layer using transaction group editable to allow Sql execution.
         self.catchLayerModifications = False
         if self.editableLayerObject != None:
             self.editableLayerObject.startEditing()
 
-        error = self.connection_wrapper_write.executeSql(q)
+        error = self.connection_wrapper_write.executeSql(replay_statement(replay_function, event_ids))
 
         if self.editableLayerObject != None:
             self.editableLayerObject.commitChanges()
 
         self.catchLayerModifications = True
 
+        self.connection_wrapper_write.commit()
+
         if error != "":
-            self.error_dlg = ErrorDialog(self)
-            self.error_dlg.setErrorText(
-                "An error has occurred during database access.")
-            self.error_dlg.setContextText(error)
-            self.error_dlg.setDetailsText("")
-            self.error_dlg.exec_()
+            self.onReplayFailed(error)
+        else:
+            self.onReplayDone(event_ids)
 
-        self.connection_wrapper_write.commit()
+    def onReplayProgress(self, replayed, total):
+        self.progressBar.setRange(0, total)
+        self.progressBar.setValue(replayed)
+        self.updateStatus()
+
+    def endReplay(self):
+        self.replaying = False
+        self.replay_state = None
+        # back to a busy indicator
+        self.progressBar.setRange(0, 0)
+
+    def onReplayFailed(self, error):
+        self.endReplay()
+        self.replay_message = None
+        self.updateStatus()
+        self.showError(error)
+
+        # Refresh replay button state.
+        self.updateReplayButtonState()
+
+    def onReplayDone(self, event_ids):
+        self.endReplay()
+        if event_ids is None:
+            # canceled before the commit
+            self.replay_message = "replay canceled"
+            self.updateStatus()
+            self.updateReplayButtonState()
+            return
 
-        # refresh table
-        self.populate()
+        if self.transactionModel is not None:
+            # the replay is a new transaction: list the transactions again
+            self.worker.cancel()
+            self.populateTransactions(self.search)
+        self.replay_message = "{} events replayed".format(len(event_ids))
+
+        # refresh the replayed rows, and add the events of the replay on top
+        if self.eventModel is not None:
+            self.eventModel.setReplayed(event_ids)
+        self.updateStatus()
+        self.refreshNewEvents()
 
         # Refresh replay button state.
         self.updateReplayButtonState()
@@ -0,0 +1,212 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+from datetime import datetime
+
+from PyQt5.QtCore import QVariant
+
+from qgis.core import QgsVectorFileWriter, QgsFeature, QgsField, QgsFields, QgsWkbTypes
+
+from psycopg2 import sql
+
+from .event_dialog import parse_hstore, wkb_to_geom
+from .layer_loader import LayerLoader
+from .result_layer import geometry_select
+
+# Export of the events of a search to a file.
+#
+# The events are read from a server-side cursor by batches, like for the
+# layers of the search results, and each batch is written to the file as
+# soon as it is read, so that the memory used does not depend on the number
+# of events. The values of the row of an event (the inserted or updated
+# row, or the deleted one) are written as columns, and its main geometry as
+# the geometry of the feature.
+
+# Columns of each event, before the columns of its row.
+EVENT_FIELDS = [("event_id", QVariant.LongLong),
+                ("date", QVariant.DateTime),
+                ("table", QVariant.String),
+                ("action", QVariant.String),
+                ("application", QVariant.String),
+                ("user", QVariant.String),
+                ("changed", QVariant.String)]
+
+
+def export_select(geometry_columns, srid):
+    """Select list of the exported events.
+    @param geometry_columns dict table_name => geometry columns, the first one is the "main" geometry column
+    @param srid SRID the geometries are transformed to
+    """
+    if any(len(columns) > 0 for columns in geometry_columns.values()):
+        select, condition = geometry_select(geometry_columns, srid)
+    else:
+        select = sql.SQL("event_id, action_tstamp_clk, schema_name || '.' || table_name, action, "
+                         "session_user_name, NULL")
+    return sql.SQL("{}, application_name, row_data, changed_fields").format(select)
+
+
+def data_columns(tables):
+    """Columns of the rows of the events, geometry columns excepted.
+    @param tables list of TableInfo of the tables of the events
+    @returns list of column names, without duplicates
+    """
+    columns = []
+    for info in tables:
+        for name, column_type in info.columns:
+            if name not in info.geometry_columns and name not in columns:
+                columns.append(name)
+    return columns
+
+
+class CsvWriter():
+    """CSV file, with the geometry as WKT in the last column."""
+
+    def __init__(self, path, names, crs):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(names + ["geometry"])
+
+    def write(self, values, geometry):
+        self.writer.writerow(["" if v is None else v for v in values] +
+                             ["" if geometry.isNull() else geometry.asWkt()])
+
+    def close(self):
+        self.file.close()
+
+
+class GeoJsonLinesWriter():
+    """Newline-delimited GeoJSON, one feature per line."""
+
+    def __init__(self, path, names, crs):
+        self.file = open(path, "w", encoding="utf-8")
+        self.names = names
+
+    def write(self, values, geometry):
+        feature = {"type": "Feature",
+                   "geometry": None if geometry.isNull() else json.loads(geometry.asJson()),
+                   "properties": dict(zip(self.names, [v.isoformat() if isinstance(v, datetime) else v
+                                                       for v in values]))}
+        self.file.write(json.dumps(feature))
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+class GeoPackageWriter():
+    """GeoPackage layer, with a generic geometry type since events of many tables are mixed."""
+
+    def __init__(self, path, names, crs):
+        fields = QgsFields()
+        types = dict(EVENT_FIELDS)
+        for name in names:
+            fields.append(QgsField(name, types.get(name, QVariant.String)))
+        self.fields = fields
+        self.writer = QgsVectorFileWriter(path, "UTF-8", fields, QgsWkbTypes.Unknown, crs, "GPKG")
+        if self.writer.hasError() != QgsVectorFileWriter.NoError:
+            raise IOError(self.writer.errorMessage())
+        self.features = []
+
+    def write(self, values, geometry):
+        f = QgsFeature(self.fields)
+        f.setAttributes(values)
+        if not geometry.isNull():
+            f.setGeometry(geometry)
+        self.features.append(f)
+
+    def flush(self):
+        self.writer.addFeatures(self.features)
+        self.features = []
+
+    def close(self):
+        # the file is completed when the writer is deleted
+        del self.writer
+
+
+# Writer of each file extension.
+WRITERS = {"gpkg": GeoPackageWriter, "csv": CsvWriter, "geojsonl": GeoJsonLinesWriter}
+
+
+class EventExporter(LayerLoader):
+
+    def __init__(self, db_connection, search, path, geometry_columns, tables, crs, batch_size=1000):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param search SearchQuery of the events
+        @param path file name, its extension gives the format, see event_dialog.EXPORT_FORMATS
+        @param geometry_columns dict table_name => geometry columns, for the tables of the events
+        @param tables list of TableInfo of the tables of the events, their columns are exported
+        @param crs QgsCoordinateReferenceSystem of the exported geometries
+        @param batch_size number of events transferred and written at once
+        """
+        LayerLoader.__init__(self, db_connection, batch_size)
+        self.path = path
+        self.crs = crs
+        self.columns = data_columns(tables)
+        event_names = [name for name, field_type in EVENT_FIELDS]
+        # columns of the rows named like the event columns are prefixed
+        self.names = event_names + [c if c not in event_names else "data_" + c for c in self.columns]
+        self.geometry_columns = geometry_columns
+        self.query, self.params = search.build(export_select(geometry_columns, crs.postgisSrid() or 4326),
+                                               order=True)
+        self.writer = None
+        self.complete = False
+
+    def start(self):
+        extension = os.path.splitext(self.path)[1][1:].lower()
+        try:
+            self.writer = WRITERS[extension](self.path, self.names, self.crs)
+        except (KeyError, IOError, OSError) as e:
+            self.finish("Cannot write {}: {}".format(self.path, e))
+            return
+        LayerLoader.start(self, self.query, self.params)
+
+    def addRows(self, rows):
+        for event_id, tstamp, table_name, action, user, wkb, application, row_data, changed_fields in rows:
+            data = parse_hstore(row_data)
+            changed = parse_hstore(changed_fields)
+            # the new row of an update
+            data.update(changed)
+            geometry = wkb_to_geom(None if wkb is None else bytes(wkb))
+            values = [event_id, tstamp, table_name, action, application, user,
+                      ", ".join(sorted(changed.keys())) if action == 'U' else None]
+            values += [data.get(c) for c in self.columns]
+            self.writer.write(values, geometry)
+        if hasattr(self.writer, "flush"):
+            self.writer.flush()
+
+    def onRowsFetched(self, rows):
+        self.complete = len(rows) < self.batch_size
+        try:
+            LayerLoader.onRowsFetched(self, rows)
+        except (IOError, OSError) as e:
+            # e.g. no space left on the device
+            self.complete = False
+            self.finish("Cannot write {}: {}".format(self.path, e))
+
+    def finish(self, error):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            # a canceled or failed export leaves no partial file
+            if not self.complete and os.path.exists(self.path):
+                os.remove(self.path)
+        LayerLoader.finish(self, error)
@@ -0,0 +1,217 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import sys
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Compact storage of the listed events.
+# The rows of a page are stored by columns, ready to be displayed: ids and
+# actions in arrays, dates formatted once when the page is fetched, table,
+# application and user names as interned strings shared by all the rows.
+#
+# This module does not depend on QGIS, see tests/bench_event_page.py.
+
+# Date format of the event list.
+DATE_FORMAT = "%x - %X"
+
+# Display names of the actions, by action code.
+ACTION_LABELS = {ord('I'): "Insertion", ord('U'): "Update", ord('D'): "Delete"}
+
+# Qt.ItemDataRole values answered by cell_data(), the other roles are
+# ignored before any lookup.
+DISPLAY_ROLE, TOOLTIP_ROLE, FONT_ROLE, USER_ROLE = 0, 3, 6, 256
+DATA_ROLES = frozenset([DISPLAY_ROLE, USER_ROLE, FONT_ROLE, TOOLTIP_ROLE])
+
+
+class EventPage():
+    __slots__ = ("ids", "dates", "actions", "tables", "applications", "users")
+
+    def __init__(self, rows):
+        """@param rows list of (event_id, tstamp, table_name, action, application, user)"""
+        self.ids = array("q")
+        self.dates = []
+        self.actions = bytearray()
+        self.tables = []
+        self.applications = []
+        self.users = []
+        for event_id, tstamp, table_name, action, application, user in rows:
+            self.ids.append(event_id)
+            self.dates.append(tstamp.strftime(DATE_FORMAT))
+            self.actions.append(ord(action))
+            self.tables.append(intern_string(table_name))
+            self.applications.append(intern_string(application))
+            self.users.append(intern_string(user))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def action(self, i):
+        return chr(self.actions[i])
+
+    def actionLabel(self, i):
+        return ACTION_LABELS.get(self.actions[i])
+
+
+def intern_string(s):
+    return None if s is None else sys.intern(s)
+
+
+# Display value of each column of the event list.
+DISPLAY_COLUMNS = [lambda page, i: page.dates[i],
+                   lambda page, i: page.tables[i],
+                   lambda page, i: page.actionLabel(i),
+                   lambda page, i: page.applications[i],
+                   lambda page, i: page.users[i]]
+
+
+def cell_data(page, i, column, role, replayed=frozenset(), replayed_font=None):
+    """Value of a cell of the event list for a role, see EventModel.data().
+    @param page EventPage of the row
+    @param i index of the row in the page
+    @param replayed ids of the events replayed from the dialog
+    @param replayed_font font of the replayed events
+    """
+    if role == DISPLAY_ROLE:
+        return DISPLAY_COLUMNS[column](page, i)
+    elif role == USER_ROLE:
+        if column == 0:
+            return page.ids[i]
+        elif column == 2:
+            return page.action(i)
+    elif len(replayed) > 0 and page.ids[i] in replayed:
+        if role == FONT_ROLE:
+            return replayed_font
+        elif role == TOOLTIP_ROLE:
+            return "Replayed"
+    return None
+
+
+# Pages of an event list kept in memory.
+# Fetched pages are stored under their page number. Pages of events inserted
+# on top (see EventModel.prependRows()) are stored under negative keys, see
+# headKey(): they are not contiguous key ranges, so their event ids are kept
+# when they are dropped, to fetch them again by id.
+# At most max_rows rows are kept, the least recently used pages are dropped
+# first.
+
+
+class EventPages():
+
+    def __init__(self, page_size, max_rows=None):
+        """Constructor.
+        @param page_size number of rows of the fetched pages
+        @param max_rows maximum number of rows kept in memory, None to keep all the pages
+        """
+        self.page_size = page_size
+        self.max_rows = max_rows
+        # event ids of the head pages, in insertion order: the last one is
+        # displayed first
+        self.__head = []
+        # number of head rows up to each head page included
+        self.__head_ends = []
+        self.__head_count = 0
+        # key => EventPage, least recently used first
+        self.__pages = OrderedDict()
+        # number of rows of the pages in memory
+        self.__memory_rows = 0
+
+    def headCount(self):
+        """Number of rows inserted on top."""
+        return self.__head_count
+
+    def memoryRows(self):
+        return self.__memory_rows
+
+    def store(self, key, page):
+        """Keep a page in memory, dropping the least recently used ones beyond max_rows.
+        @param key number of the page, or headKey() of a head page
+        """
+        previous = self.__pages.get(key)
+        if previous is not None:
+            self.__memory_rows -= len(previous)
+        self.__pages[key] = page
+        self.__pages.move_to_end(key)
+        self.__memory_rows += len(page)
+        if self.max_rows is None:
+            return
+        while self.__memory_rows > self.max_rows and len(self.__pages) > 1:
+            self.__memory_rows -= len(self.__pages.popitem(last=False)[1])
+
+    def prepend(self, page):
+        """Insert a page on top of the rows."""
+        self.__head.append(page.ids)
+        self.__head_count += len(page)
+        self.__head_ends.append(self.__head_count)
+        self.store(self.headKey(len(self.__head) - 1), page)
+
+    @staticmethod
+    def headKey(j):
+        """Key of the head page j, negative not to collide with page numbers."""
+        return -1 - j
+
+    def headIds(self, key):
+        """Event ids of a head page, to fetch it again."""
+        return self.__head[-1 - key]
+
+    def headPage(self, row):
+        """Head page of a row inserted on top.
+        @returns (index of the head page, index in the page)
+        """
+        # position from the bottom of the head
+        b = self.__head_count - 1 - row
+        j = bisect_right(self.__head_ends, b)
+        start = self.__head_ends[j - 1] if j > 0 else 0
+        return j, len(self.__head[j]) - 1 - (b - start)
+
+    def pageKey(self, row):
+        """Key of the page of a row, whether it is in memory or not."""
+        if row < self.__head_count:
+            return self.headKey(self.headPage(row)[0])
+        return (row - self.__head_count) // self.page_size
+
+    def firstRow(self, key):
+        """Row of the first event of a page, or of a head page."""
+        if key < 0:
+            return self.__head_count - self.__head_ends[-1 - key]
+        return self.__head_count + key * self.page_size
+
+    def locate(self, row):
+        """Page and index in the page of a row.
+        @returns (EventPage, index) or None if the row is not in memory
+        """
+        if row < self.__head_count:
+            j, i = self.headPage(row)
+            key = self.headKey(j)
+        else:
+            key, i = divmod(row - self.__head_count, self.page_size)
+        page = self.__pages.get(key)
+        if page is None or i >= len(page):
+            return None
+        self.__pages.move_to_end(key)
+        return page, i
+
+    def hasEvent(self, event_id):
+        """Whether an event is in the rows inserted on top or in the pages in memory."""
+        return any(event_id in ids for ids in self.__head) or \
+            any(event_id in page.ids for page in self.__pages.values())
+
+    def items(self):
+        """@returns list of (key, EventPage) of the pages in memory"""
+        return list(self.__pages.items())
@@ -0,0 +1,109 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from psycopg2 import sql
+
+from .search_query import table_identifier
+
+# Replay of many events in one statement.
+#
+# The events are replayed in order by an anonymous code block, in the
+# current transaction. Each event is replayed in its own subtransaction so
+# that all the failing events are known: if any event fails, the block
+# raises an exception listing them and nothing is replayed.
+#
+# To report progress, the events can also be replayed by batches in one
+# transaction: each batch block records its failing events in a transaction
+# local setting instead of raising, and a last block raises the exception
+# listing all of them.
+#
+# This module does not depend on QGIS.
+
+# Number of events replayed by a batch statement.
+REPLAY_BATCH_SIZE = 200
+
+# Setting holding the errors of the batches of the current transaction, as a text[].
+REPLAY_ERRORS_SETTING = "history_viewer.replay_errors"
+
+
+def replay_statement(replay_function, event_ids):
+    """DO statement replaying events, in the given order.
+    It has no parameter, so that it can be run by QgsTransaction.executeSql() too.
+    @param replay_function name of the replay function in the database
+    @param event_ids list of event ids
+    """
+    return ("DO $replay$ DECLARE e bigint; errors text[] := '{{}}'; BEGIN "
+            "FOREACH e IN ARRAY ARRAY[{ids}]::bigint[] LOOP "
+            "BEGIN PERFORM {function}(e); "
+            "EXCEPTION WHEN OTHERS THEN errors := errors || ('event ' || e || ': ' || SQLERRM); "
+            "END; END LOOP; "
+            "IF array_length(errors, 1) > 0 THEN "
+            "RAISE EXCEPTION '% of {count} events cannot be replayed:%', array_length(errors, 1), "
+            "E'\\n' || array_to_string(errors, E'\\n'); "
+            "END IF; END $replay$").format(
+                ids=", ".join([str(int(i)) for i in event_ids]),
+                function=replay_function,
+                count=len(event_ids))
+
+
+def replay_batch_statement(replay_function, event_ids):
+    """DO statement replaying a batch of events, in the given order.
+    The errors are added to REPLAY_ERRORS_SETTING, see check_replay_statement().
+    @param replay_function name of the replay function in the database
+    @param event_ids list of event ids
+    """
+    return ("DO $replay$ DECLARE e bigint; errors text[] := '{{}}'; BEGIN "
+            "FOREACH e IN ARRAY ARRAY[{ids}]::bigint[] LOOP "
+            "BEGIN PERFORM {function}(e); "
+            "EXCEPTION WHEN OTHERS THEN errors := errors || ('event ' || e || ': ' || SQLERRM); "
+            "END; END LOOP; "
+            "IF array_length(errors, 1) > 0 THEN "
+            "PERFORM set_config('{setting}', "
+            "(coalesce(nullif(current_setting('{setting}', true), ''), '{{}}')::text[] || errors)::text, true); "
+            "END IF; END $replay$").format(
+                ids=", ".join([str(int(i)) for i in event_ids]),
+                function=replay_function,
+                setting=REPLAY_ERRORS_SETTING)
+
+
+def check_replay_statement(count):
+    """DO statement raising the errors of the batches of the current transaction.
+    @param count number of replayed events
+    """
+    return ("DO $replay$ DECLARE errors text[] := "
+            "coalesce(nullif(current_setting('{setting}', true), ''), '{{}}')::text[]; BEGIN "
+            "IF array_length(errors, 1) > 0 THEN "
+            "RAISE EXCEPTION '% of {count} events cannot be replayed:%', array_length(errors, 1), "
+            "E'\\n' || array_to_string(errors, E'\\n'); "
+            "END IF; END $replay$").format(setting=REPLAY_ERRORS_SETTING, count=int(count))
+
+
+def transaction_event_ids(cursor, audit_table, event_id):
+    """Events of the transaction of an event, oldest first.
+    The transaction start time is compared too, since transaction ids wrap around.
+    @param cursor a cursor
+    @param audit_table the name of the audit table in the database
+    @param event_id id of one of the events of the transaction
+    @returns list of event ids
+    """
+    cursor.execute(sql.SQL(
+        "SELECT t.event_id FROM {0} e JOIN {0} t "
+        "ON t.transaction_id = e.transaction_id AND t.action_tstamp_tx = e.action_tstamp_tx "
+        "WHERE e.event_id = %s ORDER BY t.event_id").format(table_identifier(audit_table)),
+        (event_id,))
+    return [r[0] for r in cursor.fetchall()]
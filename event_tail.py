@@ -0,0 +1,124 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+
+# Tail of the event list: the events recorded since the list was loaded.
+#
+# Event ids come from a sequence, a transaction may take its ids before
+# another one and commit after it, so "event_id > newest listed id" misses
+# the events of the transactions committed late. The tail is based on
+# transaction snapshots instead: the events to fetch are the ones of the
+# transactions that were not visible in the snapshot of the previous fetch.
+# Each fetched row carries its transaction id and the snapshot of the query,
+# rows fetched again because their transaction committed while the previous
+# fetch was running are dropped by id.
+#
+# New events are fetched by batches, in the order of their ids, so that a
+# bulk import is inserted in the list a page at a time.
+#
+# This module does not depend on QGIS.
+
+# Columns selected after the event columns by a tail query.
+TAIL_COLUMNS = ["transaction_id", "txid_current_snapshot()::text"]
+
+
+def current_snapshot(cursor):
+    """Snapshot of the current statement, as text."""
+    cursor.execute("SELECT txid_current_snapshot()::text")
+    return cursor.fetchone()[0]
+
+
+def parse_snapshot(snapshot):
+    """Parse the text of a txid_snapshot.
+    @returns (xmin, xmax, set of the transactions in progress)
+    """
+    xmin, xmax, xip = snapshot.split(":")
+    return int(xmin), int(xmax), set(int(x) for x in xip.split(",") if x != "")
+
+
+def txid_visible(txid, snapshot):
+    """Whether a transaction is committed in a snapshot, as txid_visible_in_snapshot().
+    @param snapshot parsed snapshot, see parse_snapshot()
+    """
+    xmin, xmax, xip = snapshot
+    return txid < xmin or (txid < xmax and txid not in xip)
+
+
+class EventTail():
+
+    def __init__(self, snapshot=None):
+        """Constructor.
+        @param snapshot snapshot taken before the list was loaded, None to start from the newest listed event
+        """
+        self.snapshot = snapshot
+        # ids of the fetched events whose transaction is not visible in the snapshot
+        self.fetched = set()
+        # snapshot and (event_id, transaction_id) of the rows of the running refresh
+        self.next_snapshot = None
+        self.next_rows = []
+
+    def setSnapshot(self, snapshot):
+        if self.snapshot is None:
+            self.snapshot = snapshot
+
+    def conditions(self, newest, after_id=None):
+        """Conditions of a tail query, see SearchQuery.build().
+        The query selects TAIL_COLUMNS after the event columns, and orders the events by event_id.
+        @param newest highest listed event id, used while no snapshot is known
+        @param after_id highest event id of the previous batch of the refresh, None for the first batch
+        @returns list of (template, values)
+        """
+        if self.snapshot is None:
+            conditions = [("event_id > {}", [newest])]
+        else:
+            xmin, xmax, xip = parse_snapshot(self.snapshot)
+            # transaction_id >= xmin for the index on transaction_id
+            conditions = [("transaction_id >= {}", [xmin]),
+                          ("NOT txid_visible_in_snapshot(transaction_id, {}::txid_snapshot)", [self.snapshot])]
+        if after_id is not None:
+            conditions.append(("event_id > {}", [after_id]))
+        return conditions
+
+    def addRows(self, rows, is_listed):
+        """Record a batch of tail rows.
+        @param rows rows of the tail query, ordered by event_id
+        @param is_listed function telling whether an event id is already in the list
+        @returns the new event rows, without the tail columns, most recent first
+        """
+        new_rows = []
+        for r in rows:
+            event_id, txid, snapshot = r[0], r[-2], r[-1]
+            if self.next_snapshot is None:
+                self.next_snapshot = snapshot
+            self.next_rows.append((event_id, txid))
+            if event_id in self.fetched or is_listed(event_id):
+                continue
+            new_rows.append(r[:-2])
+        new_rows.sort(key=lambda r: (r[1], r[0]), reverse=True)
+        return new_rows
+
+    def endRefresh(self):
+        """Move the tail after the rows of the refresh."""
+        if self.next_snapshot is not None:
+            self.snapshot = self.next_snapshot
+            snapshot = parse_snapshot(self.snapshot)
+            # the events fetched before are committed in the new snapshot
+            self.fetched = set(event_id for event_id, txid in self.next_rows
+                               if txid is not None and not txid_visible(txid, snapshot))
+        self.next_snapshot = None
+        self.next_rows = []
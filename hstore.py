@@ -0,0 +1,45 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import re
+
+# Convert a string representing a hstore from psycopg2 to a Python dict.
+# Hstores are already decoded as dicts when psycopg2's hstore adapter is
+# registered on the connection, this parser is the fallback.
+# Quoted strings are matched with an unrolled loop, so that long values
+# (hex EWKB geometries) are scanned once without backtracking.
+#
+# This module does not depend on QGIS, see tests/bench_hstore.py.
+QUOTED_STRING = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+kv_re = re.compile(QUOTED_STRING + r'\s*=>\s*(?:NULL|' + QUOTED_STRING + ')')
+escape_re = re.compile(r'\\(.)')
+
+
+def unescape_hstore(s):
+    if '\\' not in s:
+        return s
+    return escape_re.sub(r'\1', s)
+
+
+def parse_hstore(hstore_str):
+    if hstore_str is None:
+        return {}
+    if isinstance(hstore_str, dict):
+        return hstore_str
+    return dict([(unescape_hstore(m.group(1)), None if m.group(2) is None else unescape_hstore(m.group(2)))
+                 for m in kv_re.finditer(hstore_str)])
@@ -0,0 +1,177 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import os
+
+from PyQt5 import uic
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import QDialog, QMessageBox, QTableWidgetItem, QApplication
+
+from psycopg2 import Error
+
+from .audit_indexes import (table_indexes,
+                            missing_indexes,
+                            create_index_statement,
+                            create_data_index_statements,
+                            data_index_kind,
+                            representative_searches,
+                            explain_analyze,
+                            plan_uses_seq_scan,
+                            run_outside_transaction,
+                            statements_text)
+
+FORM_CLASS, _ = uic.loadUiType(os.path.join(
+    os.path.dirname(__file__), 'index_advisor_dialog.ui'))
+
+# Diagnostics of the audit table: existing indexes, query plans of
+# representative searches and recommended indexes.
+
+
+class IndexAdvisorDialog(QDialog, FORM_CLASS):
+    def __init__(self, parent, connection_wrapper, audit_table):
+        """Constructor.
+        @param parent parent widget
+        @param connection_wrapper connection wrapper (dbapi2)
+        @param audit_table the name of the audit table in the database
+        """
+        super(IndexAdvisorDialog, self).__init__(parent)
+        self.setupUi(self)
+
+        self.connection_wrapper = connection_wrapper
+        self.audit_table = audit_table
+
+        self.setWindowTitle("Audit table diagnostics - " + audit_table)
+
+        self.indexesTable.setColumnCount(2)
+        self.indexesTable.setHorizontalHeaderLabels(["Name", "Definition"])
+        self.plansTable.setColumnCount(2)
+        self.plansTable.setHorizontalHeaderLabels(["Search", "Plan"])
+        self.recommendationsTable.setColumnCount(2)
+        self.recommendationsTable.setHorizontalHeaderLabels(["Index", "Used by"])
+
+        # plan lines of each representative search
+        self.plans = []
+
+        self.explainBtn.clicked.connect(self.onExplain)
+        self.createBtn.clicked.connect(self.onCreateIndexes)
+        self.plansTable.currentCellChanged.connect(self.onPlanSelected)
+
+        self.refresh()
+
+    def refresh(self):
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            return
+        try:
+            indexes = table_indexes(cur, self.audit_table)
+            data_index = data_index_kind(cur, self.audit_table)
+        except Error as e:
+            QMessageBox.critical(self, "Diagnostics", str(e))
+            return
+        finally:
+            self.connection_wrapper.rollback()
+
+        self.indexesTable.setRowCount(len(indexes))
+        for i, (name, indexdef) in enumerate(indexes):
+            self.indexesTable.setItem(i, 0, QTableWidgetItem(name))
+            self.indexesTable.setItem(i, 1, QTableWidgetItem(indexdef))
+        self.indexesTable.resizeColumnToContents(0)
+
+        # recommendations: (index, usage, statements)
+        self.recommendations = []
+        for r in missing_indexes(indexes):
+            suffix, columns, pattern, usage = r
+            self.recommendations.append(
+                (columns, usage, [create_index_statement(self.audit_table, r)]))
+        if data_index is None:
+            self.recommendations.append(("gin ((row_data::text) gin_trgm_ops)",
+                                         "data contains filter",
+                                         create_data_index_statements(self.audit_table)))
+
+        self.recommendationsTable.setRowCount(len(self.recommendations))
+        for i, (columns, usage, statements) in enumerate(self.recommendations):
+            item = QTableWidgetItem(columns)
+            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked)
+            item.setToolTip(statements_text(self.connection_wrapper.psycopg2Connection, statements))
+            self.recommendationsTable.setItem(i, 0, item)
+            self.recommendationsTable.setItem(i, 1, QTableWidgetItem(usage))
+        self.recommendationsTable.resizeColumnToContents(0)
+        self.createBtn.setEnabled(len(self.recommendations) > 0)
+
+    def onExplain(self):
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.plans = []
+        try:
+            for label, query, params in representative_searches(cur, self.audit_table):
+                self.plans.append((label, explain_analyze(cur, query, params)))
+        except Error as e:
+            QMessageBox.critical(self, "Diagnostics", str(e))
+        finally:
+            self.connection_wrapper.rollback()
+            QApplication.restoreOverrideCursor()
+
+        self.plansTable.setRowCount(len(self.plans))
+        for i, (label, plan) in enumerate(self.plans):
+            self.plansTable.setItem(i, 0, QTableWidgetItem(label))
+            # the last line is the execution time
+            summary = plan[-1].strip() if len(plan) > 0 else ""
+            item = QTableWidgetItem(summary)
+            if plan_uses_seq_scan(plan, self.audit_table):
+                item.setText("Sequential scan - " + summary)
+                item.setBackground(QBrush(QColor("#ff8888")))
+            self.plansTable.setItem(i, 1, item)
+        self.plansTable.resizeColumnToContents(0)
+        if len(self.plans) > 0:
+            self.plansTable.setCurrentCell(0, 0)
+
+    def onPlanSelected(self, row, column, previous_row, previous_column):
+        if row < 0 or row >= len(self.plans):
+            self.planText.setPlainText("")
+            return
+        self.planText.setPlainText("\n".join(self.plans[row][1]))
+
+    def onCreateIndexes(self):
+        statements = []
+        for i, (columns, usage, s) in enumerate(self.recommendations):
+            if self.recommendationsTable.item(i, 0).checkState() == Qt.Checked:
+                statements += s
+        if len(statements) == 0:
+            return
+
+        r = QMessageBox.question(self, "Create indexes",
+                                 "The following statements will be run, it may take a while on a big audit table:\n\n" +
+                                 statements_text(self.connection_wrapper.psycopg2Connection, statements))
+        if r != QMessageBox.Yes:
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            run_outside_transaction(
+                self.connection_wrapper.psycopg2Connection, statements)
+        except Error as e:
+            QMessageBox.critical(self, "Create indexes", str(e))
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        self.refresh()
@@ -0,0 +1,159 @@
+"""
+/**
+ *   Copyright (C) 2016 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from .search_query import execute_prepared
+
+# Keyset (seek) pagination of the audit events.
+#
+# Events are ordered by (action_tstamp_clk, event_id) descending, or by
+# another sort key of the search (see SearchQuery.sortBy()) and event_id. A
+# page is fetched with a "WHERE (action_tstamp_clk, event_id) < last key
+# LIMIT n" query, so that each page costs an index range scan whatever its
+# depth, and no cursor nor transaction has to be kept open between two
+# pages.
+#
+# The pager exposes fetchmany() / close() like a dbapi2 cursor, so that it
+# can feed an EventModel the same way a server-side cursor does.
+#
+# Page queries only differ by their parameters, they are prepared once per
+# connection.
+
+
+class KeysetPager():
+
+    def __init__(self, connection_wrapper, columns, search, page_size=1000):
+        """Constructor.
+        @param connection_wrapper connection wrapper (dbapi2)
+        @param columns list of selected column expressions, the first one must be event_id, the sort column of the search must be selected
+        @param search SearchQuery with the filters of the events
+        @param page_size number of events per page
+        """
+        self.connection_wrapper = connection_wrapper
+        self.columns = columns
+        self.search = search
+        self.page_size = page_size
+        self.closed = False
+
+        # Page boundaries: list of (first key, last key) of each fetched page.
+        # A key is a (sort value, event_id) tuple.
+        self.boundaries = []
+        self.sort_index = columns.index(search.sortColumn())
+
+        # Key of the first event, None for the most recent event.
+        self.start_key = None
+
+    def key(self, row):
+        """(sort value, event_id) key of a row."""
+        value = row[self.sort_index]
+        # NULL values are sorted as empty strings
+        return ("" if value is None else value), row[0]
+
+    def keyOperators(self):
+        """Comparison operators (after, at or after) in the order of the events."""
+        if self.search.descending:
+            return "<", "<="
+        return ">", ">="
+
+    def keyCondition(self, operator, key):
+        """Build a condition on the (sort value, event_id) key.
+        @param operator comparison operator
+        @param key (sort value, event_id) tuple, event_id may be None to compare sort values only
+        @returns (SQL template, values)
+        """
+        value, event_id = key
+        expression = self.search.sortExpression()
+        if event_id is None:
+            return expression + " " + operator + " {}", [value]
+        return "(" + expression + ", event_id) " + operator + " ({}, {})", [value, event_id]
+
+    def fetchPage(self, conditions, limit):
+        """Run a page query.
+        @param conditions list of (operator, key) conditions on the key
+        @param limit maximum number of rows
+        """
+        return self.fetchRows([self.keyCondition(op, key) for op, key in conditions], limit)
+
+    def fetchRows(self, conditions, limit):
+        """Run a query of the events of the search, in their order.
+        @param conditions additional (template, values) conditions
+        @param limit maximum number of rows
+        """
+        cur = self.connection_wrapper.cursor()
+        if cur == None:
+            print("Cannot get cursor for database.")
+            return []
+
+        q, params = self.search.build(", ".join(self.columns), conditions,
+                                      order=True, limit=limit, numbered=True)
+        execute_prepared(cur, q, params)
+        rows = cur.fetchall()
+        cur.close()
+
+        # Do not keep a transaction open between two pages.
+        self.connection_wrapper.rollback()
+
+        return rows
+
+    def fetchmany(self, size=None):
+        """Fetch the next page.
+        @param size maximum number of rows, page_size by default
+        @returns list of rows, an empty list when all events have been fetched
+        """
+        if self.closed:
+            return []
+        after, start = self.keyOperators()
+        conditions = []
+        if len(self.boundaries) > 0:
+            conditions.append((after, self.boundaries[-1][1]))
+        elif self.start_key is not None:
+            conditions.append((start, self.start_key))
+        rows = self.fetchPage(conditions, size or self.page_size)
+        if len(rows) > 0:
+            self.boundaries.append((self.key(rows[0]), self.key(rows[-1])))
+        return rows
+
+    def page(self, page_number):
+        """Fetch again an already fetched page, from its cached boundaries.
+        @param page_number index of the page
+        """
+        first_key, last_key = self.boundaries[page_number]
+        after, start = self.keyOperators()
+        until = ">=" if start == "<=" else "<="
+        return self.fetchPage([(start, first_key), (until, last_key)], self.page_size)
+
+    def events(self, event_ids):
+        """Fetch again events inserted out of the pages, by id, e.g. the new events of a live tail.
+        @param event_ids list of event ids
+        """
+        return self.fetchRows([("event_id = ANY({})", [list(event_ids)])], len(event_ids))
+
+    def pageCount(self):
+        return len(self.boundaries)
+
+    def seek(self, tstamp):
+        """Restart the pagination from the most recent event at or before a date,
+        or from the oldest event at or after it in ascending order.
+        The first page is found by an index range scan on action_tstamp_clk.
+        Only available when the events are sorted by date.
+        @param tstamp a datetime
+        """
+        self.boundaries = []
+        self.start_key = (tstamp, None)
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,93 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .query_worker import QueryWorker
+
+# Streaming of a query result into memory layers.
+#
+# The query is run on its own connection, so that the event dialog can be
+# used meanwhile, and its rows are read from a server-side cursor by
+# batches. Each batch is turned into features by the GUI thread, and the
+# layers are repainted as they grow.
+
+
+class LayerLoader(QObject):
+    # Emitted with the number of rows loaded so far.
+    progress = pyqtSignal(int)
+    # Emitted at the end with the error message, None on success or cancel.
+    finished = pyqtSignal(object)
+
+    def __init__(self, db_connection, batch_size=1000):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param batch_size number of rows transferred at once
+        """
+        QObject.__init__(self)
+        self.batch_size = batch_size
+        self.count = 0
+        self.cursor = None
+        self.worker = QueryWorker(db_connection)
+
+    def addRows(self, rows):
+        """Add a batch of rows to the layers.
+        Must be overridden by the subclasses: the rows are the ones of the
+        query given to start(), and only the subclass knows their columns.
+        Called in the GUI thread.
+        @param rows list of rows, at most batch_size
+        """
+        raise NotImplementedError("{} must override LayerLoader.addRows()".format(type(self).__name__))
+
+    def start(self, query, params):
+        """Run the query and fill the layers in the background."""
+        self.cursor = self.worker.connection_wrapper.namedCursor("history_layer_loader", self.batch_size)
+        if self.cursor == None:
+            self.finish("Cannot get cursor for database.")
+            return
+        cursor = self.cursor
+        self.worker.submit(lambda: cursor.execute(query, params), None, self.onFailed)
+        self.fetchMore()
+
+    def fetchMore(self):
+        cursor = self.cursor
+        batch_size = self.batch_size
+        self.worker.submit(lambda: cursor.fetchmany(batch_size), self.onRowsFetched, self.onFailed)
+
+    def onRowsFetched(self, rows):
+        self.addRows(rows)
+        self.count += len(rows)
+        self.progress.emit(self.count)
+        if len(rows) < self.batch_size:
+            self.finish(None)
+        else:
+            self.fetchMore()
+
+    def onFailed(self, error):
+        if self.cursor is None:
+            return
+        self.finish(error)
+
+    def cancel(self):
+        self.worker.cancel()
+
+    def finish(self, error):
+        # the pending jobs are dropped and the connection closed
+        self.cursor = None
+        self.worker.stop()
+        self.finished.emit(error)
@@ -0,0 +1,154 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import QObject, QSocketNotifier, QTimer, pyqtSignal
+
+from psycopg2 import Error, sql
+
+from .audit_indexes import split_table_name, table_identifier
+from .connection_wrapper import ConnectionWrapper
+
+# Live tail of the audit table.
+#
+# A statement level trigger on the audit table sends a notification with
+# the highest new event id after each statement inserting events, so that a
+# bulk import sends one notification, not one per row. The plugin listens on
+# its own connection, watched by a QSocketNotifier: nothing is polled.
+#
+# Notifications are gathered for LIVE_TAIL_INTERVAL milliseconds before
+# eventsAvailable is emitted, then the dialog fetches the new events in one
+# query.
+
+# Minimum delay between two refreshes of the event list, in milliseconds.
+LIVE_TAIL_INTERVAL = 1000
+
+
+def notify_channel(audit_table):
+    """Name of the notification channel of an audit table."""
+    schema, table = split_table_name(audit_table)
+    return "{}_{}_events".format(schema, table)
+
+
+def notify_trigger_name(audit_table):
+    schema, table = split_table_name(audit_table)
+    return "{}_notify".format(table)
+
+
+def create_notify_trigger_statements(audit_table):
+    """SQL statements installing the notification trigger.
+    Statement level triggers with transition tables need PostgreSQL 10.
+    """
+    schema, table = split_table_name(audit_table)
+    function = sql.Identifier(schema, notify_trigger_name(audit_table))
+    trigger = sql.Identifier(notify_trigger_name(audit_table))
+    return [sql.SQL("CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$ "
+                    "BEGIN "
+                    "PERFORM pg_notify({channel}, (SELECT max(event_id)::text FROM new_events)); "
+                    "RETURN NULL; "
+                    "END $$").format(function=function, channel=sql.Literal(notify_channel(audit_table))),
+            sql.SQL("DROP TRIGGER IF EXISTS {trigger} ON {audit_table}").format(
+                trigger=trigger, audit_table=table_identifier(audit_table)),
+            sql.SQL("CREATE TRIGGER {trigger} AFTER INSERT ON {audit_table} "
+                    "REFERENCING NEW TABLE AS new_events "
+                    "FOR EACH STATEMENT EXECUTE PROCEDURE {function}()").format(
+                trigger=trigger, audit_table=table_identifier(audit_table), function=function)]
+
+
+def has_notify_trigger(cursor, audit_table):
+    """Whether the notification trigger is installed on the audit table."""
+    schema, table = split_table_name(audit_table)
+    cursor.execute("SELECT count(*) FROM pg_trigger t "
+                   "JOIN pg_class c ON c.oid = t.tgrelid "
+                   "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE n.nspname = %s AND c.relname = %s AND t.tgname = %s",
+                   (schema, table, notify_trigger_name(audit_table)))
+    return cursor.fetchone()[0] > 0
+
+
+class LiveTail(QObject):
+    # Emitted with the highest notified event id, at most once per LIVE_TAIL_INTERVAL.
+    eventsAvailable = pyqtSignal(object)
+
+    def __init__(self, db_connection, audit_table, interval=LIVE_TAIL_INTERVAL):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param audit_table the name of the audit table in the database
+        @param interval minimum delay between two eventsAvailable signals, in milliseconds
+        """
+        QObject.__init__(self)
+        self.notifier = None
+        self.newest = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.onTimeout)
+
+        # Notifications are received on a dedicated connection, out of any transaction.
+        self.connection_wrapper = ConnectionWrapper()
+        self.connection_wrapper.disableTransactionGroup(True)
+        self.connection_wrapper.openConnection(db_connection)
+        connection = self.connection_wrapper.psycopg2Connection
+        if connection is None:
+            return
+        try:
+            connection.autocommit = True
+            cur = connection.cursor()
+            cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(notify_channel(audit_table))))
+            cur.close()
+        except Error as e:
+            print("Cannot listen to the audit table notifications:", e)
+            return
+
+        self.notifier = QSocketNotifier(connection.fileno(), QSocketNotifier.Read)
+        self.notifier.activated.connect(self.onActivated)
+
+    def isValid(self):
+        return self.notifier is not None
+
+    def onActivated(self, unused):
+        connection = self.connection_wrapper.psycopg2Connection
+        try:
+            connection.poll()
+        except Error as e:
+            print("Live tail stopped:", e)
+            self.close()
+            return
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            try:
+                event_id = int(notify.payload)
+            except ValueError:
+                continue
+            self.newest = event_id if self.newest is None else max(self.newest, event_id)
+        if self.newest is not None and not self.timer.isActive():
+            self.timer.start()
+
+    def onTimeout(self):
+        if self.newest is None:
+            return
+        newest = self.newest
+        self.newest = None
+        self.eventsAvailable.emit(newest)
+
+    def close(self):
+        self.timer.stop()
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            self.notifier = None
+        self.connection_wrapper.closeConnection()
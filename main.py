@@ -23,9 +23,10 @@ from . import name as plugin_name
 
 from PyQt5.QtCore import QSettings
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QAction, QMessageBox
+from PyQt5.QtWidgets import QAction, QMessageBox, QProgressDialog
 
-from qgis.core import QgsProject
+from qgis.core import QgsProject, QgsCoordinateReferenceSystem, QgsMapLayer
+from qgis.gui import QgsGui, QgsMapLayerAction
 
 from psycopg2 import Error
 
@@ -33,7 +34,12 @@ import psycopg2
 
 from .event_dialog import EventDialog
 from .config_dialog import ConfigDialog
-from .connection_wrapper import ConnectionWrapper
+from .timeline_dialog import TimelineDialog
+from .time_travel import TimeTravelLoader
+from .result_layer import ResultLayerLoader
+from .event_export import EventExporter
+from .connection_wrapper import ConnectionWrapper, ConnectionPool, ROLE_READ, ROLE_WRITE
+from .table_metadata import MetadataCache
 
 PLUGIN_PATH = os.path.dirname(__file__)
 
@@ -69,6 +75,56 @@ def set_project_audit_table(audit_table):
     QgsProject.instance().writeEntry("HistoryViewer", "audit_table", audit_table)
 
 
+def project_fetch_size():
+    fetch_size, ok = QgsProject.instance().readNumEntry(
+        "HistoryViewer", "fetch_size", 1000)
+    return fetch_size
+
+
+def set_project_fetch_size(fetch_size):
+    QgsProject.instance().writeEntry("HistoryViewer", "fetch_size", fetch_size)
+
+
+def project_pagination():
+    pagination, ok = QgsProject.instance().readEntry(
+        "HistoryViewer", "pagination", "keyset")
+    return pagination
+
+
+def set_project_pagination(pagination):
+    QgsProject.instance().writeEntry("HistoryViewer", "pagination", pagination)
+
+
+def project_estimate_count():
+    estimate_count, ok = QgsProject.instance().readBoolEntry(
+        "HistoryViewer", "estimate_count", False)
+    return estimate_count
+
+
+def set_project_estimate_count(estimate_count):
+    QgsProject.instance().writeEntry("HistoryViewer", "estimate_count", estimate_count)
+
+
+def project_level_of_detail():
+    level_of_detail, ok = QgsProject.instance().readBoolEntry(
+        "HistoryViewer", "level_of_detail", False)
+    return level_of_detail
+
+
+def set_project_level_of_detail(level_of_detail):
+    QgsProject.instance().writeEntry("HistoryViewer", "level_of_detail", level_of_detail)
+
+
+def project_max_events():
+    max_events, ok = QgsProject.instance().readNumEntry(
+        "HistoryViewer", "max_events", 100000)
+    return max_events
+
+
+def set_project_max_events(max_events):
+    QgsProject.instance().writeEntry("HistoryViewer", "max_events", max_events)
+
+
 def project_table_map():
     # get table_map
     table_map_strs, ok = QgsProject.instance().readListEntry(
@@ -87,11 +143,25 @@ class Plugin():
     def __init__(self, iface):
         self.iface = iface
 
+        # Pool of direct connections, one per role.
+        self.connection_pool = ConnectionPool()
+
         # Create database connection wrappers.
         self.connection_wrapper_read = ConnectionWrapper()
         self.connection_wrapper_read.disableTransactionGroup(True)
+        self.connection_wrapper_read.setConnectionPool(self.connection_pool, ROLE_READ)
 
+        # Transaction group if available, pooled writer connection otherwise.
         self.connection_wrapper_write = ConnectionWrapper()
+        self.connection_wrapper_write.setConnectionPool(self.connection_pool, ROLE_WRITE)
+
+        self.dlg = None
+
+        # Layers being loaded in the background.
+        self.layer_loaders = []
+
+        # Table metadata, shared by the dialogs.
+        self.metadata = MetadataCache()
 
     def initGui(self):
         self.listEventsAction = QAction(QIcon(os.path.join(
@@ -106,12 +176,36 @@ class Plugin():
         self.configureAction.triggered.connect(self.onConfigure)
         self.iface.addPluginToMenu(plugin_name(), self.configureAction)
 
+        self.refreshMetadataAction = QAction(
+            u"Refresh table metadata", self.iface.mainWindow())
+        self.refreshMetadataAction.triggered.connect(self.onRefreshMetadata)
+        self.iface.addPluginToMenu(plugin_name(), self.refreshMetadataAction)
+
+        # Feature action of the identify results and of the attribute tables.
+        self.timelineAction = QgsMapLayerAction(
+            u"Feature timeline", self.iface.mainWindow(), QgsMapLayer.VectorLayer,
+            QgsMapLayerAction.SingleFeature, QIcon(os.path.join(PLUGIN_PATH, "icons", "qaudit-64.png")))
+        self.timelineAction.triggeredForFeature.connect(self.onTimelineActionTriggered)
+        QgsGui.mapLayerActionRegistry().addMapLayerAction(self.timelineAction)
+
     def unload(self):
         self.iface.removeToolBarIcon(self.listEventsAction)
         self.iface.removePluginMenu(plugin_name(), self.listEventsAction)
         self.iface.removePluginMenu(plugin_name(), self.configureAction)
-
-    def onListEvents(self, layer_id=None, feature_id=None):
+        self.iface.removePluginMenu(plugin_name(), self.refreshMetadataAction)
+        QgsGui.mapLayerActionRegistry().removeMapLayerAction(self.timelineAction)
+
+        if self.dlg is not None:
+            self.dlg.close()
+        for loader in list(self.layer_loaders):
+            loader.cancel()
+        self.connection_wrapper_read.closeConnection()
+        self.connection_wrapper_write.closeConnection()
+        self.connection_pool.close()
+
+    # List the events, optionally of a layer and a feature.
+    # With timeline, only the timeline of the feature is shown.
+    def onListEvents(self, layer_id=None, feature_id=None, timeline=False):
         # Get database connection string.
         db_connection = database_connection_string()
         if not db_connection:
@@ -123,17 +217,16 @@ class Plugin():
             if r == 1:
                 self.connection_wrapper_read.closeConnection()
                 self.connection_wrapper_write.closeConnection()
-                self.onListEvents(layer_id, feature_id)
+                self.onListEvents(layer_id, feature_id, timeline)
 
             return
 
-        # Create database connections.
-        self.connection_wrapper_read.openConnection(db_connection)
-
-        # Reuse read connection for write direct connection.
-        self.connection_wrapper_write.psycopg2Connection = self.connection_wrapper_read.psycopg2Connection
-        self.connection_wrapper_write.db_source = self.connection_wrapper_read.db_source
+        # Create database connections, credentials are asked once for the pool.
+        if not self.connection_pool.open(db_connection):
+            print("No database connection established.")
+            return
 
+        self.connection_wrapper_read.openConnection(db_connection)
         self.connection_wrapper_write.openConnection(db_connection)
 
         # Database connection has failed.
@@ -144,6 +237,17 @@ class Plugin():
         # Database connection success.
         table_map = project_table_map()
 
+        # Reload the table metadata if the schema has changed.
+        self.metadata.refreshIfChanged(self.connection_wrapper_read)
+
+        if timeline and layer_id is not None and feature_id is not None:
+            self.showTimeline(layer_id, feature_id)
+            return
+
+        # The background connections of the pool are used by one dialog at a time.
+        if self.dlg is not None:
+            self.dlg.close()
+
         self.dlg = EventDialog(self.iface.mainWindow(),
                                self.connection_wrapper_read,
                                self.connection_wrapper_write,
@@ -152,7 +256,18 @@ class Plugin():
                                replay_function=project_replay_function(),
                                table_map=table_map,
                                selected_layer_id=layer_id,
-                               selected_feature_id=feature_id)
+                               selected_feature_id=feature_id,
+                               fetch_size=project_fetch_size(),
+                               pagination=project_pagination(),
+                               estimate_count=project_estimate_count(),
+                               level_of_detail=project_level_of_detail(),
+                               metadata=self.metadata,
+                               connection_pool=self.connection_pool,
+                               max_events=project_max_events())
+        self.dlg.timelineRequested.connect(self.showTimeline)
+        self.dlg.timeTravelRequested.connect(self.showTimeTravel)
+        self.dlg.showOnMapRequested.connect(self.showSearchResults)
+        self.dlg.exportRequested.connect(self.exportSearch)
 
         # Populate dialog & catch error if any.
         try:
@@ -167,19 +282,135 @@ class Plugin():
             if r == 1:
                 self.connection_wrapper_read.closeConnection()
                 self.connection_wrapper_write.closeConnection()
-                self.onListEvents(layer_id, feature_id)
+                self.onListEvents(layer_id, feature_id, timeline)
 
             return
 
         self.dlg.show()
 
+    # Show the edit history of a feature, e.g. from a layer action.
+    def onFeatureTimeline(self, layer_id, feature_id):
+        self.onListEvents(layer_id, feature_id, timeline=True)
+
+    # "Feature timeline" action triggered for a feature.
+    # The audited id is the value of the id column, as in the search by id,
+    # or the feature id of layers without such a column.
+    def onTimelineActionTriggered(self, layer, feature):
+        field = layer.fields().indexFromName("id")
+        feature_id = feature.attribute(field) if field >= 0 else feature.id()
+        self.onFeatureTimeline(layer.id(), feature_id)
+
+    def showTimeline(self, layer_id, feature_id):
+        table_name = project_table_map().get(layer_id)
+        if table_name is None:
+            QMessageBox.warning(None, "Feature timeline",
+                                "This layer is not associated to a database table, please check the project configuration")
+            return
+
+        self.timeline_dlg = TimelineDialog(self.iface.mainWindow(),
+                                           self.connection_wrapper_read,
+                                           self.iface.mapCanvas(),
+                                           project_audit_table(),
+                                           table_name,
+                                           feature_id,
+                                           self.metadata)
+        self.timeline_dlg.show()
+
+    # Load the state of a layer at a date in a new memory layer.
+    def showTimeTravel(self, layer_id, tstamp):
+        table_name = project_table_map().get(layer_id)
+        layer = QgsProject.instance().mapLayer(layer_id)
+        if table_name is None or layer is None:
+            QMessageBox.warning(None, "Layer at date",
+                                "This layer is not associated to a database table, please check the project configuration")
+            return
+
+        loader = TimeTravelLoader(self.connection_wrapper_read.connectionString(),
+                                  project_audit_table(),
+                                  layer,
+                                  table_name,
+                                  tstamp,
+                                  self.metadata,
+                                  project_fetch_size())
+        self.runLayerLoader(loader, "Layer at date", "Computing the state of the layer...")
+
+    # Load the geometries of the events of a search in memory layers.
+    def showSearchResults(self, search):
+        geometry_columns = self.metadata.geometryColumnsMap(set(project_table_map().values()))
+        if not any(len(columns) > 0 for columns in geometry_columns.values()):
+            QMessageBox.warning(None, "Show on map",
+                                "No layer with a geometry is associated to a database table, please check the project configuration")
+            return
+
+        loader = ResultLayerLoader(self.connection_wrapper_read.connectionString(),
+                                   search,
+                                   geometry_columns,
+                                   self.iface.mapCanvas().mapSettings().destinationCrs(),
+                                   batch_size=project_fetch_size())
+        self.runLayerLoader(loader, "Show on map", "Searching the events...")
+
+    # Export the events of a search to a file.
+    def exportSearch(self, search, path):
+        # the columns of the rows of the configured tables are exported
+        table_names = sorted(set(project_table_map().values()))
+        tables = [self.metadata.table(t) for t in table_names if self.metadata.table(t) is not None]
+        crs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        if path.lower().endswith(".geojsonl"):
+            # GeoJSON coordinates are longitudes and latitudes
+            crs = QgsCoordinateReferenceSystem("EPSG:4326")
+
+        loader = EventExporter(self.connection_wrapper_read.connectionString(),
+                               search,
+                               path,
+                               self.metadata.geometryColumnsMap(table_names),
+                               tables,
+                               crs,
+                               batch_size=project_fetch_size())
+
+        def onFinished(error):
+            if error is None and loader.complete:
+                self.iface.messageBar().pushInfo("Export", "{} events exported to {}".format(loader.count, path))
+
+        loader.finished.connect(onFinished)
+        self.runLayerLoader(loader, "Export", "Exporting the events...", "events exported")
+
+    # Run a LayerLoader with a progress dialog.
+    def runLayerLoader(self, loader, title, text, progress_text="features loaded"):
+        if not loader.worker.isValid():
+            print("No database connection established.")
+            return
+
+        progress = QProgressDialog(text, "Cancel", 0, 0, self.iface.mainWindow())
+        progress.setWindowTitle(title)
+        progress.canceled.connect(loader.cancel)
+        loader.progress.connect(
+            lambda count: progress.setLabelText("{} {}".format(count, progress_text)))
+
+        def onFinished(error):
+            progress.canceled.disconnect(loader.cancel)
+            progress.close()
+            if error is not None:
+                QMessageBox.critical(None, title, error)
+            self.layer_loaders.remove(loader)
+
+        loader.finished.connect(onFinished)
+        self.layer_loaders.append(loader)
+        progress.show()
+        loader.start()
+
     def onConfigure(self):
         table_map = project_table_map()
         db_connection = database_connection_string()
         audit_table = project_audit_table()
         replay_function = project_replay_function()
+        fetch_size = project_fetch_size()
+        pagination = project_pagination()
+        estimate_count = project_estimate_count()
+        level_of_detail = project_level_of_detail()
+        max_events = project_max_events()
         self.config_dlg = ConfigDialog(self.iface.mainWindow(
-        ), db_connection, audit_table, table_map, replay_function)
+        ), db_connection, audit_table, table_map, replay_function, fetch_size, pagination, estimate_count, level_of_detail,
+            metadata=self.metadata, max_events=max_events)
         r = self.config_dlg.exec_()
 
         if r == 1:
@@ -188,5 +419,16 @@ class Plugin():
             set_project_table_map(self.config_dlg.table_map())
             set_project_audit_table(self.config_dlg.audit_table())
             set_project_replay_function(self.config_dlg.replay_function())
+            set_project_fetch_size(self.config_dlg.fetch_size())
+            set_project_pagination(self.config_dlg.pagination())
+            set_project_estimate_count(self.config_dlg.estimate_count())
+            set_project_level_of_detail(self.config_dlg.level_of_detail())
+            set_project_max_events(self.config_dlg.max_events())
 
         return r
+
+    def onRefreshMetadata(self):
+        self.metadata.invalidate()
+        # reloaded when the next dialog is opened otherwise
+        if self.connection_wrapper_read.isValid():
+            self.metadata.load(self.connection_wrapper_read)
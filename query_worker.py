@@ -0,0 +1,180 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from psycopg2 import Error, OperationalError, InterfaceError
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+
+from .connection_wrapper import ConnectionWrapper
+
+# Background query execution.
+#
+# A QueryWorker owns a database connection and a thread. Jobs are
+# Python callables submitted from the GUI thread with submit(); they are run
+# one after the other in the worker thread and their result is given back to
+# a callback in the GUI thread, so that the QGIS main window never blocks on
+# a query.
+#
+# cancel() interrupts the running query on the backend and drops all the
+# pending jobs. A job failing on a broken connection reconnects it for the
+# next jobs.
+
+
+class JobRunner(QObject):
+    # job id, result
+    jobFinished = pyqtSignal(int, object)
+    # job id, error message
+    jobFailed = pyqtSignal(int, str)
+
+    def __init__(self, connection_wrapper):
+        QObject.__init__(self)
+        self.connection_wrapper = connection_wrapper
+        # Jobs up to this id have been canceled.
+        self.canceled_serial = 0
+
+    @pyqtSlot(int, object)
+    def run(self, job_id, function):
+        if job_id <= self.canceled_serial:
+            return
+        try:
+            result = function()
+        except (OperationalError, InterfaceError) as e:
+            # The connection may be broken, or the query canceled.
+            try:
+                if self.connection_wrapper.checkConnection():
+                    self.connection_wrapper.rollback()
+            except Error:
+                pass
+            self.jobFailed.emit(job_id, str(e))
+            return
+        except Error as e:
+            # Leave the aborted transaction.
+            try:
+                self.connection_wrapper.rollback()
+            except Error:
+                pass
+            self.jobFailed.emit(job_id, str(e))
+            return
+        self.jobFinished.emit(job_id, result)
+
+
+class QueryWorker(QObject):
+    # Internal: a job sent to the worker thread.
+    jobSubmitted = pyqtSignal(int, object)
+
+    # Emitted when the worker starts or stops running jobs.
+    busyChanged = pyqtSignal(bool)
+
+    def __init__(self, db_connection, connection_pool=None, role=None):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param connection_pool ConnectionPool the connection is taken from, None to open a new connection
+        @param role role of the connection in the pool
+        """
+        QObject.__init__(self)
+
+        # The connection is opened here, in the GUI thread, so that the
+        # credentials dialog can be shown if needed.
+        self.connection_wrapper = ConnectionWrapper()
+        self.connection_wrapper.disableTransactionGroup(True)
+        if connection_pool is not None:
+            self.connection_wrapper.setConnectionPool(connection_pool, role)
+        self.connection_wrapper.openConnection(db_connection)
+
+        # Decode row_data and changed_fields as dicts.
+        self.connection_wrapper.registerHstore()
+
+        # job id => (callback, errback)
+        self.callbacks = {}
+        self.serial = 0
+
+        self.thread = QThread()
+        self.runner = JobRunner(self.connection_wrapper)
+        self.runner.moveToThread(self.thread)
+        self.jobSubmitted.connect(self.runner.run)
+        self.runner.jobFinished.connect(self.onJobFinished)
+        self.runner.jobFailed.connect(self.onJobFailed)
+        self.thread.start()
+
+    def isValid(self):
+        return self.connection_wrapper.isValid()
+
+    def isBusy(self):
+        return len(self.callbacks) > 0
+
+    def submit(self, function, callback=None, errback=None):
+        """Run a function in the worker thread.
+        @param function callable without argument, run in the worker thread
+        @param callback called in the GUI thread with the result of the function
+        @param errback called in the GUI thread with the error message, or None if the job has been canceled
+        @returns the job id
+        """
+        self.serial += 1
+        was_busy = self.isBusy()
+        self.callbacks[self.serial] = (callback, errback)
+        self.jobSubmitted.emit(self.serial, function)
+        if not was_busy:
+            self.busyChanged.emit(True)
+        return self.serial
+
+    def onJobFinished(self, job_id, result):
+        if job_id not in self.callbacks:
+            # canceled job
+            return
+        callback, errback = self.popCallbacks(job_id)
+        if callback is not None:
+            callback(result)
+
+    def onJobFailed(self, job_id, message):
+        if job_id not in self.callbacks:
+            # canceled job
+            return
+        callback, errback = self.popCallbacks(job_id)
+        if errback is not None:
+            errback(message)
+        else:
+            print("Background query failed:", message)
+
+    def popCallbacks(self, job_id):
+        callbacks = self.callbacks.pop(job_id)
+        if not self.isBusy():
+            self.busyChanged.emit(False)
+        return callbacks
+
+    def cancel(self):
+        """Cancel the running query and drop the pending jobs."""
+        self.runner.canceled_serial = self.serial
+
+        if self.isBusy() and self.connection_wrapper.psycopg2Connection != None:
+            # Thread-safe, interrupts the query running on the backend.
+            self.connection_wrapper.psycopg2Connection.cancel()
+
+        callbacks = self.callbacks
+        self.callbacks = {}
+        for callback, errback in callbacks.values():
+            if errback is not None:
+                errback(None)
+        if len(callbacks) > 0:
+            self.busyChanged.emit(False)
+
+    def stop(self):
+        """Cancel the pending jobs, stop the thread and close (or release) the connection."""
+        self.cancel()
+        self.thread.quit()
+        self.thread.wait()
+        self.connection_wrapper.closeConnection()
@@ -0,0 +1,128 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from PyQt5.QtGui import QColor
+
+from qgis.core import (QgsVectorLayer, QgsFeature, QgsProject, QgsWkbTypes,
+                       QgsSymbol, QgsRendererCategory, QgsCategorizedSymbolRenderer)
+
+from psycopg2 import sql
+
+from .event_dialog import wkb_to_geom
+from .layer_loader import LayerLoader
+
+# Geometries of all the events of a search, in memory layers.
+#
+# The main geometry of each event is read from its hstores by the database:
+# the new geometry for an insert or an update, the old one for a delete. It
+# is transformed to the SRID of the map. Events are streamed by batches in
+# one memory layer per geometry type, styled by action.
+
+ACTION_NAMES = {'I': "insert", 'U': "update", 'D': "delete"}
+ACTION_COLORS = {'I': "#33a02c", 'U': "#ff7f00", 'D': "#e31a1c"}
+
+FIELDS = "field=event_id:long&field=date:datetime&field=table:string&field=action:string&field=user:string"
+
+MULTI_TYPES = {QgsWkbTypes.PointGeometry: "MultiPoint",
+               QgsWkbTypes.LineGeometry: "MultiLineString",
+               QgsWkbTypes.PolygonGeometry: "MultiPolygon"}
+
+
+def geometry_select(geometry_columns, srid):
+    """Select list of the events with their main geometry.
+    @param geometry_columns dict table_name => geometry columns, the first one is the "main" geometry column
+    @param srid SRID the geometries are transformed to
+    @returns (select list, condition) with the condition keeping the events with a geometry
+    """
+    key = sql.SQL("CASE schema_name || '.' || table_name {} END").format(
+        sql.SQL(" ").join([sql.SQL("WHEN {} THEN {}").format(sql.Literal(t), sql.Literal(columns[0]))
+                           for t, columns in sorted(geometry_columns.items()) if len(columns) > 0]))
+    geometry = sql.SQL(
+        "((CASE WHEN action = 'U' THEN row_data || coalesce(changed_fields, ''::hstore) "
+        "ELSE row_data END) -> ({}))::geometry").format(key)
+    select = sql.SQL(
+        "event_id, action_tstamp_clk, schema_name || '.' || table_name, action, session_user_name, "
+        "(SELECT ST_AsBinary(CASE WHEN ST_SRID(s.g) IN (0, {srid}) THEN s.g ELSE ST_Transform(s.g, {srid}) END) "
+        "FROM (SELECT {geometry} AS g) AS s)").format(srid=sql.Literal(int(srid)), geometry=geometry)
+    return select, ("(row_data -> ({})) IS NOT NULL", [key])
+
+
+def action_renderer(geometry_type):
+    categories = []
+    for action in ('I', 'U', 'D'):
+        symbol = QgsSymbol.defaultSymbol(geometry_type)
+        symbol.setColor(QColor(ACTION_COLORS[action]))
+        categories.append(QgsRendererCategory(action, symbol, ACTION_NAMES[action]))
+    return QgsCategorizedSymbolRenderer("action", categories)
+
+
+class ResultLayerLoader(LayerLoader):
+
+    def __init__(self, db_connection, search, geometry_columns, crs, name="Search results", batch_size=1000):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param search SearchQuery of the events
+        @param geometry_columns dict table_name => geometry columns, for the tables of the events
+        @param crs QgsCoordinateReferenceSystem of the layers, usually the one of the map
+        @param name name of the layers, suffixed by the geometry type
+        @param batch_size number of events transferred at once
+        """
+        LayerLoader.__init__(self, db_connection, batch_size)
+        self.crs = crs
+        self.name = name
+        srid = crs.postgisSrid() or 4326
+        select, condition = geometry_select(geometry_columns, srid)
+        self.query, self.params = search.build(select, [condition])
+        # geometry type => memory layer, created when a first geometry of this type is read
+        self.layers = {}
+
+    def start(self):
+        LayerLoader.start(self, self.query, self.params)
+
+    def layer(self, geometry_type):
+        layer = self.layers.get(geometry_type)
+        if layer is None:
+            uri = "{}?crs={}&{}".format(MULTI_TYPES[geometry_type], self.crs.authid(), FIELDS)
+            layer = QgsVectorLayer(uri, "{} ({})".format(
+                self.name, QgsWkbTypes.geometryDisplayString(geometry_type)), "memory")
+            layer.setRenderer(action_renderer(geometry_type))
+            QgsProject.instance().addMapLayer(layer)
+            self.layers[geometry_type] = layer
+        return layer
+
+    def addRows(self, rows):
+        # geometry type => features
+        features = {}
+        for event_id, tstamp, table_name, action, user, wkb in rows:
+            if wkb is None:
+                continue
+            g = wkb_to_geom(bytes(wkb))
+            geometry_type = g.type()
+            if geometry_type not in MULTI_TYPES:
+                continue
+            g.convertToMultiType()
+            f = QgsFeature()
+            f.setAttributes([event_id, tstamp, table_name, action, user])
+            f.setGeometry(g)
+            features.setdefault(geometry_type, []).append(f)
+
+        for geometry_type, fs in features.items():
+            layer = self.layer(geometry_type)
+            layer.dataProvider().addFeatures(fs)
+            layer.updateExtents()
+            layer.triggerRepaint()
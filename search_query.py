@@ -0,0 +1,243 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import hashlib
+import weakref
+
+from psycopg2 import sql
+
+from .audit_indexes import data_filter, table_identifier
+
+# Parameterized queries of the event searches.
+#
+# A SearchQuery holds the filters of a search as SQL templates, with a {}
+# field for each value. Values are never formatted in the SQL text: they
+# are sent as query parameters, and the audit table name is quoted as an
+# identifier.
+#
+# A search with the same kinds of filters gives the same SQL text whatever
+# the values, so that execute_prepared() prepares it once per connection and
+# PostgreSQL reuses its plan for the next pages and the next searches.
+# Values given as sql.Composable are inlined in the SQL text, for the
+# conditions that must match the predicate of a partial index.
+#
+# This module does not depend on QGIS.
+
+# Columns of the event list query, event_id first as the tie-breaker of the
+# pagination key.
+# row_data and changed_fields are fetched on demand through a DetailCache.
+EVENT_COLUMNS = ["event_id",
+                 "action_tstamp_clk",
+                 "schema_name || '.' || table_name",
+                 "action",
+                 "application_name",
+                 "session_user_name"]
+
+# Actions recorded by the audit trigger.
+ACTIONS = ['I', 'U', 'D']
+
+# Sort keys of the event list: key => (selected column, sort expression).
+# Events are ordered by the sort expression, then by event_id, so that a
+# (sort value, event_id) pair is a unique key for keyset pagination. NULL
+# values are sorted as empty strings, to be comparable in keyset conditions.
+SORT_KEYS = {"date": ("action_tstamp_clk", "action_tstamp_clk"),
+             "table": ("schema_name || '.' || table_name", "schema_name || '.' || table_name"),
+             "action": ("action", "action"),
+             "application": ("application_name", "coalesce(application_name, '')"),
+             "user": ("session_user_name", "coalesce(session_user_name, '')")}
+
+
+class SearchQuery():
+
+    def __init__(self, audit_table):
+        """Constructor.
+        @param audit_table the name of the audit table in the database
+        """
+        self.audit_table = audit_table
+        # list of (SQL template with a {} field per value, values)
+        self.conditions = []
+        # key of SORT_KEYS and direction of the order
+        self.sort_key = "date"
+        self.descending = True
+
+    def isEmpty(self):
+        return len(self.conditions) == 0
+
+    def addCondition(self, template, *values):
+        """Add a filter.
+        @param template SQL expression with a {} field for each value
+        @param values values of the fields
+        """
+        self.conditions.append((template, list(values)))
+        return self
+
+    def filterTable(self, schema, table):
+        return self.addCondition("schema_name = {} AND table_name = {}", schema, table)
+
+    def filterApplication(self, application):
+        return self.addCondition("coalesce(application_name, '') = {}", application)
+
+    def filterUser(self, user):
+        return self.addCondition("coalesce(session_user_name, '') = {}", user)
+
+    def filterFeatureId(self, feature_id):
+        return self.addCondition("row_data->'id' = {}", str(feature_id))
+
+    def filterActions(self, actions):
+        """@param actions list of 'I', 'U' or 'D', all of them is no filter"""
+        if set(actions) == set(ACTIONS):
+            return self
+        return self.addCondition("action = ANY({}::text[])", list(actions))
+
+    def filterAfter(self, tstamp):
+        return self.addCondition("action_tstamp_clk > {}", tstamp)
+
+    def filterBefore(self, tstamp):
+        return self.addCondition("action_tstamp_clk < {}", tstamp)
+
+    def filterData(self, value, index_kind=None):
+        """Filter on a text contained in the values of row_data.
+        @param index_kind kind of the data index of the audit table, see audit_indexes
+        """
+        template, values = data_filter(value, index_kind)
+        return self.addCondition(template, *values)
+
+    def filterGeometry(self, schema, table, column, srid, bbox, wkt=None):
+        """Filter on the geometry of the rows of a table.
+        The table and the column are inlined, so that the partial expression
+        index of audit_indexes.spatial_index_statement() can be used.
+        @param column geometry column of the table
+        @param srid SRID of the geometry column
+        @param bbox (xmin, ymin, xmax, ymax) in the SRID of the column
+        @param wkt WKT of a polygon the geometries must intersect, None to filter on the bounding box only
+        """
+        geometry = "(row_data -> {})::geometry"
+        template = ("schema_name = {} AND table_name = {} AND " + geometry +
+                    " && ST_MakeEnvelope({}, {}, {}, {}, {})")
+        values = [sql.Literal(schema), sql.Literal(table), sql.Literal(column)] + \
+            [float(v) for v in bbox] + [int(srid)]
+        if wkt is not None:
+            template += " AND ST_Intersects(" + geometry + ", ST_GeomFromText({}, {}))"
+            values += [sql.Literal(column), wkt, int(srid)]
+        return self.addCondition(template, *values)
+
+    def sortBy(self, sort_key, descending=True):
+        """Set the order of the events.
+        @param sort_key key of SORT_KEYS
+        @param descending whether the highest values come first
+        """
+        self.sort_key = sort_key
+        self.descending = descending
+        return self
+
+    def isSortedByDate(self):
+        """Whether the events are in the default order, most recent first."""
+        return self.sort_key == "date" and self.descending
+
+    def sortColumn(self):
+        """Selected column holding the sort value."""
+        return SORT_KEYS[self.sort_key][0]
+
+    def sortExpression(self):
+        return SORT_KEYS[self.sort_key][1]
+
+    def orderBy(self):
+        direction = " DESC" if self.descending else " ASC"
+        return " ORDER BY " + self.sortExpression() + direction + ", event_id" + direction
+
+    def build(self, select, conditions=[], order=False, limit=None, numbered=False, group_by=None):
+        """Build the query.
+        @param select SQL select list, as a string or a sql.Composable
+        @param conditions additional (template, values) conditions
+        @param order whether events are ordered, see sortBy(), or a SQL ORDER BY list
+        @param limit maximum number of rows, None for no limit
+        @param numbered whether placeholders are $1, $2..., as needed by PREPARE, or %s
+        @param group_by list of expressions the events are grouped by, None for no grouping
+        @returns (sql.Composed query, list of parameters)
+        """
+        params = []
+
+        def placeholder(value):
+            if isinstance(value, sql.Composable):
+                return value
+            params.append(value)
+            if numbered:
+                return sql.SQL("${}".format(len(params)))
+            return sql.Placeholder()
+
+        if not isinstance(select, sql.Composable):
+            select = sql.SQL(select)
+        parts = [sql.SQL("SELECT {} FROM ").format(select),
+                 table_identifier(self.audit_table),
+                 sql.SQL(" l")]
+        wheres = [sql.SQL(template).format(*[placeholder(v) for v in values])
+                  for template, values in self.conditions + list(conditions)]
+        if len(wheres) > 0:
+            parts += [sql.SQL(" WHERE "), sql.SQL(" AND ").join(wheres)]
+        if group_by is not None:
+            parts.append(sql.SQL(" GROUP BY " + ", ".join(group_by)))
+        if isinstance(order, str):
+            parts.append(sql.SQL(" ORDER BY " + order))
+        elif order:
+            parts.append(sql.SQL(self.orderBy()))
+        if limit is not None:
+            parts += [sql.SQL(" LIMIT "), placeholder(int(limit))]
+        return sql.Composed(parts), params
+
+
+# Names of the statements prepared on each connection.
+# Prepared statements live as long as the database session.
+prepared_statements = weakref.WeakKeyDictionary()
+
+
+def statement_name(query_text):
+    return "history_" + hashlib.md5(query_text.encode("utf-8")).hexdigest()[:16]
+
+
+def prepare(cursor, query):
+    """Prepare a query, once per connection.
+    @param cursor a cursor
+    @param query query built with numbered placeholders
+    @returns the name of the prepared statement
+    """
+    connection = cursor.connection
+    query_text = query.as_string(connection)
+    name = statement_name(query_text)
+
+    names = prepared_statements.setdefault(connection, set())
+    if name not in names:
+        cursor.execute("PREPARE {} AS {}".format(name, query_text))
+        names.add(name)
+    return name
+
+
+def execute_statement(name, params):
+    """EXECUTE statement of a prepared statement, with a %s placeholder per parameter."""
+    if len(params) == 0:
+        return "EXECUTE {}".format(name)
+    return "EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(params)))
+
+
+def execute_prepared(cursor, query, params):
+    """Execute a query, preparing it on the first execution on the connection.
+    @param cursor a cursor
+    @param query query built with numbered placeholders
+    @param params list of parameters
+    """
+    name = prepare(cursor, query)
+    cursor.execute(execute_statement(name, params), params)
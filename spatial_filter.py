@@ -0,0 +1,88 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtGui import QColor
+
+from qgis.core import (QgsGeometry, QgsWkbTypes, QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransform, QgsProject)
+from qgis.gui import QgsMapTool, QgsRubberBand
+
+# Spatial filter of the event searches.
+#
+# The events of a table are filtered on the main geometry of their row_data,
+# with a bounding box test that can use a GiST expression index on the audit
+# table (see audit_indexes.spatial_index_statement()), then with an exact
+# intersection test for a drawn polygon.
+
+
+def to_table_crs(geometry, crs, srid):
+    """Transform a geometry to the SRID of a table geometry column.
+    @param geometry QgsGeometry
+    @param crs QgsCoordinateReferenceSystem of the geometry
+    @param srid SRID of the geometry column
+    """
+    g = QgsGeometry(geometry)
+    dest = QgsCoordinateReferenceSystem("EPSG:{}".format(srid))
+    if dest.isValid() and crs.isValid() and dest != crs:
+        g.transform(QgsCoordinateTransform(crs, dest, QgsProject.instance()))
+    return g
+
+
+class PolygonMapTool(QgsMapTool):
+    """Map tool drawing a polygon: left click adds a vertex, right click ends the polygon."""
+
+    # Emitted with the drawn polygon, in the canvas CRS.
+    polygonDrawn = pyqtSignal(QgsGeometry)
+
+    def __init__(self, canvas):
+        QgsMapTool.__init__(self, canvas)
+        self.rubber = QgsRubberBand(canvas, QgsWkbTypes.PolygonGeometry)
+        self.rubber.setColor(QColor(0, 0, 255, 60))
+        self.rubber.setStrokeColor(QColor("#0000ff"))
+        self.rubber.setWidth(2)
+        self.drawing = False
+
+    def canvasMoveEvent(self, e):
+        if self.drawing:
+            self.rubber.movePoint(self.toMapCoordinates(e.pos()))
+
+    def canvasReleaseEvent(self, e):
+        point = self.toMapCoordinates(e.pos())
+        if e.button() == Qt.LeftButton:
+            if not self.drawing:
+                self.rubber.reset(QgsWkbTypes.PolygonGeometry)
+                self.rubber.addPoint(point)
+                self.drawing = True
+            self.rubber.addPoint(point)
+        elif e.button() == Qt.RightButton and self.drawing:
+            self.drawing = False
+            # drop the floating vertex
+            self.rubber.removeLastPoint()
+            if self.rubber.numberOfVertices() >= 3:
+                self.polygonDrawn.emit(self.rubber.asGeometry())
+
+    def clear(self):
+        self.drawing = False
+        self.rubber.reset(QgsWkbTypes.PolygonGeometry)
+
+    def deactivate(self):
+        # an unfinished polygon is dropped
+        if self.drawing:
+            self.clear()
+        QgsMapTool.deactivate(self)
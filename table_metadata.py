@@ -0,0 +1,195 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from psycopg2 import Error
+
+# Metadata of the database tables, shared by the dialogs of the plugin.
+#
+# Columns, column types, primary keys, geometry columns and their SRID are
+# read for all the tables at once from the catalog when the connection is
+# opened. The cache is reloaded by the "Refresh table metadata" action, or
+# when the schema signature (number of relations, of columns and highest
+# relation oid) has changed.
+
+RELATION_KINDS = "('r', 'v', 'm', 'p', 'f')"
+SYSTEM_SCHEMAS = "n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%%'"
+
+
+class TableInfo():
+
+    def __init__(self):
+        # list of (column name, column type), in table order
+        self.columns = []
+        # primary key columns
+        self.primary_key = []
+        # geometry columns, the first one is the "main" geometry column
+        self.geometry_columns = []
+        # geometry column => SRID
+        self.srids = {}
+
+    def columnType(self, column):
+        for name, column_type in self.columns:
+            if name == column:
+                return column_type
+        return None
+
+
+def query_tables(cursor, table_names=None):
+    """Read the metadata of tables from the catalog, in one query.
+    Can be run in a QueryWorker thread.
+    @param cursor a cursor
+    @param table_names list of schema qualified table names, None for all the tables
+    @returns dict table_name => TableInfo, tables that do not exist are not listed
+    """
+    q = "SELECT n.nspname || '.' || c.relname, a.attname, format_type(a.atttypid, a.atttypmod), " \
+        "coalesce(a.attnum = ANY(i.indkey), false), g.srid " \
+        "FROM pg_attribute a " \
+        "JOIN pg_class c ON c.oid = a.attrelid " \
+        "JOIN pg_namespace n ON n.oid = c.relnamespace " \
+        "LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary " \
+        "LEFT JOIN geometry_columns g ON g.f_table_schema = n.nspname " \
+        "AND g.f_table_name = c.relname AND g.f_geometry_column = a.attname " \
+        "WHERE c.relkind IN {} AND a.attnum > 0 AND NOT a.attisdropped AND {}".format(
+            RELATION_KINDS, SYSTEM_SCHEMAS)
+    params = []
+    if table_names is not None:
+        q += " AND n.nspname || '.' || c.relname = ANY(%s)"
+        params.append(list(table_names))
+    q += " ORDER BY n.nspname, c.relname, a.attnum"
+    cursor.execute(q, params)
+
+    tables = {}
+    for table_name, column, column_type, is_pk, srid in cursor.fetchall():
+        info = tables.get(table_name)
+        if info is None:
+            info = tables[table_name] = TableInfo()
+        info.columns.append((column, column_type))
+        if is_pk:
+            info.primary_key.append(column)
+        if srid is not None:
+            info.geometry_columns.append(column)
+            info.srids[column] = srid
+    return tables
+
+
+def schema_signature(cursor):
+    """Cheap summary of the schema, that changes when tables or columns are added or removed."""
+    cursor.execute("SELECT count(*), coalesce(sum(c.relnatts), 0), coalesce(max(c.oid::bigint), 0) "
+                   "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE c.relkind IN {} AND {}".format(RELATION_KINDS, SYSTEM_SCHEMAS), ())
+    return tuple(cursor.fetchone())
+
+
+class MetadataCache():
+
+    def __init__(self):
+        # table_name => TableInfo
+        self.__tables = {}
+        # connection string and schema signature of the loaded metadata
+        self.db_connection = None
+        self.signature = None
+
+    def isLoaded(self):
+        return self.signature is not None
+
+    def load(self, connection_wrapper):
+        """Load the metadata of all the tables.
+        @param connection_wrapper connection wrapper (dbapi2)
+        @returns True on success
+        """
+        cur = connection_wrapper.cursor()
+        if cur == None:
+            return False
+        try:
+            signature = schema_signature(cur)
+            tables = query_tables(cur)
+        except Error as e:
+            print("Cannot read the table metadata:", e)
+            return False
+        finally:
+            cur.close()
+            connection_wrapper.rollback()
+
+        self.__tables = tables
+        self.db_connection = connection_wrapper.connectionString()
+        self.signature = signature
+        return True
+
+    def refreshIfChanged(self, connection_wrapper):
+        """Reload the metadata if they are not loaded, come from another
+        database or if the schema has changed.
+        @returns True if the metadata have been reloaded
+        """
+        if self.isLoaded() and self.db_connection == connection_wrapper.connectionString():
+            cur = connection_wrapper.cursor()
+            if cur == None:
+                return False
+            try:
+                signature = schema_signature(cur)
+            except Error as e:
+                print("Cannot read the schema signature:", e)
+                signature = None
+            finally:
+                cur.close()
+                connection_wrapper.rollback()
+            if signature == self.signature:
+                return False
+        return self.load(connection_wrapper)
+
+    def invalidate(self):
+        self.__tables = {}
+        self.db_connection = None
+        self.signature = None
+
+    def update(self, tables):
+        """Add the metadata of tables read with query_tables()."""
+        self.__tables.update(tables)
+
+    def tableNames(self):
+        return sorted(self.__tables.keys())
+
+    def table(self, table_name):
+        """@returns the TableInfo of a table or None if unknown"""
+        return self.__tables.get(table_name)
+
+    def missing(self, table_names):
+        return [t for t in table_names if t not in self.__tables]
+
+    def geometryColumns(self, table_name):
+        """Geometry columns of a table, the first one is the "main" geometry column."""
+        info = self.__tables.get(table_name)
+        if info is None:
+            return []
+        return info.geometry_columns
+
+    def geometryColumnsMap(self, table_names):
+        """@returns dict table_name => list of geometry columns, for the known tables"""
+        return dict([(t, self.__tables[t].geometry_columns) for t in table_names
+                     if t in self.__tables])
+
+    def srid(self, table_name, column):
+        info = self.__tables.get(table_name)
+        if info is None:
+            return None
+        return info.srids.get(column)
+
+    def primaryKey(self, table_name):
+        info = self.__tables.get(table_name)
+        if info is None:
+            return []
+        return info.primary_key
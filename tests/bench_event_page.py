@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the event list row lookup, scrolling through 100k events.
+
+Run with: python3 tests/bench_event_page.py
+
+EventModel.data() is EventPages.locate() and cell_data() behind a Qt model
+index, this runs them as a view does: for each screen of the scroll, every
+role the item delegate reads is asked for each visible cell. The pages come
+from a synthetic source of 100k events, fetched by pages of 1000 events
+like a KeysetPager, with 500 events inserted one by one on top by a live
+tail. Pages that are not in memory are fetched again from the source, as
+EventModel.refetchPage() does.
+"""
+import importlib.util
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location("event_page", os.path.join(ROOT, "event_page.py"))
+event_page = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(event_page)
+
+# Qt.ItemDataRole values
+DisplayRole, DecorationRole, ToolTipRole, FontRole, TextAlignmentRole = 0, 1, 3, 6, 7
+BackgroundRole, ForegroundRole, CheckStateRole, SizeHintRole, UserRole = 8, 9, 10, 13, 256
+
+# Roles read by QStyledItemDelegate for each painted cell
+PAINT_ROLES = [FontRole, TextAlignmentRole, ForegroundRole, CheckStateRole,
+               DecorationRole, DisplayRole, BackgroundRole, SizeHintRole]
+VISIBLE_ROWS = 40
+COLUMNS = 5
+PAGE_SIZE = 1000
+EVENTS = 100000
+HEAD_EVENTS = 500
+
+
+class SyntheticSource():
+    """Events ordered by date descending, generated on demand."""
+
+    def __init__(self, n):
+        self.n = n
+        self.first = datetime(2017, 5, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+        self.fetched_pages = 0
+
+    def row(self, k):
+        event_id = self.n - k
+        return (event_id, self.first - timedelta(seconds=k), "public.roads_{}".format(k % 7),
+                "IUD"[k % 3], "QGIS", "editor{}".format(k % 3))
+
+    def page(self, page_number):
+        self.fetched_pages += 1
+        first = page_number * PAGE_SIZE
+        return [self.row(k) for k in range(first, min(first + PAGE_SIZE, self.n))]
+
+    def tailRow(self, event_id):
+        """Event inserted after the source was listed."""
+        return (event_id, self.first + timedelta(seconds=event_id - self.n), "public.roads", "I", "QGIS", "editor")
+
+    def events(self, event_ids):
+        self.fetched_pages += 1
+        return [self.tailRow(event_id) for event_id in event_ids]
+
+
+def load(source, max_rows):
+    """Pages of the whole source, then the live tail events inserted on top."""
+    pages = event_page.EventPages(PAGE_SIZE, max_rows)
+    for page_number in range((source.n + PAGE_SIZE - 1) // PAGE_SIZE):
+        pages.store(page_number, event_page.EventPage(source.page(page_number)))
+    for k in range(HEAD_EVENTS):
+        pages.prepend(event_page.EventPage([source.tailRow(source.n + 1 + k)]))
+    return pages
+
+
+def data(pages, source, replayed, row, column, role):
+    # EventModel.data()
+    if role not in event_page.DATA_ROLES:
+        return None
+    located = pages.locate(row)
+    if located is None:
+        # EventModel.requestRow(), run synchronously
+        key = pages.pageKey(row)
+        rows = source.events(pages.headIds(key)) if key < 0 else source.page(key)
+        pages.store(key, event_page.EventPage(rows))
+        return None
+    page, i = located
+    return event_page.cell_data(page, i, column, role, replayed, "italic")
+
+
+def scroll(pages, source, replayed, total_rows):
+    """Paint each screen from the top to the bottom of the list.
+    @returns number of data() calls
+    """
+    calls = 0
+    for first_row in range(0, total_rows - VISIBLE_ROWS + 1, VISIBLE_ROWS):
+        for row in range(first_row, first_row + VISIBLE_ROWS):
+            for column in range(COLUMNS):
+                for role in PAINT_ROLES:
+                    data(pages, source, replayed, row, column, role)
+                    calls += 1
+    return calls
+
+
+def check(pages, source):
+    total_rows = source.n + HEAD_EVENTS
+    for row in [0, HEAD_EVENTS - 1, HEAD_EVENTS, HEAD_EVENTS + PAGE_SIZE, total_rows - 1]:
+        located = pages.locate(row)
+        assert located is not None, row
+        page, i = located
+        expected = source.n + HEAD_EVENTS - row if row < HEAD_EVENTS else source.n - (row - HEAD_EVENTS)
+        assert event_page.cell_data(page, i, 0, UserRole) == expected, row
+
+
+if __name__ == "__main__":
+    total_rows = EVENTS + HEAD_EVENTS
+    for label, max_rows in [("all the events in memory", None),
+                            ("at most 20000 events in memory", 20000)]:
+        source = SyntheticSource(EVENTS)
+        pages = load(source, max_rows)
+        if max_rows is None:
+            check(pages, source)
+        replayed = set(range(1, EVENTS, 97))
+        source.fetched_pages = 0
+        start = time.perf_counter()
+        calls = scroll(pages, source, replayed, total_rows)
+        elapsed = time.perf_counter() - start
+        screens = (total_rows - VISIBLE_ROWS) // VISIBLE_ROWS + 1
+        print("page down through {} rows, {}:".format(total_rows, label))
+        print("  {} repaints of {} rows, {} data() calls".format(screens, VISIBLE_ROWS, calls))
+        print("  total:               {:.2f} s".format(elapsed))
+        print("  per repaint:         {:.3f} ms".format(elapsed / screens * 1000))
+        print("  per data() call:     {:.3f} us".format(elapsed / calls * 1e6))
+        print("  pages fetched again: {}".format(source.fetched_pages))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the hstore decoding of a row.
+
+Run with: python3 tests/bench_hstore.py
+
+The row has 150 short text fields and one geometry of about 2 MB of hex
+EWKB, as a feature with a large polygon. It is also timed without the
+geometry, as DetailCache fetches it when the main geometry column of the
+table is known: the geometry is then sent as WKB, out of the hstores.
+
+When the hstore typecaster of psycopg2.extras is registered on the
+connection, the hstores are decoded by HstoreAdapter.parse() as they are
+fetched, and parse_hstore() returns them unchanged: this is the time to
+look at. HstoreAdapter.parse() is timed on the text of the row without a
+server; the fetch itself, that the typecaster runs on, is not measured.
+parse_hstore() only parses the text when the typecaster cannot be
+registered, it is compared to the regex it replaced.
+"""
+import importlib.util
+import os
+import re
+import timeit
+
+from psycopg2.extras import HstoreAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location("hstore", os.path.join(ROOT, "hstore.py"))
+hstore = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(hstore)
+
+# Parser replaced by hstore.parse_hstore
+old_kv_re = re.compile('"(\\w+)"=>(NULL|""|".*?[^\\\\]")(?:, |$)')
+
+
+def old_parse_hstore(hstore_str):
+    return dict([(m.group(1), None if m.group(2) == 'NULL' else m.group(2).replace('\\"', '"')[1:-1])
+                 for m in re.finditer(old_kv_re, hstore_str)])
+
+
+def sample_row(fields=150, geometry_size=2 * 1024 * 1024):
+    items = ['"field{}"=>"value of the field {}"'.format(i, i) for i in range(fields)]
+    items.append('"comment"=>NULL')
+    if geometry_size is not None:
+        items.append('"geom"=>"{}"'.format("0103000020E6100000" + "0" * geometry_size))
+    return ", ".join(items)
+
+
+def bench(function, row, repeat=5, number=10):
+    return min(timeit.repeat(lambda: function(row), repeat=repeat, number=number)) / number
+
+
+if __name__ == "__main__":
+    for label, row in [("row with its geometry", sample_row()),
+                       ("row without its geometry", sample_row(geometry_size=None))]:
+        decoded = HstoreAdapter.parse(row, None)
+        assert old_parse_hstore(row) == decoded
+        assert hstore.parse_hstore(row) == decoded
+        native = bench(lambda r: HstoreAdapter.parse(r, None), row)
+        old = bench(old_parse_hstore, row)
+        new = bench(hstore.parse_hstore, row)
+        print("{}, {:.1f} kB:".format(label, len(row) / 1024.0))
+        print("  registered typecaster, HstoreAdapter.parse: {:.3f} ms".format(native * 1000))
+        print("  fallback, previous regex:                   {:.3f} ms".format(old * 1000))
+        print("  fallback, parse_hstore:                     {:.3f} ms".format(new * 1000))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import os
+import sys
+
+# The plugin directory is a package whose name depends on the install, it
+# is imported as "history_viewer" for the tests.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "history_viewer" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "history_viewer", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["history_viewer"] = module
+    spec.loader.exec_module(module)
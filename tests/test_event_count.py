@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from history_viewer.event_count import estimate_count
+from history_viewer.search_query import SearchQuery
+
+
+class FakeCursor():
+    """Cursor returning canned rows, recording the executed queries."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+
+def test_all_actions_is_unfiltered():
+    search = SearchQuery("audit.logged_actions").filterActions(['I', 'U', 'D'])
+    assert search.isEmpty()
+
+
+def test_some_actions_is_filtered():
+    search = SearchQuery("audit.logged_actions").filterActions(['I', 'D'])
+    assert not search.isEmpty()
+
+
+def test_unfiltered_estimate_reads_reltuples():
+    search = SearchQuery("audit.logged_actions").filterActions(['D', 'U', 'I'])
+    cursor = FakeCursor([(123456,)])
+    assert estimate_count(cursor, search) == 123456
+    assert len(cursor.queries) == 1
+    assert "reltuples" in cursor.queries[0]
+
+
+def test_never_analyzed_table_falls_back_to_the_plan():
+    search = SearchQuery("audit.logged_actions")
+    cursor = FakeCursor([(-1,), ([{"Plan": {"Plan Rows": 42}}],)])
+    assert estimate_count(cursor, search) == 42
+    assert "reltuples" in cursor.queries[0]
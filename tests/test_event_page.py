@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from history_viewer.event_page import (EventPage, EventPages, DISPLAY_COLUMNS, DATE_FORMAT,
+                                       FONT_ROLE, USER_ROLE, cell_data)
+
+
+def test_display_values():
+    tstamp = datetime(2017, 5, 1, 12, 30)
+    page = EventPage([(7, tstamp, "public.roads", "D", None, "editor")])
+    assert len(page) == 1
+    assert [f(page, 0) for f in DISPLAY_COLUMNS] == \
+        [tstamp.strftime(DATE_FORMAT), "public.roads", "Delete", None, "editor"]
+    assert page.ids[0] == 7
+    assert page.action(0) == "D"
+
+
+def sample_page(first_id, n):
+    tstamp = datetime(2017, 5, 1, 12, 30)
+    return EventPage([(first_id - k, tstamp, "public.roads", "I", None, "editor") for k in range(n)])
+
+
+def test_locate_head_pages():
+    pages = EventPages(page_size=3)
+    pages.store(0, sample_page(10, 3))
+    pages.store(1, sample_page(7, 2))
+    # inserted on top: 11, then 13 and 12
+    pages.prepend(sample_page(11, 1))
+    pages.prepend(sample_page(13, 2))
+    assert pages.headCount() == 3
+    ids = [cell_data(*pages.locate(row), 0, USER_ROLE) for row in range(8)]
+    assert ids == [13, 12, 11, 10, 9, 8, 7, 6]
+    assert pages.locate(8) is None
+    assert pages.firstRow(pages.headKey(0)) == 2
+    assert pages.firstRow(pages.headKey(1)) == 0
+    assert pages.firstRow(1) == 6
+    assert pages.pageKey(1) == pages.headKey(1)
+    assert pages.pageKey(7) == 1
+
+
+def test_memory_ceiling():
+    pages = EventPages(page_size=3, max_rows=6)
+    pages.store(0, sample_page(10, 3))
+    pages.store(1, sample_page(7, 3))
+    pages.locate(0)
+    pages.prepend(sample_page(11, 2))
+    # the least recently used page is dropped
+    assert pages.memoryRows() == 5
+    assert pages.locate(2 + 3) is None
+    assert pages.locate(2) is not None
+    pages.prepend(sample_page(13, 2))
+    # the head pages count too, their ids are kept
+    assert pages.memoryRows() == 5
+    assert pages.locate(2) is None
+    assert list(pages.headIds(pages.pageKey(2))) == [11, 10]
+    assert pages.hasEvent(13) and pages.hasEvent(11) and not pages.hasEvent(5)
+
+
+def test_cell_data_replayed():
+    page = sample_page(10, 2)
+    assert cell_data(page, 1, 0, FONT_ROLE, {9}, "italic") == "italic"
+    assert cell_data(page, 0, 0, FONT_ROLE, {9}, "italic") is None
+    assert cell_data(page, 1, 2, USER_ROLE) == "I"
+    assert cell_data(page, 1, 1, USER_ROLE) is None
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from history_viewer.event_tail import EventTail, parse_snapshot, txid_visible
+
+
+def test_parse_snapshot():
+    assert parse_snapshot("10:20:12,15") == (10, 20, {12, 15})
+    assert parse_snapshot("10:10:") == (10, 10, set())
+
+
+def test_txid_visible():
+    snapshot = parse_snapshot("10:20:12,15")
+    assert txid_visible(9, snapshot)
+    assert txid_visible(13, snapshot)
+    assert not txid_visible(12, snapshot)
+    assert not txid_visible(20, snapshot)
+
+
+def test_conditions():
+    tail = EventTail()
+    assert tail.conditions(100) == [("event_id > {}", [100])]
+    tail.setSnapshot("10:20:12")
+    assert tail.conditions(100, 150) == [
+        ("transaction_id >= {}", [10]),
+        ("NOT txid_visible_in_snapshot(transaction_id, {}::txid_snapshot)", ["10:20:12"]),
+        ("event_id > {}", [150])]
+
+
+def test_late_commit_and_duplicates():
+    tail = EventTail("10:20:12")
+
+    # transaction 12 took event id 5 before transaction 19 and is still running
+    rows = [(6, 2, "public.t", "I", "app", "user", 19, "18:22:12,21"),
+            (7, 3, "public.t", "I", "app", "user", 21, "18:22:12,21")]
+    new_rows = tail.addRows(rows, lambda event_id: False)
+    assert [r[0] for r in new_rows] == [7, 6]
+    assert new_rows[0] == (7, 3, "public.t", "I", "app", "user")
+    tail.endRefresh()
+    assert tail.snapshot == "18:22:12,21"
+    # 21 was committed after the snapshot of the refresh
+    assert tail.fetched == {7}
+
+    # transaction 12 commits: its event is fetched, event 7 is dropped
+    rows = [(5, 1, "public.t", "I", "app", "user", 12, "22:23:"),
+            (7, 3, "public.t", "I", "app", "user", 21, "22:23:")]
+    assert [r[0] for r in tail.addRows(rows, lambda event_id: False)] == [5]
+    tail.endRefresh()
+    assert tail.fetched == set()
+
+
+def test_listed_events_are_dropped():
+    tail = EventTail("10:20:")
+    rows = [(6, 2, "public.t", "I", "app", "user", 15, "18:18:")]
+    assert tail.addRows(rows, lambda event_id: event_id == 6) == []
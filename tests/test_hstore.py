@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from history_viewer.hstore import parse_hstore
+
+
+def test_null_and_empty_values():
+    assert parse_hstore('"a"=>NULL, "b"=>"", "c"=>"1"') == {"a": None, "b": "", "c": "1"}
+
+
+def test_escaped_quotes_and_backslashes():
+    row = '"na\\"me"=>"say \\"hi\\"", "path"=>"C:\\\\tmp\\\\", "x"=>"y"'
+    assert parse_hstore(row) == {'na"me': 'say "hi"', "path": "C:\\tmp\\", "x": "y"}
+
+
+def test_decoded_hstore_is_passed_through():
+    row = {"a": "1"}
+    assert parse_hstore(row) is row
+    assert parse_hstore(None) == {}
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from psycopg2 import sql
+
+from history_viewer.audit_indexes import data_filter, DATA_INDEX_TRGM, DATA_INDEX_TSVECTOR
+from history_viewer.event_replay import (replay_statement, replay_batch_statement, check_replay_statement,
+                                         REPLAY_ERRORS_SETTING)
+from history_viewer.keyset_pager import KeysetPager
+from history_viewer.search_query import SearchQuery, SORT_KEYS, EVENT_COLUMNS, statement_name, execute_statement
+
+
+def render(composable):
+    """SQL text of a query, as as_string() gives it, without a connection to quote the values."""
+    if isinstance(composable, sql.Composed):
+        return "".join([render(c) for c in composable])
+    if isinstance(composable, sql.SQL):
+        return composable.string
+    if isinstance(composable, sql.Identifier):
+        return ".".join(['"' + s + '"' for s in composable.strings])
+    if isinstance(composable, sql.Placeholder):
+        return "%s"
+    if isinstance(composable, sql.Literal):
+        return "'" + str(composable.wrapped) + "'"
+    raise TypeError(composable)
+
+
+def sample_search():
+    return SearchQuery("audit.logged_actions") \
+        .filterTable("public", "roads") \
+        .filterUser("editor") \
+        .filterActions(['I', 'D'])
+
+
+def test_build_unnumbered():
+    q, params = sample_search().build("event_id", limit=10)
+    assert render(q) == \
+        'SELECT event_id FROM "audit"."logged_actions" l ' \
+        'WHERE schema_name = %s AND table_name = %s AND coalesce(session_user_name, \'\') = %s ' \
+        'AND action = ANY(%s::text[]) LIMIT %s'
+    assert params == ["public", "roads", "editor", ['I', 'D'], 10]
+
+
+def test_build_numbered():
+    q, params = sample_search().build("event_id", [("event_id > {}", [42])], order=True, limit=10, numbered=True)
+    assert render(q) == \
+        'SELECT event_id FROM "audit"."logged_actions" l ' \
+        'WHERE schema_name = $1 AND table_name = $2 AND coalesce(session_user_name, \'\') = $3 ' \
+        'AND action = ANY($4::text[]) AND event_id > $5 ' \
+        'ORDER BY action_tstamp_clk DESC, event_id DESC LIMIT $6'
+    # $n is the n-th parameter
+    assert params == ["public", "roads", "editor", ['I', 'D'], 42, 10]
+    assert execute_statement("s", params) == "EXECUTE s (%s, %s, %s, %s, %s, %s)"
+
+
+def test_build_inlines_composable_values():
+    search = SearchQuery("audit.logged_actions").filterGeometry("public", "roads", "geom", 2154, (0, 1, 2, 3))
+    q, params = search.build("event_id", numbered=True)
+    assert "(row_data -> 'geom')::geometry && ST_MakeEnvelope($1, $2, $3, $4, $5)" in render(q)
+    assert params == [0.0, 1.0, 2.0, 3.0, 2154]
+
+
+def test_statement_name_depends_on_the_query_text_only():
+    def page_query(user, after):
+        search = SearchQuery("audit.logged_actions").filterUser(user)
+        q, params = search.build("event_id", [("event_id < {}", [after])], order=True, limit=100, numbered=True)
+        return render(q)
+
+    name = statement_name(page_query("editor", 1000))
+    # other values, same statement
+    assert statement_name(page_query("admin", 5)) == name
+    assert name.startswith("history_") and len(name) == len("history_") + 16
+    # other filters, other statement
+    other = SearchQuery("audit.logged_actions").filterApplication("QGIS")
+    q, params = other.build("event_id", order=True, limit=100, numbered=True)
+    assert statement_name(render(q)) != name
+
+
+@pytest.mark.parametrize("sort_key", sorted(SORT_KEYS.keys()))
+@pytest.mark.parametrize("descending", [True, False])
+def test_keyset_conditions(sort_key, descending):
+    search = SearchQuery("audit.logged_actions").sortBy(sort_key, descending)
+    pager = KeysetPager(None, EVENT_COLUMNS, search)
+    after, start = pager.keyOperators()
+    assert (after, start) == (("<", "<=") if descending else (">", ">="))
+
+    expression = SORT_KEYS[sort_key][1]
+    template, values = pager.keyCondition(after, ("x", 12))
+    assert template == "(" + expression + ", event_id) " + after + " ({}, {})"
+    assert values == ["x", 12]
+    template, values = pager.keyCondition(start, ("x", None))
+    assert template == expression + " " + start + " {}"
+    assert values == ["x"]
+
+    # the key is read from the selected sort column, NULL as an empty string
+    row = [12, "2017-05-01", "public.roads", "I", None, None]
+    value = row[EVENT_COLUMNS.index(SORT_KEYS[sort_key][0])]
+    assert pager.key(row) == (("" if value is None else value), 12)
+
+    # the key condition follows the order of the query
+    q, params = search.build("event_id", [pager.keyCondition(after, ("x", 12))], order=True, numbered=True)
+    direction = "DESC" if descending else "ASC"
+    assert render(q).endswith("WHERE (" + expression + ", event_id) " + after + " ($1, $2) "
+                              "ORDER BY " + expression + " " + direction + ", event_id " + direction)
+
+
+def test_data_filter_plain():
+    template, values = data_filter("50%_off")
+    assert template == "(SELECT string_agg(v,' ') FROM svals(row_data) as v) ILIKE {}"
+    assert values == ["%50\\%\\_off%"]
+
+
+def test_data_filter_trgm():
+    template, values = data_filter('say "hi"', DATA_INDEX_TRGM)
+    assert template.startswith("(row_data::text ILIKE {} AND ")
+    assert template.count("{}") == 2
+    # the indexed text is the hstore text, with escaped quotes, and the
+    # backslashes of these escapes are escaped in the LIKE pattern
+    assert values == ['%say \\\\"hi\\\\"%', '%say "hi"%']
+
+
+def test_data_filter_tsvector():
+    template, values = data_filter("main street", DATA_INDEX_TSVECTOR)
+    assert template.startswith("(to_tsvector('simple', row_data::text) @@ plainto_tsquery('simple', {}) AND ")
+    assert values == ["main street", "%main street%"]
+    # no word to look up in the index
+    template, values = data_filter(" ", DATA_INDEX_TSVECTOR)
+    assert template == data_filter(" ")[0]
+
+
+def test_data_filter_in_search():
+    q, params = SearchQuery("audit.logged_actions").filterData("x", DATA_INDEX_TRGM).build("event_id", numbered=True)
+    assert "(row_data::text ILIKE $1 AND (SELECT string_agg(v,' ') FROM svals(row_data) as v) ILIKE $2)" in render(q)
+    assert params == ["%x%", "%x%"]
+
+
+def test_replay_statement():
+    q = replay_statement("audit.replay_event", [3, 1, 2])
+    assert "FOREACH e IN ARRAY ARRAY[3, 1, 2]::bigint[] LOOP" in q
+    assert "PERFORM audit.replay_event(e);" in q
+    assert "'% of 3 events cannot be replayed:%'" in q
+    assert "errors text[] := '{}';" in q
+    assert q.startswith("DO $replay$") and q.endswith("END $replay$")
+
+
+def test_replay_statement_ids_are_integers():
+    with pytest.raises(ValueError):
+        replay_statement("audit.replay_event", ["1); DROP TABLE roads; --"])
+
+
+def test_replay_batch_statement():
+    q = replay_batch_statement("audit.replay_event", [5, 4])
+    assert "FOREACH e IN ARRAY ARRAY[5, 4]::bigint[] LOOP" in q
+    # errors are recorded, not raised
+    assert "RAISE" not in q
+    assert "set_config('{}', ".format(REPLAY_ERRORS_SETTING) in q
+    assert "current_setting('{}', true)".format(REPLAY_ERRORS_SETTING) in q
+
+
+def test_check_replay_statement():
+    q = check_replay_statement(400)
+    assert "current_setting('{}', true)".format(REPLAY_ERRORS_SETTING) in q
+    assert "'% of 400 events cannot be replayed:%'" in q
@@ -0,0 +1,139 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import QVariant
+
+from qgis.core import QgsVectorLayer, QgsFeature, QgsProject, QgsWkbTypes
+
+from psycopg2 import sql
+
+from .event_dialog import parse_hstore, wkb_to_geom
+from .layer_loader import LayerLoader
+from .search_query import table_identifier
+
+# State of a table at a past date ("time travel").
+#
+# The state is computed by the database in one set-based query: for each
+# primary key, the last event at or before the date is kept, and its row is
+# row_data with changed_fields applied for an update. Features whose last
+# event is a deletion are left out. Only the rows whose insertion has been
+# audited can be rebuilt.
+#
+# The result is streamed from a server-side cursor, in batches, into a
+# read-only memory layer with the fields of the QGIS layer of the table.
+
+
+def state_query(audit_table, table_name, tstamp, primary_key=["id"], geometry_columns=[]):
+    """Build the query of the state of a table at a date.
+    @param audit_table the name of the audit table in the database
+    @param table_name schema qualified name of the table
+    @param tstamp a datetime
+    @param primary_key primary key columns of the table
+    @param geometry_columns geometry columns of the table, the first one is the "main" geometry column
+    @returns (sql.Composed query, dict of parameters), the query returns (attributes, geometry WKB)
+    """
+    schema, table = table_name.split(".", 1)
+    q = sql.SQL(
+        "SELECT s.state - %(geoms)s::text[], ST_AsBinary((s.state -> %(gcol)s::text)::geometry) "
+        "FROM (SELECT DISTINCT ON (l.row_data -> %(pk)s::text[]) l.action, "
+        "CASE WHEN l.action = 'U' THEN l.row_data || coalesce(l.changed_fields, ''::hstore) "
+        "ELSE l.row_data END AS state "
+        "FROM {} l "
+        "WHERE l.schema_name = %(schema)s AND l.table_name = %(table)s "
+        "AND l.action IN ('I', 'U', 'D') AND l.action_tstamp_clk <= %(tstamp)s "
+        "ORDER BY l.row_data -> %(pk)s::text[], l.action_tstamp_clk DESC, l.event_id DESC) AS s "
+        "WHERE s.action <> 'D'").format(table_identifier(audit_table))
+    params = {"geoms": list(geometry_columns),
+              "gcol": geometry_columns[0] if len(geometry_columns) > 0 else None,
+              "pk": list(primary_key),
+              "schema": schema,
+              "table": table,
+              "tstamp": tstamp}
+    return q, params
+
+
+def attribute_value(field, value):
+    """Convert a hstore value to the type of a field."""
+    if value is None:
+        return None
+    t = field.type()
+    try:
+        if t in (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong):
+            return int(value)
+        if t == QVariant.Double:
+            return float(value)
+        if t == QVariant.Bool:
+            return value in ("t", "true", "1")
+    except ValueError:
+        return None
+    return value
+
+
+class TimeTravelLoader(LayerLoader):
+
+    def __init__(self, db_connection, audit_table, layer, table_name, tstamp, metadata=None, batch_size=1000):
+        """Constructor.
+        @param db_connection database connection string, with credentials if needed
+        @param audit_table the name of the audit table in the database
+        @param layer QGIS layer of the table, its fields, geometry type and CRS are used
+        @param table_name schema qualified name of the table
+        @param tstamp a datetime
+        @param metadata MetadataCache with the primary key and the geometry columns of the table
+        @param batch_size number of features transferred at once
+        """
+        # The state may take a while to compute and transfer: it is loaded on
+        # its own connection.
+        LayerLoader.__init__(self, db_connection, batch_size)
+        self.source_layer = layer
+
+        primary_key = ["id"]
+        geometry_columns = []
+        if metadata is not None:
+            primary_key = metadata.primaryKey(table_name) or primary_key
+            geometry_columns = metadata.geometryColumns(table_name)
+        self.query, self.params = state_query(
+            audit_table, table_name, tstamp, primary_key, geometry_columns)
+
+        # read-only memory layer with the fields of the source layer
+        geometry_type = QgsWkbTypes.displayString(layer.wkbType()) if layer.isSpatial() else "None"
+        uri = geometry_type
+        if layer.crs().isValid():
+            uri += "?crs=" + layer.crs().authid()
+        self.layer = QgsVectorLayer(uri, "{} at {}".format(layer.name(), tstamp.strftime("%x %X")), "memory")
+        self.fields = layer.fields()
+        self.layer.dataProvider().addAttributes(self.fields.toList())
+        self.layer.updateFields()
+        self.layer.setReadOnly(True)
+
+    def start(self):
+        """Add the layer to the project and fill it in the background."""
+        QgsProject.instance().addMapLayer(self.layer)
+        LayerLoader.start(self, self.query, self.params)
+
+    def addRows(self, rows):
+        features = []
+        for attributes, wkb in rows:
+            state = parse_hstore(attributes)
+            f = QgsFeature(self.fields)
+            f.setAttributes([attribute_value(field, state.get(field.name())) for field in self.fields])
+            if wkb is not None:
+                f.setGeometry(wkb_to_geom(bytes(wkb)))
+            features.append(f)
+        self.layer.dataProvider().addFeatures(features)
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
@@ -0,0 +1,243 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+import os
+
+from PyQt5 import uic
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import QDialog, QMessageBox, QTableWidgetItem, QVBoxLayout
+
+from qgis.core import QgsGeometry
+from qgis.gui import QgsMapCanvas
+
+from psycopg2 import sql
+
+from .event_dialog import GeometryDisplayer, parse_hstore, wkb_to_geom, reset_table_widget
+from .search_query import table_identifier
+from .query_worker import QueryWorker
+
+FORM_CLASS, _ = uic.loadUiType(os.path.join(
+    os.path.dirname(__file__), 'timeline_dialog.ui'))
+
+# Timeline of the edits of one feature.
+#
+# All the events of the feature are fetched in one query on the
+# row_data->'id' index, oldest first. The state of the feature before and
+# after each event, the list of the changed fields and the geometry after
+# each event are computed by the database, so that moving along the
+# timeline does not need any other query.
+
+ACTION_NAMES = {'I': "insert", 'U': "update", 'D': "delete"}
+
+
+def feature_timeline(cursor, audit_table, table_name, feature_id, geometry_columns=[]):
+    """Query the events of a feature, oldest first.
+    @param cursor a cursor
+    @param audit_table the name of the audit table in the database
+    @param table_name schema qualified name of the table of the feature
+    @param feature_id value of the id column of the feature
+    @param geometry_columns geometry columns of the table, the first one is the "main" geometry column
+    @returns list of (event_id, tstamp, action, user, application, before, after, changed fields, geometry WKB, first WKB)
+    before and after are the attributes without the geometries, the geometry WKB is the state after the event,
+    and the first WKB the state before the event, only for the first event
+    """
+    schema, table = table_name.split(".", 1)
+    main_column = geometry_columns[0] if len(geometry_columns) > 0 else None
+    q = sql.SQL(
+        "SELECT e.event_id, e.action_tstamp_clk, e.action, e.session_user_name, e.application_name, "
+        "s.b - %(geoms)s::text[], s.a - %(geoms)s::text[], "
+        "(SELECT array_agg(k ORDER BY k) "
+        " FROM (SELECT skeys(coalesce(s.b, ''::hstore)) UNION SELECT skeys(coalesce(s.a, ''::hstore))) AS ks(k) "
+        " WHERE k <> ALL(%(geoms)s::text[]) AND (s.b -> k) IS DISTINCT FROM (s.a -> k)), "
+        "ST_AsBinary((s.a -> %(gcol)s::text)::geometry), "
+        "CASE WHEN lag(e.event_id) OVER (ORDER BY e.action_tstamp_clk, e.event_id) IS NULL "
+        "THEN ST_AsBinary((s.b -> %(gcol)s::text)::geometry) END "
+        "FROM {} e, "
+        "LATERAL (SELECT CASE WHEN e.action = 'I' THEN NULL ELSE e.row_data END AS b, "
+        "CASE WHEN e.action = 'D' THEN NULL "
+        "WHEN e.action = 'U' THEN e.row_data || coalesce(e.changed_fields, ''::hstore) "
+        "ELSE e.row_data END AS a) AS s "
+        "WHERE e.schema_name = %(schema)s AND e.table_name = %(table)s AND e.row_data->'id' = %(id)s "
+        "ORDER BY e.action_tstamp_clk, e.event_id").format(table_identifier(audit_table))
+    cursor.execute(q, {"geoms": list(geometry_columns),
+                       "gcol": main_column,
+                       "schema": schema,
+                       "table": table,
+                       "id": str(feature_id)})
+    return cursor.fetchall()
+
+
+class TimelineDialog(QDialog, FORM_CLASS):
+    def __init__(self, parent, connection_wrapper, map_canvas, audit_table, table_name, feature_id, metadata=None):
+        """Constructor.
+        @param parent parent widget
+        @param connection_wrapper connection wrapper (dbapi2)
+        @param map_canvas the main QgsMapCanvas
+        @param audit_table the name of the audit table in the database
+        @param table_name schema qualified name of the table of the feature
+        @param feature_id value of the id column of the feature
+        @param metadata MetadataCache with the geometry columns of the table
+        """
+        super(TimelineDialog, self).__init__(parent)
+        self.setupUi(self)
+
+        self.audit_table = audit_table
+        self.table_name = table_name
+        self.feature_id = feature_id
+        self.geometry_columns = metadata.geometryColumns(table_name) if metadata is not None else []
+
+        self.setWindowTitle("Timeline of feature {} - {}".format(feature_id, table_name))
+
+        # The events are queried in the background, on a connection of the
+        # dialog: the pooled connections may be in use by the event list.
+        self.worker = QueryWorker(connection_wrapper.connectionString())
+
+        # canvas showing the geometry before (old color) and after (new color) the event
+        self.canvas = QgsMapCanvas()
+        self.canvas.setLayers(map_canvas.layers())
+        self.canvas.setDestinationCrs(map_canvas.mapSettings().destinationCrs())
+        self.canvas.setExtent(map_canvas.extent())
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.canvas)
+        self.canvasWidget.setLayout(layout)
+        self.displayer = GeometryDisplayer(self.canvas)
+        self.splitter.setSizes([100, 100])
+
+        # list of (event_id, tstamp, action, user, application, before, after, changed fields)
+        self.events = []
+        # geometry after each event, and before the first one
+        self.geometries = []
+        self.first_geometry = QgsGeometry()
+
+        self.timelineSlider.valueChanged.connect(self.onEventChanged)
+        self.previousButton.clicked.connect(
+            lambda: self.timelineSlider.setValue(self.timelineSlider.value() - 1))
+        self.nextButton.clicked.connect(
+            lambda: self.timelineSlider.setValue(self.timelineSlider.value() + 1))
+        self.changedOnlyChk.toggled.connect(
+            lambda checked: self.onEventChanged(self.timelineSlider.value()))
+
+        self.load()
+
+    def load(self):
+        if not self.worker.isValid():
+            return
+
+        connection_wrapper = self.worker.connection_wrapper
+        audit_table = self.audit_table
+        table_name = self.table_name
+        feature_id = self.feature_id
+        geometry_columns = self.geometry_columns
+
+        def run():
+            cur = connection_wrapper.cursor()
+            try:
+                return feature_timeline(cur, audit_table, table_name, feature_id, geometry_columns)
+            finally:
+                cur.close()
+                connection_wrapper.rollback()
+
+        self.eventLabel.setText("Loading the events of the feature...")
+        self.timelineSlider.setEnabled(False)
+        self.worker.submit(run, self.onLoaded, self.onLoadFailed)
+
+    def onLoadFailed(self, message):
+        if message is None:
+            # canceled
+            return
+        self.eventLabel.setText("")
+        QMessageBox.critical(self, "Feature timeline", message)
+
+    def onLoaded(self, rows):
+        if len(rows) == 0:
+            self.eventLabel.setText("No event for this feature")
+            self.timelineSlider.setEnabled(False)
+            return
+
+        # Decode everything once, the timeline is then browsed without query.
+        extent = None
+        for i, (event_id, tstamp, action, user, application, before, after, changed, wkb, first_wkb) in enumerate(rows):
+            self.events.append((event_id, tstamp, action, user, application,
+                                parse_hstore(before), parse_hstore(after), set(changed or [])))
+            geom = wkb_to_geom(None if wkb is None else bytes(wkb))
+            self.geometries.append(geom)
+            if i == 0:
+                self.first_geometry = wkb_to_geom(None if first_wkb is None else bytes(first_wkb))
+            for g in (geom, self.first_geometry if i == 0 else None):
+                if g is None or g.isEmpty():
+                    continue
+                if extent is None:
+                    extent = g.boundingBox()
+                else:
+                    extent.combineExtentWith(g.boundingBox())
+
+        # The canvas shows the whole life of the feature.
+        if extent is not None:
+            extent.scale(1.5)
+            self.canvas.setExtent(extent)
+
+        self.timelineSlider.setEnabled(True)
+        self.timelineSlider.setRange(0, len(self.events) - 1)
+        self.timelineSlider.setValue(len(self.events) - 1)
+        self.onEventChanged(self.timelineSlider.value())
+
+    def onEventChanged(self, i):
+        if i < 0 or i >= len(self.events):
+            return
+        event_id, tstamp, action, user, application, before, after, changed = self.events[i]
+
+        self.previousButton.setEnabled(i > 0)
+        self.nextButton.setEnabled(i < len(self.events) - 1)
+        self.eventLabel.setText("{}/{} - event {}: {} on {} by {} ({})".format(
+            i + 1, len(self.events), event_id, ACTION_NAMES.get(action, action),
+            tstamp.strftime("%x - %X"), user, application))
+
+        # attributes before and after the event
+        reset_table_widget(self.stateTable)
+        self.stateTable.setColumnCount(3)
+        self.stateTable.setHorizontalHeaderLabels(["Column", "Before", "After"])
+        columns = sorted(set(before.keys()) | set(after.keys()))
+        j = 0
+        for k in columns:
+            if self.changedOnlyChk.isChecked() and k not in changed:
+                continue
+            self.stateTable.insertRow(j)
+            self.stateTable.setItem(j, 0, QTableWidgetItem(k))
+            self.stateTable.setItem(j, 1, QTableWidgetItem(before.get(k)))
+            self.stateTable.setItem(j, 2, QTableWidgetItem(after.get(k)))
+            if k in changed:
+                b = QBrush(QColor("#ff8888"))
+                for c in range(3):
+                    self.stateTable.item(j, c).setBackground(b)
+            j += 1
+        self.stateTable.resizeColumnsToContents()
+
+        # geometry before (old color) and after (new color) the event
+        previous = self.geometries[i - 1] if i > 0 else self.first_geometry
+        current = self.geometries[i]
+        self.displayer.reset()
+        if previous.isEmpty():
+            self.displayer.display(current, zoom=False)
+        else:
+            self.displayer.display(previous, current, zoom=False)
+
+    def done(self, status):
+        self.worker.stop()
+        return QDialog.done(self, status)
@@ -0,0 +1,78 @@
+"""
+/**
+ *   Copyright (C) 2017 Oslandia <infos@oslandia.com>
+ *
+ *   This library is free software; you can redistribute it and/or
+ *   modify it under the terms of the GNU Library General Public
+ *   License as published by the Free Software Foundation; either
+ *   version 2 of the License, or (at your option) any later version.
+ *
+ *   This library is distributed in the hope that it will be useful,
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ *   Library General Public License for more details.
+ *   You should have received a copy of the GNU Library General Public
+ *   License along with this library; if not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+# -*- coding: utf-8 -*-
+from .search_query import execute_prepared
+
+# Events of a search grouped by transaction.
+#
+# The transactions are aggregated by the database: number of events, time
+# span, tables, applications and users. They are listed by keyset pages on
+# (action_tstamp_tx, transaction_id), most recent first, and the events of
+# a transaction are only read when it is expanded, by keyset pages on
+# event_id. The transaction start time is part of the key since
+# transaction ids wrap around.
+#
+# This module does not depend on QGIS.
+
+TRANSACTION_KEY = ["action_tstamp_tx", "transaction_id"]
+
+# Columns of the transaction list query, the first two are the key.
+TRANSACTION_COLUMNS = ["action_tstamp_tx",
+                       "transaction_id",
+                       "count(*)",
+                       "min(action_tstamp_clk)",
+                       "max(action_tstamp_clk)",
+                       "string_agg(DISTINCT schema_name || '.' || table_name, ', ')",
+                       "string_agg(DISTINCT application_name, ', ')",
+                       "string_agg(DISTINCT session_user_name, ', ')",
+                       "max(event_id)"]
+
+
+def fetch_transactions(cursor, search, last_key, limit):
+    """Fetch a page of transactions.
+    @param cursor a cursor
+    @param search SearchQuery with the filters of the events
+    @param last_key (action_tstamp_tx, transaction_id) of the last transaction of the previous page, None for the first page
+    @param limit maximum number of transactions
+    @returns list of rows of TRANSACTION_COLUMNS
+    """
+    conditions = []
+    if last_key is not None:
+        conditions.append(("(action_tstamp_tx, transaction_id) < ({}, {})", list(last_key)))
+    q, params = search.build(", ".join(TRANSACTION_COLUMNS), conditions,
+                             order="action_tstamp_tx DESC, transaction_id DESC",
+                             limit=limit, numbered=True, group_by=TRANSACTION_KEY)
+    execute_prepared(cursor, q, params)
+    return cursor.fetchall()
+
+
+def fetch_transaction_events(cursor, search, columns, key, last_event_id, limit):
+    """Fetch a page of the events of a transaction, in the order they were recorded.
+    @param cursor a cursor
+    @param search SearchQuery with the filters of the events
+    @param columns list of selected column expressions, the first one must be event_id
+    @param key (action_tstamp_tx, transaction_id) of the transaction
+    @param last_event_id id of the last event of the previous page, None for the first page
+    @param limit maximum number of events
+    """
+    conditions = [("action_tstamp_tx = {} AND transaction_id = {}", list(key))]
+    if last_event_id is not None:
+        conditions.append(("event_id > {}", [last_event_id]))
+    q, params = search.build(", ".join(columns), conditions, order="event_id", limit=limit, numbered=True)
+    execute_prepared(cursor, q, params)
+    return cursor.fetchall()